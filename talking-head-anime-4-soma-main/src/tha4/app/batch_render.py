@@ -0,0 +1,301 @@
+import argparse
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Optional, Tuple, Deque, Iterator
+
+import PIL.Image
+import numpy
+import torch
+import torch.multiprocessing
+from torch import Tensor
+
+from tha4.charmodel.character_model import CharacterModel
+from tha4.image_util import resize_PIL_image
+from tha4.mocap.pose_converter_core import compute_breathing_values
+from tha4.mocap.pose_recording import PoseRecording, HEADER_FILE_NAME, STREAM_POSE, STREAM_BLENDSHAPES, \
+    STREAM_HEAD_ROTATIONS, STREAM_XFORM_MATRIX
+from tha4.poser.poser import Poser
+from tha4.shion.base.image_util import extract_pytorch_image_from_PIL_image, torch_linear_to_srgb
+
+OUTPUT_FORMAT_PNG = "png"
+OUTPUT_FORMAT_APNG = "apng"
+OUTPUT_FORMAT_RGBA = "rgba"
+
+PROGRESS_FILE_NAME = "progress.txt"
+RGBA_FILE_NAME = "frames.rgba"
+APNG_FILE_NAME = "animation.png"
+
+
+def load_poses_from_recording(
+        directory: str, convert_from_mocap: bool, breathing_frequency: float) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    recording = PoseRecording(directory)
+    stream_names = recording.get_stream_names()
+    if STREAM_POSE in stream_names and not convert_from_mocap:
+        return recording.get_stream(STREAM_POSE), recording.timestamps
+
+    breathing_values = compute_breathing_values(recording.timestamps - recording.timestamps[0], breathing_frequency)
+    if STREAM_HEAD_ROTATIONS in stream_names:
+        from tha4.mocap.ifacialmocap_pose_converter_25 import IFacialMocapPoseConverter25
+        poses = IFacialMocapPoseConverter25().convert_batch(
+            recording.get_stream(STREAM_BLENDSHAPES),
+            recording.get_stream(STREAM_HEAD_ROTATIONS),
+            breathing_values)
+    elif STREAM_XFORM_MATRIX in stream_names:
+        from tha4.mocap.mediapipe_face_pose_converter_00 import MediaPoseFacePoseConverter00
+        xform_matrices = recording.get_stream(STREAM_XFORM_MATRIX).reshape(recording.num_frames, 4, 4)
+        poses = MediaPoseFacePoseConverter00().convert_batch(
+            recording.get_stream(STREAM_BLENDSHAPES),
+            xform_matrices,
+            breathing_values)
+    else:
+        raise RuntimeError(f"Recording {directory} has neither a pose stream nor a mocap stream.")
+    return poses, recording.timestamps
+
+
+def load_poses(file_name: str, convert_from_mocap: bool = False, breathing_frequency: float = 0.0) -> numpy.ndarray:
+    if os.path.isdir(file_name) and os.path.exists(os.path.join(file_name, HEADER_FILE_NAME)):
+        poses, _ = load_poses_from_recording(file_name, convert_from_mocap, breathing_frequency)
+    elif file_name.endswith(".npy"):
+        poses = numpy.load(file_name, mmap_mode='r')
+    elif file_name.endswith(".pt"):
+        poses = torch.load(file_name, map_location='cpu').numpy()
+    else:
+        raise RuntimeError(f"Unsupported pose sequence file: {file_name}")
+    if len(poses.shape) != 2:
+        raise RuntimeError(f"The pose sequence must be a (num_frames x num_parameters) array, got {poses.shape}.")
+    return poses
+
+
+def load_poser_and_image(
+        character_model_file_name: Optional[str],
+        image_file_name: Optional[str],
+        device: torch.device) -> Tuple[Poser, Tensor]:
+    if character_model_file_name is not None:
+        character_model = CharacterModel.load(character_model_file_name)
+        poser = character_model.get_poser(device)
+        image = character_model.get_character_image(device)
+    else:
+        import tha4.poser.modes.mode_07
+
+        poser = tha4.poser.modes.mode_07.create_poser(device)
+        pil_image = resize_PIL_image(
+            PIL.Image.open(image_file_name), (poser.get_image_size(), poser.get_image_size()))
+        if pil_image.mode != 'RGBA':
+            raise RuntimeError("Image must have alpha channel!")
+        image = extract_pytorch_image_from_PIL_image(pil_image).to(device)
+    return poser, image.to(poser.get_dtype())
+
+
+def convert_output_images_to_numpy(output_images: Tensor) -> numpy.ndarray:
+    output_images = torch.clip((output_images.float() + 1.0) / 2.0, 0.0, 1.0)
+    rgb_images = torch_linear_to_srgb(output_images[:, 0:3, :, :])
+    output_images = torch.cat([rgb_images, output_images[:, 3:4, :, :]], dim=1)
+    output_images = torch.round(output_images * 255.0).to(torch.uint8)
+    return output_images.permute(0, 2, 3, 1).contiguous().cpu().numpy()
+
+
+def get_frame_file_name(output_dir: str, index: int) -> str:
+    return os.path.join(output_dir, "%08d.png" % index)
+
+
+def write_png_frame(numpy_image: numpy.ndarray, file_name: str, compress_level: int) -> str:
+    temp_file_name = file_name + ".tmp"
+    PIL.Image.fromarray(numpy_image, mode='RGBA').save(temp_file_name, format="PNG", compress_level=compress_level)
+    os.replace(temp_file_name, file_name)
+    return file_name
+
+
+class OrderedFrameWriter:
+    def __init__(self,
+                 output_dir: str,
+                 output_format: str,
+                 num_workers: int,
+                 max_pending_frames: int,
+                 png_compress_level: int = 6):
+        assert num_workers >= 1
+        assert max_pending_frames >= 1
+        self.png_compress_level = png_compress_level
+        self.max_pending_frames = max_pending_frames
+        self.num_workers = num_workers
+        self.output_format = output_format
+        self.output_dir = output_dir
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.pending_frames: Deque[Tuple[int, Future]] = deque()
+        self.rgba_file = None
+        self.frame_num_bytes = None
+        self.num_completed_frames = self.load_num_completed_frames()
+
+    def get_progress_file_name(self) -> str:
+        return os.path.join(self.output_dir, PROGRESS_FILE_NAME)
+
+    def load_num_completed_frames(self) -> int:
+        if not os.path.exists(self.get_progress_file_name()):
+            return 0
+        with open(self.get_progress_file_name(), "rt") as fin:
+            return int(fin.read().strip())
+
+    def save_num_completed_frames(self):
+        temp_file_name = self.get_progress_file_name() + ".tmp"
+        with open(temp_file_name, "wt") as fout:
+            fout.write(str(self.num_completed_frames))
+        os.replace(temp_file_name, self.get_progress_file_name())
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                mp_context=torch.multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def open_rgba_file(self, frame_num_bytes: int):
+        self.frame_num_bytes = frame_num_bytes
+        self.rgba_file = open(os.path.join(self.output_dir, RGBA_FILE_NAME), "ab")
+        self.rgba_file.truncate(self.num_completed_frames * frame_num_bytes)
+
+    def write_batch(self, start_index: int, numpy_images: numpy.ndarray):
+        assert start_index == self.num_completed_frames + len(self.pending_frames)
+        if self.output_format == OUTPUT_FORMAT_RGBA:
+            if self.rgba_file is None:
+                self.open_rgba_file(numpy_images[0].nbytes)
+            self.rgba_file.write(numpy_images.tobytes())
+            self.rgba_file.flush()
+            self.num_completed_frames += numpy_images.shape[0]
+            self.save_num_completed_frames()
+            return
+
+        for i in range(numpy_images.shape[0]):
+            index = start_index + i
+            future = self.get_executor().submit(
+                write_png_frame,
+                numpy_images[i],
+                get_frame_file_name(self.output_dir, index),
+                self.png_compress_level)
+            self.pending_frames.append((index, future))
+        self.collect_completed_frames(wait=False)
+
+    def collect_completed_frames(self, wait: bool):
+        num_completed_frames = self.num_completed_frames
+        while len(self.pending_frames) > 0:
+            index, future = self.pending_frames[0]
+            must_wait = wait or len(self.pending_frames) > self.max_pending_frames
+            if not must_wait and not future.done():
+                break
+            future.result()
+            self.pending_frames.popleft()
+            self.num_completed_frames = index + 1
+        if self.num_completed_frames != num_completed_frames:
+            self.save_num_completed_frames()
+
+    def load_frames(self, start: int, end: int) -> Iterator[PIL.Image.Image]:
+        for i in range(start, end):
+            with PIL.Image.open(get_frame_file_name(self.output_dir, i)) as file_frame:
+                frame = file_frame.copy()
+            yield frame
+
+    # The frame files are opened one at a time and closed once decoded, so long sequences do not run out of file
+    # descriptors. Pillow's APNG encoder still keeps every decoded frame until the file is written, so assembling
+    # takes about num_frames * width * height * 4 bytes of memory, e.g. 1 GiB for 1000 frames of 512x512. Use the
+    # rgba output for longer sequences.
+    def assemble_apng(self, num_frames: int, frame_duration_ms: float):
+        first_frame = next(self.load_frames(0, 1))
+        first_frame.save(
+            os.path.join(self.output_dir, APNG_FILE_NAME),
+            format="PNG",
+            save_all=True,
+            append_images=self.load_frames(1, num_frames),
+            duration=frame_duration_ms,
+            loop=0,
+            disposal=1)
+
+    def close(self):
+        self.collect_completed_frames(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.rgba_file is not None:
+            self.rgba_file.close()
+            self.rgba_file = None
+
+
+def render(poser: Poser,
+           image: Tensor,
+           poses: numpy.ndarray,
+           writer: OrderedFrameWriter,
+           batch_size: int,
+           device: torch.device):
+    num_frames = poses.shape[0]
+    start_index = writer.num_completed_frames
+    if start_index > 0:
+        logging.info(f"Resuming from frame {start_index} of {num_frames}")
+    start_time = time.time()
+    for batch_start in range(start_index, num_frames, batch_size):
+        batch_end = min(num_frames, batch_start + batch_size)
+        pose = torch.from_numpy(numpy.ascontiguousarray(poses[batch_start:batch_end], dtype=numpy.float32))
+        pose = pose.to(device).to(poser.get_dtype())
+        with torch.no_grad():
+            output_images = poser.pose(image, pose)
+        writer.write_batch(batch_start, convert_output_images_to_numpy(output_images))
+
+        elapsed_time = time.time() - start_time
+        num_rendered_frames = batch_end - start_index
+        logging.info(
+            f"Rendered {batch_end}/{num_frames} frames ({num_rendered_frames / max(elapsed_time, 1e-6):0.2f} fps)")
+    writer.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Render a pose sequence to an image sequence without the GUI.')
+    parser.add_argument('--character_model', type=str, required=False, default=None,
+                        help='The YAML file of the character model to render with.')
+    parser.add_argument('--image', type=str, required=False, default=None,
+                        help='The RGBA image to render with the mode_07 poser. Used when no character model is given.')
+    parser.add_argument('--poses', type=str, required=True,
+                        help='A (num_frames x num_parameters) .npy or .pt file, or a pose recording directory.')
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='The directory to write the frames to. Rendering resumes from the last completed frame.')
+    parser.add_argument('--output_format', type=str, default=OUTPUT_FORMAT_PNG,
+                        choices=[OUTPUT_FORMAT_PNG, OUTPUT_FORMAT_APNG, OUTPUT_FORMAT_RGBA],
+                        help='The output format. "rgba" writes a raw RGBA stream that can be piped into a video encoder.')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='The number of frames to render in one poser call.')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count() or 1,
+                        help='The number of processes that encode PNG frames.')
+    parser.add_argument('--png_compress_level', type=int, default=6,
+                        help='The zlib compression level of the PNG frames, from 0 to 9.')
+    parser.add_argument('--fps', type=float, default=30.0,
+                        help='The frame rate of the APNG output.')
+    parser.add_argument('--convert_from_mocap', action='store_true',
+                        help='Convert the mocap streams of a recording even if it contains a pose stream.')
+    parser.add_argument('--breathing_frequency', type=float, default=0.0,
+                        help='The breathing frequency, in breaths per minute, used when converting mocap streams.')
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu',
+                        help='The device to render on.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, force=True)
+    if args.character_model is None and args.image is None:
+        parser.error("Either --character_model or --image must be given.")
+
+    device = torch.device(args.device)
+    poser, image = load_poser_and_image(args.character_model, args.image, device)
+    poses = load_poses(args.poses, args.convert_from_mocap, args.breathing_frequency)
+    if poses.shape[1] != poser.get_num_parameters():
+        raise RuntimeError(
+            f"The poser takes {poser.get_num_parameters()} parameters, but the poses have {poses.shape[1]}.")
+
+    writer = OrderedFrameWriter(
+        args.output_dir,
+        args.output_format,
+        num_workers=max(1, args.num_workers),
+        max_pending_frames=4 * max(1, args.num_workers) + args.batch_size,
+        png_compress_level=args.png_compress_level)
+    render(poser, image, poses, writer, args.batch_size, device)
+
+    if args.output_format == OUTPUT_FORMAT_APNG:
+        writer.assemble_apng(poses.shape[0], 1000.0 / args.fps)
+    logging.info(f"Wrote {poses.shape[0]} frames to {args.output_dir}")
@@ -0,0 +1,88 @@
+import argparse
+import logging
+import math
+import os
+
+import numpy
+import torch
+
+from tha4.charmodel.character_model import CharacterModel
+from tha4.poser.sprite_atlas import SpriteAtlasAxis, SpriteAtlasPoser, render_sprite_atlas, evaluate_sprite_atlas
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Pre-render a character model over a lattice of a few pose parameters into a sprite atlas.')
+    parser.add_argument('--character_model', type=str, required=True,
+                        help='The YAML file of the character model.')
+    parser.add_argument('--axis', type=str, action='append', required=True,
+                        help='A lattice axis given as name:min:max:num_samples, for example eye_wink_left:0:1:5. '
+                             'Repeat the option to add more axes.')
+    parser.add_argument('--base_pose', type=str, required=False, default=None,
+                        help='A .npy file with the values of the parameters that are not on the lattice. '
+                             'Defaults to all zeros.')
+    parser.add_argument('--atlas_image_size', type=int, required=False, default=None,
+                        help='The size of the stored images. Defaults to the size of the character image.')
+    parser.add_argument('--max_atlas_megabytes', type=float, default=1024.0,
+                        help='Refuse to build atlases whose uncompressed images are larger than this.')
+    parser.add_argument('--output', type=str, required=False, default=None,
+                        help='The atlas file. Defaults to sprite_atlas.npz next to the character model.')
+    parser.add_argument('--update_character_model', action='store_true',
+                        help='Record the atlas in the character model YAML file.')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='The number of lattice entries to render in one poser call.')
+    parser.add_argument('--num_evaluation_samples', type=int, default=64,
+                        help='The number of random poses used to measure the reconstruction error. 0 disables it.')
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu',
+                        help='The device to render on.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, force=True)
+    device = torch.device(args.device)
+    axes = [SpriteAtlasAxis.parse(spec) for spec in args.axis]
+
+    character_model = CharacterModel.load(args.character_model)
+    poser = character_model.get_poser(device)
+    image = character_model.get_character_image(device).to(poser.get_dtype())
+
+    if args.base_pose is not None:
+        base_pose = numpy.load(args.base_pose).astype(numpy.float32).reshape(-1)
+    else:
+        base_pose = numpy.zeros(poser.get_num_parameters(), dtype=numpy.float32)
+    if base_pose.shape[0] != poser.get_num_parameters():
+        raise RuntimeError(
+            f"The base pose has {base_pose.shape[0]} values, but the poser takes {poser.get_num_parameters()}.")
+
+    atlas_image_size = args.atlas_image_size if args.atlas_image_size is not None else poser.get_image_size()
+    num_entries = math.prod(axis.num_samples for axis in axes)
+    atlas_megabytes = num_entries * 4 * atlas_image_size * atlas_image_size / 2 ** 20
+    logging.info(f"The atlas has {num_entries} entries of size {atlas_image_size} ({atlas_megabytes:0.1f} MiB)")
+    if atlas_megabytes > args.max_atlas_megabytes:
+        raise RuntimeError(
+            f"The atlas would take {atlas_megabytes:0.1f} MiB, more than --max_atlas_megabytes. "
+            f"Use fewer samples per axis or a smaller --atlas_image_size.")
+
+    atlas = render_sprite_atlas(poser, image, axes, base_pose, atlas_image_size, args.batch_size)
+
+    output_file_name = args.output
+    if output_file_name is None:
+        output_file_name = os.path.join(os.path.dirname(args.character_model), "sprite_atlas.npz")
+    os.makedirs(os.path.dirname(os.path.abspath(output_file_name)), exist_ok=True)
+    atlas.save(output_file_name)
+    logging.info(f"Saved {output_file_name} ({os.path.getsize(output_file_name) / 2 ** 20:0.1f} MiB compressed)")
+
+    if args.num_evaluation_samples > 0:
+        atlas_poser = SpriteAtlasPoser(atlas, poser.get_pose_parameter_groups(), device)
+        errors = evaluate_sprite_atlas(atlas_poser, poser, image, args.num_evaluation_samples, args.batch_size)
+        logging.info(
+            "Reconstruction error over %d random poses: mean abs = %0.5f, rmse = %0.5f, psnr = %0.2f dB, "
+            "max abs = %0.5f" % (
+                args.num_evaluation_samples,
+                errors["mean_abs_error"],
+                errors["rmse"],
+                errors["psnr"],
+                errors["max_abs_error"]))
+
+    if args.update_character_model:
+        character_model.sprite_atlas_file_name = output_file_name
+        character_model.save(args.character_model)
+        logging.info(f"Updated {args.character_model}")
@@ -1,3 +1,4 @@
+import argparse
 import os
 import socket
 import sys
@@ -23,6 +24,9 @@ import wx
 
 from tha4.mocap.ifacialmocap_constants import *
 from tha4.mocap.ifacialmocap_pose_converter import IFacialMocapPoseConverter
+from tha4.mocap.pose_filter import PosePredictionFilter, create_pose_filter
+from tha4.mocap.pose_recording import PoseRecordingWriter, create_ifacialmocap_recording_writer, \
+    STREAM_BLENDSHAPES, STREAM_HEAD_ROTATIONS, STREAM_POSE
 
 
 class FpsStatistics:
@@ -45,13 +49,23 @@ class FpsStatistics:
 class MainFrame(wx.Frame):
     IMAGE_SIZE = 512
 
-    def __init__(self, pose_converter: IFacialMocapPoseConverter, device: torch.device):
+    def __init__(self,
+                 pose_converter: IFacialMocapPoseConverter,
+                 device: torch.device,
+                 recording_writer: Optional[PoseRecordingWriter] = None,
+                 pose_filter: Optional[PosePredictionFilter] = None,
+                 use_sprite_atlas: bool = False):
         super().__init__(None, wx.ID_ANY, "iFacialMocap Puppeteer (Fuji)")
+        self.use_sprite_atlas = use_sprite_atlas
+        self.pose_filter = pose_filter
+        self.recording_writer = recording_writer
         self.poser = None
         self.pose_converter = pose_converter
         self.device = device
 
         self.ifacialmocap_pose = create_default_ifacialmocap_pose()
+        self.ifacialmocap_pose_time = time.time()
+        self.last_recorded_pose_time = self.ifacialmocap_pose_time
         self.source_image_bitmap = wx.Bitmap(MainFrame.IMAGE_SIZE, MainFrame.IMAGE_SIZE)
         self.result_image_bitmap = wx.Bitmap(MainFrame.IMAGE_SIZE, MainFrame.IMAGE_SIZE)
         self.wx_source_image = None
@@ -87,6 +101,11 @@ class MainFrame(wx.Frame):
         # Close receiving socket
         self.receiving_socket.close()
 
+        # Close the recording
+        if self.recording_writer is not None:
+            self.recording_writer.close()
+            self.recording_writer = None
+
         # Destroy the windows
         self.Destroy()
         event.Skip()
@@ -118,6 +137,7 @@ class MainFrame(wx.Frame):
         if socket_bytes is not None:
             socket_string = socket_bytes.decode("utf-8")
             self.ifacialmocap_pose = parse_ifacialmocap_v2_pose(socket_string)
+            self.ifacialmocap_pose_time = time.time()
         return self.ifacialmocap_pose
 
     def on_erase_background(self, event: wx.Event):
@@ -308,6 +328,9 @@ class MainFrame(wx.Frame):
     def update_result_image_bitmap(self, event: Optional[wx.Event] = None):
         ifacialmocap_pose = self.read_ifacialmocap_pose()
         current_pose = self.pose_converter.convert(ifacialmocap_pose)
+        self.record_pose(ifacialmocap_pose, current_pose)
+        if self.pose_filter is not None:
+            current_pose = self.pose_filter.filter(current_pose, self.ifacialmocap_pose_time, time.time())
         if self.last_pose is not None and self.last_pose == current_pose:
             return
         self.last_pose = current_pose
@@ -319,6 +342,7 @@ class MainFrame(wx.Frame):
             del dc
             return
 
+        render_start_time = time.time()
         pose = torch.tensor(current_pose, device=self.device, dtype=self.poser.get_dtype())
 
         with torch.no_grad():
@@ -363,6 +387,9 @@ class MainFrame(wx.Frame):
                       (MainFrame.IMAGE_SIZE - numpy_image.shape[1]) // 2, True)
         del dc
 
+        if self.pose_filter is not None:
+            self.pose_filter.add_latency_sample(time.time() - render_start_time)
+
         time_now = time.time_ns()
         if self.last_update_time is not None:
             elapsed_time = time_now - self.last_update_time
@@ -374,6 +401,20 @@ class MainFrame(wx.Frame):
 
         self.Refresh()
 
+    def record_pose(self, ifacialmocap_pose, current_pose):
+        # The render timer ticks faster than iFacialMocap sends poses, so only poses that arrived since the last
+        # recorded one are written, stamped with the time they arrived.
+        if self.recording_writer is None or not self.animation_timer.IsRunning():
+            return
+        if self.ifacialmocap_pose_time == self.last_recorded_pose_time:
+            return
+        self.last_recorded_pose_time = self.ifacialmocap_pose_time
+        self.recording_writer.add(self.ifacialmocap_pose_time, {
+            STREAM_BLENDSHAPES: [ifacialmocap_pose[name] for name in BLENDSHAPE_NAMES],
+            STREAM_HEAD_ROTATIONS: [ifacialmocap_pose[name] for name in HEAD_BONE_ROTATIONS],
+            STREAM_POSE: current_pose,
+        })
+
     def blend_with_background(self, numpy_image, background):
         alpha = numpy_image[3:4, :, :]
         color = numpy_image[0:3, :, :]
@@ -394,7 +435,10 @@ class MainFrame(wx.Frame):
                 w, h = pil_image.size
                 self.wx_source_image = wx.Bitmap.FromBufferRGBA(w, h, pil_image.convert("RGBA").tobytes())
                 self.update_source_image_bitmap()
-                self.poser = self.character_model.get_poser(self.device)
+                if self.use_sprite_atlas and self.character_model.sprite_atlas_file_name is not None:
+                    self.poser = self.character_model.get_sprite_atlas_poser(self.device)
+                else:
+                    self.poser = self.character_model.get_poser(self.device)
             except Exception:
                 message_dialog = wx.MessageDialog(
                     self, "Could not load character model " + character_model_json_file_name, "Poser", wx.OK)
@@ -405,12 +449,28 @@ class MainFrame(wx.Frame):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Control a character model with iFacialMocap.')
+    parser.add_argument('--record_dir', type=str, required=False, default=None,
+                        help='The directory to append the received blendshapes and converted poses to.')
+    parser.add_argument('--pose_filter', type=str, default='none', choices=['none', 'one_euro', 'kalman'],
+                        help='The filter that smooths the converted poses and extrapolates them to the display time.')
+    parser.add_argument('--prediction_latency', type=float, default=0.0,
+                        help='The capture latency, in seconds, to extrapolate the head rotation over '
+                             'in addition to the measured rendering latency.')
+    parser.add_argument('--use_sprite_atlas', action='store_true',
+                        help='Serve frames from the character model\'s sprite atlas instead of running the network.')
+    args = parser.parse_args()
+
     device = torch.device('cuda:0')
 
     pose_converter = create_ifacialmocap_pose_converter()
+    pose_filter = create_pose_filter(args.pose_filter, args.prediction_latency)
+    recording_writer = None
+    if args.record_dir is not None:
+        recording_writer = create_ifacialmocap_recording_writer(args.record_dir)
 
     app = wx.App()
-    main_frame = MainFrame(pose_converter, device)
+    main_frame = MainFrame(pose_converter, device, recording_writer, pose_filter, args.use_sprite_atlas)
     main_frame.Show(True)
     main_frame.capture_timer.Start(10)
     main_frame.animation_timer.Start(10)
@@ -1,7 +1,6 @@
 import logging
 import os
 import sys
-import time
 from typing import List
 
 from tha4.charmodel.character_model import CharacterModel
@@ -15,6 +14,7 @@ import torch
 import wx
 
 from tha4.poser.poser import PoseParameterCategory, PoseParameterGroup
+from tha4.shion.core.profiler import get_profiler
 
 
 class MorphCategoryControlPanel(wx.Panel):
@@ -362,20 +362,9 @@ class MainFrame(wx.Frame):
 
         pose = torch.tensor(current_pose, device=self.device)
         output_index = self.output_index_choice.GetSelection()
-        with torch.no_grad():
-            start_cuda_event = torch.cuda.Event(enable_timing=True)
-            end_cuda_event = torch.cuda.Event(enable_timing=True)
-            start_cuda_event.record()
-            start_time = time.time()
-
+        with torch.no_grad(), get_profiler().profile("character_model_manual_poser.pose"):
             output_image = self.poser.pose(self.torch_source_image, pose, output_index)[0].detach().cpu()
 
-            end_time = time.time()
-            end_cuda_event.record()
-            torch.cuda.synchronize()
-            print("cuda time (ms):", start_cuda_event.elapsed_time(end_cuda_event))
-            print("elapsed time (ms):", (end_time - start_time) * 1000.0)
-
         numpy_image = convert_output_image_from_torch_to_numpy(output_image)
         self.last_output_numpy_image = numpy_image
         wx_image = wx.ImageFromBuffer(
@@ -430,7 +419,10 @@ class MainFrame(wx.Frame):
 
 
 if __name__ == "__main__":
-    device = torch.device('cuda:0')
+    if torch.cuda.is_available():
+        device = torch.device('cuda:0')
+    else:
+        device = torch.device('cpu')
     app = wx.App()
     main_frame = MainFrame(device)
     main_frame.Show(True)
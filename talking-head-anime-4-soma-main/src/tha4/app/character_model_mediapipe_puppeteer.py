@@ -1,3 +1,4 @@
+import argparse
 import os
 import sys
 import threading
@@ -12,9 +13,12 @@ from scipy.spatial.transform import Rotation
 from tha4.shion.base.image_util import resize_PIL_image
 from tha4.charmodel.character_model import CharacterModel
 from tha4.image_util import convert_linear_to_srgb
-from tha4.mocap.mediapipe_constants import HEAD_ROTATIONS, HEAD_X, HEAD_Y, HEAD_Z
+from tha4.mocap.mediapipe_constants import HEAD_ROTATIONS, HEAD_X, HEAD_Y, HEAD_Z, BLENDSHAPE_NAMES
 from tha4.mocap.mediapipe_face_pose import MediaPipeFacePose
 from tha4.mocap.mediapipe_face_pose_converter_00 import MediaPoseFacePoseConverter00
+from tha4.mocap.pose_filter import PosePredictionFilter, create_pose_filter
+from tha4.mocap.pose_recording import PoseRecordingWriter, create_mediapipe_recording_writer, STREAM_BLENDSHAPES, \
+    STREAM_XFORM_MATRIX, STREAM_POSE
 
 sys.path.append(os.getcwd())
 
@@ -46,8 +50,15 @@ class MainFrame(wx.Frame):
                  pose_converter: MediaPoseFacePoseConverter00,
                  video_capture,
                  face_landmarker,
-                 device: torch.device):
+                 device: torch.device,
+                 recording_writer: Optional[PoseRecordingWriter] = None,
+                 pose_filter: Optional[PosePredictionFilter] = None,
+                 use_sprite_atlas: bool = False):
         super().__init__(None, wx.ID_ANY, "THA4 Character Model MediaPipe Puppeteer")
+        self.use_sprite_atlas = use_sprite_atlas
+        self.pose_filter = pose_filter
+        self.recording_writer = recording_writer
+        self.last_recorded_face_pose = None
         self.face_landmarker = face_landmarker
         self.video_capture = video_capture
         self.pose_converter = pose_converter
@@ -60,6 +71,7 @@ class MainFrame(wx.Frame):
         self.torch_source_image = None
         self.last_pose = None
         self.mediapipe_face_pose = None
+        self.mediapipe_face_pose_time = None
         self.fps_statistics = FpsStatistics()
         self.last_update_time = None
         self.character_model = None
@@ -83,6 +95,11 @@ class MainFrame(wx.Frame):
         self.animation_timer.Stop()
         self.capture_timer.Stop()
 
+        # Close the recording
+        if self.recording_writer is not None:
+            self.recording_writer.close()
+            self.recording_writer = None
+
         # Destroy the windows
         self.Destroy()
         event.Skip()
@@ -244,12 +261,12 @@ class MainFrame(wx.Frame):
 
         self.webcam_capture_panel.Refresh()
 
-        time_ms = int(time.time() * 1000)
+        capture_time = time.time()
         mediapipe_image = mediapipe.Image(image_format=mediapipe.ImageFormat.SRGB, data=rgb_frame)
-        detection_result = self.face_landmarker.detect_for_video(mediapipe_image, time_ms)
-        self.update_mediapipe_face_pose(detection_result)
+        detection_result = self.face_landmarker.detect_for_video(mediapipe_image, int(capture_time * 1000))
+        self.update_mediapipe_face_pose(detection_result, capture_time)
 
-    def update_mediapipe_face_pose(self, detection_result):
+    def update_mediapipe_face_pose(self, detection_result, capture_time: float):
         if len(detection_result.facial_transformation_matrixes) == 0:
             return
 
@@ -269,6 +286,7 @@ class MainFrame(wx.Frame):
         self.rotation_value_labels[HEAD_Z].Refresh()
 
         self.mediapipe_face_pose = MediaPipeFacePose(blendshape_params, xform_matrix)
+        self.mediapipe_face_pose_time = capture_time
 
     @staticmethod
     def convert_to_100(x):
@@ -306,6 +324,9 @@ class MainFrame(wx.Frame):
             return
 
         current_pose = self.pose_converter.convert(self.mediapipe_face_pose)
+        self.record_pose(self.mediapipe_face_pose, current_pose)
+        if self.pose_filter is not None:
+            current_pose = self.pose_filter.filter(current_pose, self.mediapipe_face_pose_time, time.time())
         if self.last_pose is not None and self.last_pose == current_pose:
             return
         self.last_pose = current_pose
@@ -317,6 +338,7 @@ class MainFrame(wx.Frame):
             del dc
             return
 
+        render_start_time = time.time()
         pose = torch.tensor(current_pose, device=self.device, dtype=self.poser.get_dtype())
 
         with torch.no_grad():
@@ -361,6 +383,9 @@ class MainFrame(wx.Frame):
                       (MainFrame.IMAGE_SIZE - numpy_image.shape[1]) // 2, True)
         del dc
 
+        if self.pose_filter is not None:
+            self.pose_filter.add_latency_sample(time.time() - render_start_time)
+
         time_now = time.time_ns()
         if self.last_update_time is not None:
             elapsed_time = time_now - self.last_update_time
@@ -372,6 +397,16 @@ class MainFrame(wx.Frame):
 
         self.Refresh()
 
+    def record_pose(self, mediapipe_face_pose: MediaPipeFacePose, current_pose):
+        if self.recording_writer is None or self.last_recorded_face_pose is mediapipe_face_pose:
+            return
+        self.last_recorded_face_pose = mediapipe_face_pose
+        self.recording_writer.add(self.mediapipe_face_pose_time, {
+            STREAM_BLENDSHAPES: [mediapipe_face_pose.blendshape_params.get(name, 0.0) for name in BLENDSHAPE_NAMES],
+            STREAM_XFORM_MATRIX: mediapipe_face_pose.xform_matrix,
+            STREAM_POSE: current_pose,
+        })
+
     def blend_with_background(self, numpy_image, background):
         alpha = numpy_image[3:4, :, :]
         color = numpy_image[0:3, :, :]
@@ -392,7 +427,10 @@ class MainFrame(wx.Frame):
                 w, h = pil_image.size
                 self.wx_source_image = wx.Bitmap.FromBufferRGBA(w, h, pil_image.convert("RGBA").tobytes())
                 self.update_source_image_bitmap()
-                self.poser = self.character_model.get_poser(self.device)
+                if self.use_sprite_atlas and self.character_model.sprite_atlas_file_name is not None:
+                    self.poser = self.character_model.get_sprite_atlas_poser(self.device)
+                else:
+                    self.poser = self.character_model.get_poser(self.device)
             except Exception:
                 message_dialog = wx.MessageDialog(
                     self, "Could not load character model " + character_model_json_file_name, "Poser", wx.OK)
@@ -403,9 +441,25 @@ class MainFrame(wx.Frame):
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Control a character model with a webcam through MediaPipe.')
+    parser.add_argument('--record_dir', type=str, required=False, default=None,
+                        help='The directory to append the detected blendshapes, transforms, and poses to.')
+    parser.add_argument('--pose_filter', type=str, default='none', choices=['none', 'one_euro', 'kalman'],
+                        help='The filter that smooths the converted poses and extrapolates them to the display time.')
+    parser.add_argument('--prediction_latency', type=float, default=0.0,
+                        help='The capture latency, in seconds, to extrapolate the head rotation over '
+                             'in addition to the measured rendering latency.')
+    parser.add_argument('--use_sprite_atlas', action='store_true',
+                        help='Serve frames from the character model\'s sprite atlas instead of running the network.')
+    args = parser.parse_args()
+
     device = torch.device("cuda:0")
 
     pose_converter = MediaPoseFacePoseConverter00()
+    pose_filter = create_pose_filter(args.pose_filter, args.prediction_latency)
+    recording_writer = None
+    if args.record_dir is not None:
+        recording_writer = create_mediapipe_recording_writer(args.record_dir)
 
     face_landmarker_base_options = mediapipe.tasks.BaseOptions(
         model_asset_path='data/thirdparty/mediapipe/face_landmarker_v2_with_blendshapes.task')
@@ -420,7 +474,9 @@ if __name__ == "__main__":
     video_capture = cv2.VideoCapture(0)
 
     app = wx.App()
-    main_frame = MainFrame(pose_converter, video_capture, face_landmarker, device)
+    main_frame = MainFrame(
+        pose_converter, video_capture, face_landmarker, device, recording_writer, pose_filter,
+        args.use_sprite_atlas)
     main_frame.Show(True)
     main_frame.capture_timer.Start(30)
     main_frame.animation_timer.Start(30)
@@ -0,0 +1,25 @@
+import argparse
+import logging
+
+from tha4.distiller.multi_character_distiller_config import MultiCharacterDistillerConfig
+from tha4.pytasuku.workspace import Workspace
+
+
+def run_config(config_file_name: str):
+    config = MultiCharacterDistillerConfig.load(config_file_name)
+
+    logging.basicConfig(level=logging.INFO, force=True)
+    workspace = Workspace()
+    config.define_tasks(workspace)
+
+    workspace.start_session()
+    workspace.run(f"{config.prefix}/all")
+    workspace.end_session()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Distill several characters in one training job.')
+    parser.add_argument("--config_file", type=str, required=True,
+                        help="The name of the config file that lists the characters' distiller config files.")
+    args = parser.parse_args()
+    run_config(args.config_file)
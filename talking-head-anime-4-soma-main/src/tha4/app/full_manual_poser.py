@@ -1,7 +1,6 @@
 import logging
 import os
 import sys
-import time
 from typing import List
 
 from tha4.shion.base.image_util import extract_pytorch_image_from_PIL_image, pytorch_rgba_to_numpy_image, \
@@ -16,6 +15,7 @@ import torch
 import wx
 
 from tha4.poser.poser import Poser, PoseParameterCategory, PoseParameterGroup
+from tha4.shion.core.profiler import get_profiler
 
 
 class MorphCategoryControlPanel(wx.Panel):
@@ -384,20 +384,9 @@ class MainFrame(wx.Frame):
 
         pose = torch.tensor(current_pose, device=self.device, dtype=self.dtype)
         output_index = self.output_index_choice.GetSelection()
-        with torch.no_grad():
-            start_cuda_event = torch.cuda.Event(enable_timing=True)
-            end_cuda_event = torch.cuda.Event(enable_timing=True)
-            start_cuda_event.record()
-            start_time = time.time()
-
+        with torch.no_grad(), get_profiler().profile("full_manual_poser.pose"):
             output_image = self.poser.pose(self.torch_source_image, pose, output_index)[0].detach().cpu()
 
-            end_time = time.time()
-            end_cuda_event.record()
-            torch.cuda.synchronize()
-            print("cuda time (ms):", start_cuda_event.elapsed_time(end_cuda_event))
-            print("elapsed time (ms):", (end_time - start_time) * 1000.0)
-
         numpy_image = convert_output_image_from_torch_to_numpy(output_image)
         self.last_output_numpy_image = numpy_image
         wx_image = wx.ImageFromBuffer(
@@ -452,7 +441,10 @@ class MainFrame(wx.Frame):
 
 
 if __name__ == "__main__":
-    device = torch.device('cuda:0')
+    if torch.cuda.is_available():
+        device = torch.device('cuda:0')
+    else:
+        device = torch.device('cpu')
     try:
         import tha4.poser.modes.mode_07
 
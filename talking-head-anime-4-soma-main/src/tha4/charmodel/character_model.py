@@ -1,37 +1,64 @@
 import json
 import os.path
+from typing import Optional
 
 import PIL.Image
 import torch
-from omegaconf import OmegaConf
 
 from tha4.shion.base.image_util import extract_pytorch_image_from_PIL_image
-from tha4.poser.modes.mode_14 import create_poser, KEY_FACE_MORPHER, KEY_BODY_MORPHER
 
 
 class CharacterModel:
     def __init__(self,
                  character_image_file_name: str,
                  face_morpher_file_name: str,
-                 body_morpher_file_name: str):
+                 body_morpher_file_name: str,
+                 coverage_mask_file_name: Optional[str] = None,
+                 sprite_atlas_file_name: Optional[str] = None):
+        self.sprite_atlas_file_name = sprite_atlas_file_name
+        self.coverage_mask_file_name = coverage_mask_file_name
         self.body_morpher_file_name = body_morpher_file_name
         self.face_morpher_file_name = face_morpher_file_name
         self.character_image_file_name = character_image_file_name
         self.poser = None
+        self.sprite_atlas_poser = None
         self.character_image = None
 
     def get_poser(self, device: torch.device):
+        from tha4.poser.modes.mode_14 import create_poser, KEY_FACE_MORPHER, KEY_BODY_MORPHER, SirenEngine
+
         if self.poser is not None:
             self.poser.to(device)
         else:
+            if self.coverage_mask_file_name is not None:
+                engine = SirenEngine.SPARSE
+            else:
+                engine = SirenEngine.CONV
             self.poser = create_poser(
                 device,
                 module_file_names={
                     KEY_FACE_MORPHER: self.face_morpher_file_name,
                     KEY_BODY_MORPHER: self.body_morpher_file_name
-                })
+                },
+                engine=engine,
+                coverage_mask_file_name=self.coverage_mask_file_name)
         return self.poser
 
+    def get_sprite_atlas_poser(self, device: torch.device):
+        from tha4.poser.modes.pose_parameters import get_pose_parameters
+        from tha4.poser.sprite_atlas import SpriteAtlas, SpriteAtlasPoser
+
+        if self.sprite_atlas_file_name is None:
+            raise RuntimeError("The character model does not have a sprite atlas.")
+        if self.sprite_atlas_poser is not None:
+            self.sprite_atlas_poser.to(device)
+        else:
+            self.sprite_atlas_poser = SpriteAtlasPoser(
+                SpriteAtlas.load(self.sprite_atlas_file_name),
+                get_pose_parameters().get_pose_parameter_groups(),
+                device)
+        return self.sprite_atlas_poser
+
     def get_character_image(self, device: torch.device):
         if self.character_image is None:
             pil_image = PIL.Image.open(self.character_image_file_name)
@@ -41,7 +68,16 @@ class CharacterModel:
         self.character_image = self.character_image.to(device)
         return self.character_image
 
+    def free(self):
+        if self.poser is not None and hasattr(self.poser, "free"):
+            self.poser.free()
+        self.poser = None
+        self.sprite_atlas_poser = None
+        self.character_image = None
+
     def save(self, file_name: str):
+        from omegaconf import OmegaConf
+
         dir = os.path.dirname(file_name)
         rel_char_image_file_name = os.path.relpath(self.character_image_file_name, dir)
         rel_face_morpher_file_name = os.path.relpath(self.face_morpher_file_name, dir)
@@ -51,6 +87,10 @@ class CharacterModel:
             "face_morpher_file_name": rel_face_morpher_file_name,
             "body_morpher_file_name": rel_body_morpher_file_name,
         }
+        if self.coverage_mask_file_name is not None:
+            data["coverage_mask_file_name"] = os.path.relpath(self.coverage_mask_file_name, dir)
+        if self.sprite_atlas_file_name is not None:
+            data["sprite_atlas_file_name"] = os.path.relpath(self.sprite_atlas_file_name, dir)
         conf = OmegaConf.create(data)
         os.makedirs(dir, exist_ok=True)
         with open(file_name, "wt") as fout:
@@ -58,12 +98,24 @@ class CharacterModel:
 
     @staticmethod
     def load(file_name: str):
+        from omegaconf import OmegaConf
+
         conf = OmegaConf.to_container(OmegaConf.load(file_name))
         dir = os.path.dirname(file_name)
         character_image_file_name = os.path.join(dir, conf["character_image_file_name"])
         face_morpher_file_name = os.path.join(dir, conf["face_morpher_file_name"])
         body_morpher_file_name = os.path.join(dir, conf["body_morpher_file_name"])
+        if "coverage_mask_file_name" in conf:
+            coverage_mask_file_name = os.path.join(dir, conf["coverage_mask_file_name"])
+        else:
+            coverage_mask_file_name = None
+        if "sprite_atlas_file_name" in conf:
+            sprite_atlas_file_name = os.path.join(dir, conf["sprite_atlas_file_name"])
+        else:
+            sprite_atlas_file_name = None
         return CharacterModel(
             character_image_file_name,
             face_morpher_file_name,
-            body_morpher_file_name)
+            body_morpher_file_name,
+            coverage_mask_file_name,
+            sprite_atlas_file_name)
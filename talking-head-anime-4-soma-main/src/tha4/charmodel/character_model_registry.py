@@ -0,0 +1,289 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, List, Tuple, Iterator
+
+import torch
+from torch import Tensor
+from torch.nn import Module
+
+from tha4.charmodel.character_model import CharacterModel
+from tha4.poser.general_poser_02 import GeneralPoser02
+from tha4.poser.poser import Poser
+from tha4.poser.sprite_atlas import SpriteAtlasPoser
+
+
+def get_tensor_num_bytes(tensor: Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+def get_module_num_bytes(module: Module) -> int:
+    num_bytes = 0
+    seen = set()
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        num_bytes += get_tensor_num_bytes(tensor)
+    return num_bytes
+
+
+def get_poser_num_bytes(poser: Poser) -> int:
+    if isinstance(poser, GeneralPoser02):
+        return sum(get_module_num_bytes(module) for module in poser.get_modules().values())
+    elif isinstance(poser, SpriteAtlasPoser):
+        num_bytes = poser.atlas.get_num_bytes()
+        images = poser.get_images()
+        # On the CPU, torch.from_numpy shares the atlas's memory instead of copying it.
+        if images.device.type != 'cpu' or images.data_ptr() != poser.atlas.images.ctypes.data:
+            num_bytes += get_tensor_num_bytes(images)
+        return num_bytes
+    else:
+        return 0
+
+
+class ResidentCharacterModel:
+    def __init__(self, name: str, character_model: CharacterModel, poser: Poser, image: Tensor, load_time: float):
+        self.load_time = load_time
+        self.image = image
+        self.poser = poser
+        self.character_model = character_model
+        self.name = name
+        self.num_bytes = get_poser_num_bytes(poser) + get_tensor_num_bytes(image)
+
+
+class CharacterModelRegistryStats:
+    def __init__(self):
+        self.num_hits = 0
+        self.num_misses = 0
+        self.num_prefetches = 0
+        self.num_useful_prefetches = 0
+        self.num_evictions = 0
+        self.total_load_time = 0.0
+        self.num_loads = 0
+        self.max_load_time = 0.0
+        self.resident_bytes = 0
+        self.num_resident_models = 0
+
+    def get_hit_rate(self) -> float:
+        num_requests = self.num_hits + self.num_misses
+        if num_requests == 0:
+            return 0.0
+        return self.num_hits / num_requests
+
+    def get_mean_load_time(self) -> float:
+        if self.num_loads == 0:
+            return 0.0
+        return self.total_load_time / self.num_loads
+
+    def __str__(self):
+        return f"hit rate = {self.get_hit_rate():.3f} ({self.num_hits} hits, {self.num_misses} misses), " \
+               f"load time mean/max (ms) = {self.get_mean_load_time() * 1000:.1f}/{self.max_load_time * 1000:.1f}, " \
+               f"prefetches = {self.num_prefetches} ({self.num_useful_prefetches} used), " \
+               f"evictions = {self.num_evictions}, " \
+               f"resident = {self.num_resident_models} models, {self.resident_bytes / 2 ** 20:.1f} MiB"
+
+
+# Keeps the posers and character images of many character models under a memory budget. The least recently used
+# models are evicted first. After every request, the models that most often followed the requested one are loaded
+# in the background so that they are resident by the time they are asked for.
+#
+# acquire() leases a model until the matching release(), and lease() does both around a with block. Leased models and
+# the most recently acquired model are never evicted, so the budget can be exceeded while they alone use it up.
+class CharacterModelRegistry:
+    def __init__(self,
+                 device: torch.device,
+                 max_resident_bytes: int,
+                 num_prefetched_successors: int = 1,
+                 num_loader_threads: int = 1,
+                 use_sprite_atlas: bool = False):
+        assert max_resident_bytes > 0
+        assert num_prefetched_successors >= 0
+        assert num_loader_threads >= 1
+        self.use_sprite_atlas = use_sprite_atlas
+        self.num_loader_threads = num_loader_threads
+        self.num_prefetched_successors = num_prefetched_successors
+        self.max_resident_bytes = max_resident_bytes
+        self.device = device
+
+        # Reentrant because a load that is already done runs its completion callback in the thread adding it.
+        self.lock = threading.RLock()
+        self.file_names: Dict[str, str] = {}
+        self.resident_models: Dict[str, ResidentCharacterModel] = OrderedDict()
+        self.pending_loads: Dict[str, Future] = {}
+        self.prefetched_names = set()
+        self.successor_counts: Dict[str, Dict[str, int]] = {}
+        self.lease_counts: Dict[str, int] = {}
+        self.last_requested_name: Optional[str] = None
+        self.stats = CharacterModelRegistryStats()
+        self.executor = ThreadPoolExecutor(max_workers=num_loader_threads)
+
+    def register(self, name: str, character_model_file_name: str):
+        with self.lock:
+            self.file_names[name] = character_model_file_name
+
+    def get_names(self) -> List[str]:
+        with self.lock:
+            return list(self.file_names.keys())
+
+    def is_resident(self, name: str) -> bool:
+        with self.lock:
+            return name in self.resident_models
+
+    def load(self, name: str) -> ResidentCharacterModel:
+        start_time = time.perf_counter()
+        character_model = CharacterModel.load(self.file_names[name])
+        if self.use_sprite_atlas and character_model.sprite_atlas_file_name is not None:
+            poser = character_model.get_sprite_atlas_poser(self.device)
+            poser.get_images()
+        else:
+            poser = character_model.get_poser(self.device)
+            if isinstance(poser, GeneralPoser02):
+                poser.get_modules()
+        image = character_model.get_character_image(self.device).to(poser.get_dtype())
+        load_time = time.perf_counter() - start_time
+        return ResidentCharacterModel(name, character_model, poser, image, load_time)
+
+    def start_load(self, name: str) -> Tuple[Future, bool]:
+        # Must be called with the lock held. Returns the future of the load and whether this call started it.
+        future = self.pending_loads.get(name, None)
+        if future is not None:
+            return future, False
+        future = self.executor.submit(self.load, name)
+        self.pending_loads[name] = future
+        future.add_done_callback(lambda f: self.finish_load(name, f))
+        return future, True
+
+    def finish_load(self, name: str, future: Future):
+        with self.lock:
+            self.pending_loads.pop(name, None)
+            if future.exception() is not None:
+                self.prefetched_names.discard(name)
+                return
+            resident_model = future.result()
+            self.stats.num_loads += 1
+            self.stats.total_load_time += resident_model.load_time
+            self.stats.max_load_time = max(self.stats.max_load_time, resident_model.load_time)
+            self.resident_models[name] = resident_model
+            self.evict(keep_name=name)
+            self.update_resident_stats()
+
+    def can_evict(self, name: str) -> bool:
+        # Must be called with the lock held.
+        return self.lease_counts.get(name, 0) == 0 and name != self.last_requested_name
+
+    def evict(self, keep_name: Optional[str] = None):
+        # Must be called with the lock held.
+        resident_bytes = sum(model.num_bytes for model in self.resident_models.values())
+        for name in list(self.resident_models.keys()):
+            if resident_bytes <= self.max_resident_bytes:
+                break
+            if name == keep_name or not self.can_evict(name):
+                continue
+            resident_model = self.resident_models.pop(name)
+            resident_model.character_model.free()
+            resident_bytes -= resident_model.num_bytes
+            self.prefetched_names.discard(name)
+            self.stats.num_evictions += 1
+            logging.info(f"Evicted character model {name} ({resident_model.num_bytes / 2 ** 20:.1f} MiB)")
+
+    def update_resident_stats(self):
+        self.stats.resident_bytes = sum(model.num_bytes for model in self.resident_models.values())
+        self.stats.num_resident_models = len(self.resident_models)
+
+    def get_predicted_successors(self, name: str) -> List[str]:
+        # Must be called with the lock held.
+        counts = self.successor_counts.get(name, {})
+        successors = sorted(counts.keys(), key=lambda x: counts[x], reverse=True)
+        return successors[:self.num_prefetched_successors]
+
+    def record_request(self, name: str):
+        # Must be called with the lock held.
+        if self.last_requested_name is not None and self.last_requested_name != name:
+            counts = self.successor_counts.setdefault(self.last_requested_name, {})
+            counts[name] = counts.get(name, 0) + 1
+        self.last_requested_name = name
+
+    def prefetch(self, names: List[str]):
+        with self.lock:
+            self.prefetch_locked(names)
+
+    def prefetch_locked(self, names: List[str]):
+        for name in names:
+            if name not in self.file_names or name in self.resident_models or name in self.pending_loads:
+                continue
+            self.start_load(name)
+            self.prefetched_names.add(name)
+            self.stats.num_prefetches += 1
+
+    def acquire(self, name: str) -> Tuple[Poser, Tensor]:
+        with self.lock:
+            if name not in self.file_names:
+                raise RuntimeError(f"Character model {name} is not registered.")
+            self.record_request(name)
+            # Leased before the load finishes so that no other load can evict the model in the meantime.
+            self.lease_counts[name] = self.lease_counts.get(name, 0) + 1
+            resident_model = self.resident_models.get(name, None)
+            if resident_model is not None:
+                self.stats.num_hits += 1
+                self.resident_models.move_to_end(name)
+                future = None
+            else:
+                self.stats.num_misses += 1
+                future, _ = self.start_load(name)
+            if name in self.prefetched_names:
+                self.prefetched_names.discard(name)
+                self.stats.num_useful_prefetches += 1
+            self.prefetch_locked(self.get_predicted_successors(name))
+
+        if future is not None:
+            try:
+                resident_model = future.result()
+            except Exception:
+                self.release(name)
+                raise
+            with self.lock:
+                if name in self.resident_models:
+                    self.resident_models.move_to_end(name)
+        return resident_model.poser, resident_model.image
+
+    def release(self, name: str):
+        with self.lock:
+            lease_count = self.lease_counts.get(name, 0)
+            assert lease_count > 0, f"Character model {name} is not acquired."
+            if lease_count == 1:
+                del self.lease_counts[name]
+            else:
+                self.lease_counts[name] = lease_count - 1
+            self.evict()
+            self.update_resident_stats()
+
+    @contextmanager
+    def lease(self, name: str) -> Iterator[Tuple[Poser, Tensor]]:
+        poser, image = self.acquire(name)
+        try:
+            yield poser, image
+        finally:
+            self.release(name)
+
+    def get_statistics(self) -> CharacterModelRegistryStats:
+        with self.lock:
+            self.update_resident_stats()
+            stats = CharacterModelRegistryStats()
+            stats.__dict__.update(self.stats.__dict__)
+            return stats
+
+    def log_statistics(self):
+        logging.info(f"Character model registry: {self.get_statistics()}")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            for resident_model in self.resident_models.values():
+                resident_model.character_model.free()
+            self.resident_models.clear()
+            self.prefetched_names.clear()
+            self.update_resident_stats()
@@ -0,0 +1,80 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+HEADLESS_MODULES = [
+    "tha4.shion.base.image_util",
+    "tha4.image_util",
+    "tha4.charmodel.character_model",
+    "tha4.poser.modes.mode_14",
+    "tha4.mocap.pose_converter_core",
+    "tha4.mocap.pose_recording",
+    "tha4.mocap.pose_filter",
+    "tha4.mocap.ifacialmocap_pose_converter_25",
+    "tha4.mocap.mediapipe_face_pose_converter_00",
+]
+
+FORBIDDEN_MODULES = [
+    "wx",
+    "matplotlib",
+    "scipy",
+    "omegaconf",
+]
+
+# The result is printed as one JSON line after the import, so anything the module prints while importing comes
+# before it.
+MEASUREMENT_SCRIPT = """
+import json
+import sys
+import time
+start_time = time.perf_counter()
+import {module_name}
+elapsed_time = time.perf_counter() - start_time
+print(json.dumps({{
+    "elapsed_time": elapsed_time,
+    "loaded_forbidden_modules": [name for name in {forbidden_modules!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure_import(module_name: str) -> Tuple[float, List[str]]:
+    script = MEASUREMENT_SCRIPT.format(module_name=module_name, forbidden_modules=FORBIDDEN_MODULES)
+    env = {**os.environ}
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = src_dir + os.pathsep + env.get("PYTHONPATH", "")
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not import {module_name}:\n{result.stderr}")
+    measurement = json.loads(result.stdout.splitlines()[-1])
+    return measurement["elapsed_time"], measurement["loaded_forbidden_modules"]
+
+
+def check_headless_imports(module_names: List[str], max_seconds: float) -> bool:
+    ok = True
+    for module_name in module_names:
+        elapsed_time, loaded_forbidden_modules = measure_import(module_name)
+        status = "ok"
+        if len(loaded_forbidden_modules) > 0:
+            status = "FAIL (pulled in %s)" % ", ".join(loaded_forbidden_modules)
+            ok = False
+        elif elapsed_time > max_seconds:
+            status = "FAIL (slower than %.2f s)" % max_seconds
+            ok = False
+        print("%-48s %8.3f s  %s" % (module_name, elapsed_time, status))
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Check that headless tha4 modules import without GUI and plotting stacks.')
+    parser.add_argument('--max_seconds', type=float, default=5.0,
+                        help='The maximum time, in seconds, a single module may take to import.')
+    parser.add_argument('modules', type=str, nargs='*', default=HEADLESS_MODULES,
+                        help='The modules to check. Defaults to the headless posing and conversion modules.')
+    args = parser.parse_args()
+
+    if not check_headless_imports(args.modules, args.max_seconds):
+        sys.exit(1)
@@ -0,0 +1,135 @@
+import logging
+import os
+from typing import Optional, Callable, Iterator
+
+import torch
+import torch.distributed
+from torch import Tensor
+from torch.utils.data import Sampler
+
+from tha4.shion.core.cached_computation import ComputationState, TensorCachedComputationFunc
+from tha4.shion.core.load_save import torch_save
+
+
+class AdaptivePoseSampler(Sampler):
+    def __init__(self,
+                 num_poses: int,
+                 random_seed: int,
+                 num_replicas: Optional[int] = None,
+                 rank: Optional[int] = None,
+                 uniform_fraction: float = 0.5,
+                 error_decay: float = 0.9,
+                 max_weight_ratio: float = 10.0,
+                 refresh_interval: int = 4096,
+                 record_dir: Optional[str] = None):
+        super().__init__(None)
+        assert num_poses >= 1
+        assert 0.0 < uniform_fraction <= 1.0
+        assert max_weight_ratio >= 1.0
+        assert refresh_interval >= 1
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+
+        self.record_dir = record_dir
+        self.refresh_interval = refresh_interval
+        self.max_weight_ratio = max_weight_ratio
+        self.error_decay = error_decay
+        self.uniform_fraction = uniform_fraction
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.random_seed = random_seed
+        self.num_poses = num_poses
+
+        self.num_samples = num_poses // num_replicas
+        self.epoch = 0
+        self.errors = torch.zeros(num_poses)
+        self.seen = torch.zeros(num_poses, dtype=torch.bool)
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def get_weights(self) -> Tensor:
+        uniform = torch.full([self.num_poses], 1.0 / self.num_poses)
+        if not self.seen.any():
+            return uniform
+        errors = torch.where(self.seen, self.errors, self.errors[self.seen].mean())
+        total = errors.sum()
+        if total.item() <= 0:
+            return uniform
+        weights = self.uniform_fraction * uniform + (1 - self.uniform_fraction) * errors / total
+        weights = weights.clamp(max=self.max_weight_ratio / self.num_poses)
+        return weights / weights.sum()
+
+    def get_record_file_name(self, epoch: int, chunk_index: int) -> str:
+        return "%s/rank_%02d/epoch_%06d_chunk_%06d.pt" % (self.record_dir, self.rank, epoch, chunk_index)
+
+    def record_weights(self, epoch: int, chunk_index: int, weights: Tensor):
+        if self.record_dir is None:
+            return
+        file_name = self.get_record_file_name(epoch, chunk_index)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        torch_save({
+            'random_seed': self.random_seed,
+            'rank': self.rank,
+            'epoch': epoch,
+            'chunk_index': chunk_index,
+            'weights': weights,
+        }, file_name)
+
+    def __iter__(self) -> Iterator[int]:
+        epoch = self.epoch
+        self.log_statistics()
+        generator = torch.Generator()
+        generator.manual_seed(self.random_seed + self.num_replicas * epoch + self.rank)
+        num_chunks = (self.num_samples + self.refresh_interval - 1) // self.refresh_interval
+        for chunk_index in range(num_chunks):
+            chunk_size = min(self.refresh_interval, self.num_samples - chunk_index * self.refresh_interval)
+            weights = self.get_weights()
+            self.record_weights(epoch, chunk_index, weights)
+            indices = torch.multinomial(weights, chunk_size, replacement=True, generator=generator)
+            for index in indices.tolist():
+                yield index
+
+    def update(self, pose_indices: Tensor, errors: Tensor):
+        pose_indices = pose_indices.detach().to('cpu').long().reshape(-1)
+        errors = errors.detach().to('cpu').float().reshape(-1)
+        sums = torch.zeros(self.num_poses).index_add_(0, pose_indices, errors)
+        counts = torch.zeros(self.num_poses).index_add_(0, pose_indices, torch.ones_like(errors))
+        touched = counts > 0
+        new_errors = sums[touched] / counts[touched]
+        old_errors = torch.where(self.seen[touched], self.errors[touched], new_errors)
+        self.errors[touched] = self.error_decay * old_errors + (1 - self.error_decay) * new_errors
+        self.seen[touched] = True
+
+    def log_statistics(self):
+        weights = self.get_weights()
+        logging.info(
+            f"Adaptive pose sampler (rank {self.rank}): "
+            f"{int(self.seen.sum().item())}/{self.num_poses} poses seen, "
+            f"max weight ratio = {weights.max().item() * self.num_poses:.2f}")
+
+
+class AdaptivePoseSamplerErrorFeedback:
+    def __init__(self,
+                 sampler_func: Callable[[], Optional[AdaptivePoseSampler]],
+                 pose_index_func: TensorCachedComputationFunc,
+                 expected_func: TensorCachedComputationFunc,
+                 actual_func: TensorCachedComputationFunc):
+        self.actual_func = actual_func
+        self.expected_func = expected_func
+        self.pose_index_func = pose_index_func
+        self.sampler_func = sampler_func
+
+    def __call__(self, state: ComputationState):
+        sampler = self.sampler_func()
+        if sampler is None:
+            return
+        with torch.no_grad():
+            diff = (self.expected_func(state) - self.actual_func(state)).abs()
+            errors = diff.reshape(diff.shape[0], -1).mean(dim=1)
+            sampler.update(self.pose_index_func(state), errors)
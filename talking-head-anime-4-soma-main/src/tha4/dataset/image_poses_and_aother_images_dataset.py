@@ -1,5 +1,6 @@
 from typing import List, Callable
 
+import torch
 from torch import Tensor
 from torch.utils.data import Dataset
 
@@ -8,7 +9,9 @@ class ImagePosesAndOtherImagesDataset(Dataset):
     def __init__(self,
                  main_image_func: Callable[[], Tensor],
                  pose_dataset: Dataset,
-                 other_image_funcs: List[Callable[[], Tensor]]):
+                 other_image_funcs: List[Callable[[], Tensor]],
+                 return_pose_index: bool = False):
+        self.return_pose_index = return_pose_index
         self.main_image_func = main_image_func
         self.other_image_funcs = other_image_funcs
         self.pose_dataset = pose_dataset
@@ -32,4 +35,53 @@ class ImagePosesAndOtherImagesDataset(Dataset):
         main_image = self.get_main_image()
         pose = self.pose_dataset[index][0]
         other_images = [self.get_other_image(i) for i in range(len(self.other_image_funcs))]
-        return [main_image, pose] + other_images
+        if self.return_pose_index:
+            return [main_image, pose] + other_images + [torch.tensor(index, dtype=torch.long)]
+        else:
+            return [main_image, pose] + other_images
+
+
+class PosesWithBroadcastImagesDataset(Dataset):
+    def __init__(self,
+                 main_image_func: Callable[[], Tensor],
+                 pose_dataset: Dataset,
+                 other_image_funcs: List[Callable[[], Tensor]],
+                 expand_to_batch_size: bool = False,
+                 return_pose_index: bool = False):
+        self.return_pose_index = return_pose_index
+        self.expand_to_batch_size = expand_to_batch_size
+        self.main_image_func = main_image_func
+        self.other_image_funcs = other_image_funcs
+        self.pose_dataset = pose_dataset
+        self.device_images = None
+        self.device = None
+
+    def __len__(self):
+        return len(self.pose_dataset)
+
+    def __getitem__(self, index):
+        if self.return_pose_index:
+            return [self.pose_dataset[index][0], torch.tensor(index, dtype=torch.long)]
+        else:
+            return [self.pose_dataset[index][0]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['device_images'] = None
+        state['device'] = None
+        return state
+
+    def get_device_images(self, device: torch.device) -> List[Tensor]:
+        if self.device_images is None or self.device != device:
+            images = [self.main_image_func()] + [func() for func in self.other_image_funcs]
+            self.device_images = [image.to(device).unsqueeze(0) for image in images]
+            self.device = device
+        return self.device_images
+
+    def attach_constant_images(self, batch: List[Tensor], device: torch.device) -> List[Tensor]:
+        pose = batch[0]
+        images = self.get_device_images(device)
+        if self.expand_to_batch_size:
+            n = pose.shape[0]
+            images = [image.expand(n, *image.shape[1:]) for image in images]
+        return [images[0], pose] + images[1:] + batch[1:]
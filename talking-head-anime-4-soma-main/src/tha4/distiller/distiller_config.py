@@ -2,11 +2,13 @@ import os.path
 import shutil
 import PIL.Image
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, List
 
 from omegaconf import OmegaConf
 from tha4.charmodel.character_model import CharacterModel
 from tha4.pytasuku.workspace import Workspace, file_task
+from tha4.shion.core.training.distrib.distributed_trainer import DistributedTrainer
+from tha4.shion.core.training.distrib.distributed_training_states import DistributedTrainingState
 from tha4.distiller.config_based_training_tasks import define_standalone_config_based_training_tasks
 from tha4.nn.siren.face_morpher.siren_face_morpher_00_trainer import SirenFaceMorpher00TrainerArgs
 from tha4.nn.siren.morpher.siren_morpher_03_trainer import SirenMorpher03TrainerArgs, TrainingPhases, TrainingPhase, \
@@ -21,6 +23,12 @@ def copy_file(source_file_name: str, dest_file_name):
     shutil.copyfile(source_file_name, dest_file_name)
 
 
+# The trainer prepends checkpoint 0 to its schedule, so the last checkpoint index equals the number of checkpoints.
+# Computing it from the trainer arguments avoids building a whole trainer just to name a file.
+def get_final_checkpoint_prefix(prefix: str, trainer_args) -> str:
+    return DistributedTrainer.checkpoint_prefix(prefix, trainer_args.get_num_checkpoints())
+
+
 @dataclass
 class DistillerConfig:
     prefix: str
@@ -31,15 +39,27 @@ class DistillerConfig:
     face_morpher_random_seed_1: int = 14367217090963479175
     face_morpher_num_training_examples_per_sample_output: Optional[int] = 10_000
     face_morpher_batch_size: int = 8
+    face_morpher_num_pixel_samples: Optional[int] = None
 
     body_morpher_random_seed_0: int = 2892221210020292507
     body_morpher_random_seed_1: int = 9998918537095922080
     body_morpher_num_training_examples_per_sample_output: Optional[int] = 10_000
     body_morpher_batch_size: int = 8
+    body_morpher_num_pixel_samples: Optional[int] = None
 
     num_cpu_workers: int = 1
     num_gpus: int = 1
 
+    adaptive_pose_sampling: bool = False
+
+    num_online_teacher_workers: int = 0
+    online_teacher_device: Optional[str] = None
+    online_teacher_batch_size: int = 32
+    online_teacher_num_slots: int = 4
+
+    warm_start_character_model_file_name: Optional[str] = None
+    warm_start_early_stopping_patience: Optional[int] = 2
+
     def check(self):
         DistillerConfig.check_prefix(self.prefix)
         DistillerConfig.check_character_image_file_name(self.character_image_file_name)
@@ -47,10 +67,20 @@ class DistillerConfig:
 
         DistillerConfig.check_num_cpu_workers(self.num_cpu_workers)
         DistillerConfig.check_num_gpus(self.num_gpus)
+        DistillerConfig.check_num_online_teacher_workers(self.num_online_teacher_workers)
+        DistillerConfig.check_online_teacher_batch_size(
+            self.online_teacher_batch_size, [self.face_morpher_batch_size, self.body_morpher_batch_size])
+        DistillerConfig.check_online_teacher_num_slots(self.online_teacher_num_slots)
+        assert not (self.adaptive_pose_sampling and self.num_online_teacher_workers > 0), \
+            "The 'adaptive_pose_sampling' option cannot be used together with online teacher workers."
+        DistillerConfig.check_warm_start_character_model_file_name(self.warm_start_character_model_file_name)
+        DistillerConfig.check_warm_start_early_stopping_patience(self.warm_start_early_stopping_patience)
 
         DistillerConfig.check_random_seed(self.face_morpher_random_seed_0, "face_morpher_random_seed_0")
         DistillerConfig.check_random_seed(self.face_morpher_random_seed_1, "face_morpher_random_seed_1")
         DistillerConfig.check_batch_size(self.face_morpher_batch_size, "face_morpher_batch_size")
+        DistillerConfig.check_num_pixel_samples(
+            self.face_morpher_num_pixel_samples, 128 * 128, "face_morpher_num_pixel_samples")
         DistillerConfig.check_num_training_examples_per_sample_output(
             self.face_morpher_num_training_examples_per_sample_output,
             "face_morpher_num_training_examples_per_sample_output")
@@ -58,6 +88,8 @@ class DistillerConfig:
         DistillerConfig.check_random_seed(self.body_morpher_random_seed_0, "body_morpher_random_seed_0")
         DistillerConfig.check_random_seed(self.body_morpher_random_seed_1, "body_morpher_random_seed_1")
         DistillerConfig.check_batch_size(self.body_morpher_batch_size, "body_morpher_batch_size")
+        DistillerConfig.check_num_pixel_samples(
+            self.body_morpher_num_pixel_samples, 512 * 512, "body_morpher_num_pixel_samples")
         DistillerConfig.check_num_training_examples_per_sample_output(
             self.body_morpher_num_training_examples_per_sample_output,
             "body_morpher_num_training_examples_per_sample_output")
@@ -103,6 +135,14 @@ class DistillerConfig:
         assert value >= 1, f"The {field_name} must be at least 1."
         assert value <= 8, f"The {field_name} must be at most 8."
 
+    @staticmethod
+    def check_num_pixel_samples(value, num_pixels: int, field_name: str):
+        if value is None:
+            return
+        assert isinstance(value, int), f"The {field_name} must be an integer or None."
+        assert value >= 1, f"The {field_name} must be at least 1."
+        assert value <= num_pixels, f"The {field_name} must be at most {num_pixels}."
+
     @staticmethod
     def check_num_cpu_workers(value):
         assert value >= 1, "The value of 'num_cpu_workers must be at least 1."
@@ -111,6 +151,45 @@ class DistillerConfig:
     def check_num_gpus(value):
         assert value >= 1, "The value of 'num_gpus' must be at least 1."
 
+    @staticmethod
+    def check_num_online_teacher_workers(value):
+        assert isinstance(value, int), "The value of 'num_online_teacher_workers' must be an integer."
+        assert value >= 0, "The value of 'num_online_teacher_workers' must be at least 0."
+
+    @staticmethod
+    def check_online_teacher_batch_size(value, batch_sizes: List[int]):
+        assert isinstance(value, int), "The value of 'online_teacher_batch_size' must be an integer."
+        assert value >= 1, "The value of 'online_teacher_batch_size' must be at least 1."
+        for batch_size in batch_sizes:
+            assert value % batch_size == 0, \
+                f"The value of 'online_teacher_batch_size' must be a multiple of the batch size {batch_size}."
+
+    @staticmethod
+    def check_online_teacher_num_slots(value):
+        assert isinstance(value, int), "The value of 'online_teacher_num_slots' must be an integer."
+        assert value >= 1, "The value of 'online_teacher_num_slots' must be at least 1."
+
+    @staticmethod
+    def check_warm_start_character_model_file_name(file_name):
+        if file_name is None:
+            return
+        assert os.path.isfile(file_name), \
+            f"The specified warm start character model file name, {file_name}, does not point to a file."
+        character_model = CharacterModel.load(file_name)
+        assert os.path.isfile(character_model.face_morpher_file_name), \
+            f"The face morpher of the warm start character model, " \
+            f"{character_model.face_morpher_file_name}, does not exist."
+        assert os.path.isfile(character_model.body_morpher_file_name), \
+            f"The body morpher of the warm start character model, " \
+            f"{character_model.body_morpher_file_name}, does not exist."
+
+    @staticmethod
+    def check_warm_start_early_stopping_patience(value):
+        if value is None:
+            return
+        assert isinstance(value, int), "The value of 'warm_start_early_stopping_patience' must be an integer or None."
+        assert value >= 1, "The value of 'warm_start_early_stopping_patience' must be at least 1."
+
     @staticmethod
     def check_random_seed(value, field_name: str):
         assert isinstance(value, int), f"The {field_name} must be an integer."
@@ -142,13 +221,52 @@ class DistillerConfig:
         args.check()
         return args
 
+    def get_online_teacher_devices(self) -> Optional[List[str]]:
+        if self.num_online_teacher_workers == 0:
+            return None
+        if self.online_teacher_device is None:
+            device = 'cuda'
+        else:
+            device = self.online_teacher_device
+        return [device for i in range(self.num_online_teacher_workers)]
+
+    def is_warm_start(self) -> bool:
+        return self.warm_start_character_model_file_name is not None
+
+    def get_warm_start_character_model(self) -> Optional[CharacterModel]:
+        if not self.is_warm_start():
+            return None
+        return CharacterModel.load(self.warm_start_character_model_file_name)
+
+    def get_early_stopping_patience(self) -> Optional[int]:
+        if not self.is_warm_start():
+            return None
+        return self.warm_start_early_stopping_patience
+
     def face_morpher_prefix(self):
         return f"{self.prefix}/face_morpher"
 
     def get_face_morpher_trainer(self, world_size: Optional[int] = None, backend: str = 'gloo'):
         if world_size is None:
             world_size = self.num_gpus
-        args = SirenFaceMorpher00TrainerArgs(
+        args = self.get_face_morpher_trainer_args()
+        return args.create_trainer(self.face_morpher_prefix(), world_size, backend)
+
+    def face_morpher_final_checkpoint_prefix(self):
+        return get_final_checkpoint_prefix(self.face_morpher_prefix(), self.get_face_morpher_trainer_args())
+
+    def get_face_morpher_trainer_args(self) -> SirenFaceMorpher00TrainerArgs:
+        warm_start_character_model = self.get_warm_start_character_model()
+        if warm_start_character_model is not None:
+            schedule = {
+                'num_training_total_examples': 300_000,
+                'num_training_examples_lr_boundaries': [100_000, 200_000, 250_000],
+                'base_learning_rate': 3e-5,
+                'pretrained_module_file_name': warm_start_character_model.face_morpher_file_name,
+            }
+        else:
+            schedule = {}
+        return SirenFaceMorpher00TrainerArgs(
             character_file_name=self.character_image_file_name,
             face_mask_file_name=self.face_mask_image_file_name,
             pose_dataset_file_name=POSE_DATASET_FILE_NAME,
@@ -156,8 +274,16 @@ class DistillerConfig:
             num_training_examples_per_sample_output=self.face_morpher_num_training_examples_per_sample_output,
             total_batch_size=self.face_morpher_batch_size,
             training_random_seed=self.face_morpher_random_seed_0,
-            sample_output_random_seed=self.face_morpher_random_seed_1)
-        return args.create_trainer(self.face_morpher_prefix(), world_size, backend)
+            sample_output_random_seed=self.face_morpher_random_seed_1,
+            num_pixel_samples=self.face_morpher_num_pixel_samples,
+            adaptive_pose_sampling=self.adaptive_pose_sampling,
+            broadcast_constant_images=True,
+            online_teacher_devices=self.get_online_teacher_devices(),
+            online_teacher_batch_size=self.online_teacher_batch_size,
+            online_teacher_num_slots=self.online_teacher_num_slots,
+            early_stopping_patience=self.get_early_stopping_patience(),
+            early_stopping_window_size=5,
+            **schedule)
 
     def body_morpher_prefix(self):
         return f"{self.prefix}/body_morpher"
@@ -165,7 +291,21 @@ class DistillerConfig:
     def get_body_morpher_trainer(self, world_size: Optional[int] = None, backend: str = 'gloo'):
         if world_size is None:
             world_size = self.num_gpus
-        args = SirenMorpher03TrainerArgs(
+        args = self.get_body_morpher_trainer_args()
+        return args.create_trainer(self.body_morpher_prefix(), world_size, backend)
+
+    def body_morpher_final_checkpoint_prefix(self):
+        return get_final_checkpoint_prefix(self.body_morpher_prefix(), self.get_body_morpher_trainer_args())
+
+    def get_body_morpher_trainer_args(self) -> SirenMorpher03TrainerArgs:
+        warm_start_character_model = self.get_warm_start_character_model()
+        if warm_start_character_model is not None:
+            training_phases = DistillerConfig.get_warm_start_body_morpher_training_phases()
+            pretrained_module_file_name = warm_start_character_model.body_morpher_file_name
+        else:
+            training_phases = DistillerConfig.get_cold_start_body_morpher_training_phases()
+            pretrained_module_file_name = None
+        return SirenMorpher03TrainerArgs(
             character_file_name=self.character_image_file_name,
             pose_dataset_file_name=POSE_DATASET_FILE_NAME,
             total_worker=self.num_cpu_workers,
@@ -173,64 +313,107 @@ class DistillerConfig:
             training_random_seed=self.body_morpher_random_seed_0,
             sample_output_random_seed=self.body_morpher_random_seed_1,
             total_batch_size=self.body_morpher_batch_size,
-            sample_output_batch_size=1,
-            training_phases=TrainingPhases([
-                TrainingPhase(
-                    num_examples_upper_bound=200_000,
-                    learning_rate=1e-4,
-                    loss_weights=LossWeights(weights={
-                        LossTerm.full_blended: 0.25,
-                        LossTerm.full_warped: 0.25,
-                        LossTerm.full_grid_change: 0.5,
-                        LossTerm.full_color_change: 2.0,
-                    })),
-                TrainingPhase(
-                    num_examples_upper_bound=400_000,
-                    learning_rate=3e-5,
-                    loss_weights=LossWeights(weights={
-                        LossTerm.full_blended: 0.25,
-                        LossTerm.full_warped: 0.25,
-                        LossTerm.full_grid_change: 0.5,
-                        LossTerm.full_color_change: 2.0,
-                    })),
-                TrainingPhase(
-                    num_examples_upper_bound=600_000,
-                    learning_rate=3e-5,
-                    loss_weights=LossWeights(weights={
-                        LossTerm.full_blended: 1.0,
-                        LossTerm.full_warped: 2.5,
-                        LossTerm.full_grid_change: 5.0,
-                        LossTerm.full_color_change: 1.0,
-                    })),
-                TrainingPhase(
-                    num_examples_upper_bound=800_000,
-                    learning_rate=1e-5,
-                    loss_weights=LossWeights(weights={
-                        LossTerm.full_blended: 1.0,
-                        LossTerm.full_warped: 2.5,
-                        LossTerm.full_grid_change: 5.0,
-                        LossTerm.full_color_change: 1.0,
-                    })),
-                TrainingPhase(
-                    num_examples_upper_bound=1_300_000,
-                    learning_rate=1e-5,
-                    loss_weights=LossWeights(weights={
-                        LossTerm.full_blended: 10.0,
-                        LossTerm.full_warped: 1.0,
-                        LossTerm.full_grid_change: 1.0,
-                        LossTerm.full_color_change: 1.0,
-                    })),
-                TrainingPhase(
-                    num_examples_upper_bound=1_500_000,
-                    learning_rate=3e-6,
-                    loss_weights=LossWeights(weights={
-                        LossTerm.full_blended: 10.0,
-                        LossTerm.full_warped: 1.0,
-                        LossTerm.full_grid_change: 1.0,
-                        LossTerm.full_color_change: 1.0,
-                    })),
-            ]))
-        return args.create_trainer(self.body_morpher_prefix(), world_size, backend)
+            num_pixel_samples=self.body_morpher_num_pixel_samples,
+            adaptive_pose_sampling=self.adaptive_pose_sampling,
+            broadcast_constant_images=True,
+            online_teacher_devices=self.get_online_teacher_devices(),
+            online_teacher_batch_size=self.online_teacher_batch_size,
+            online_teacher_num_slots=self.online_teacher_num_slots,
+            early_stopping_patience=self.get_early_stopping_patience(),
+            early_stopping_window_size=5,
+            pretrained_module_file_name=pretrained_module_file_name,
+            training_phases=training_phases)
+
+    @staticmethod
+    def get_cold_start_body_morpher_training_phases() -> TrainingPhases:
+        return TrainingPhases([
+            TrainingPhase(
+                num_examples_upper_bound=200_000,
+                learning_rate=1e-4,
+                loss_weights=LossWeights(weights={
+                    LossTerm.full_blended: 0.25,
+                    LossTerm.full_warped: 0.25,
+                    LossTerm.full_grid_change: 0.5,
+                    LossTerm.full_color_change: 2.0,
+                })),
+            TrainingPhase(
+                num_examples_upper_bound=400_000,
+                learning_rate=3e-5,
+                loss_weights=LossWeights(weights={
+                    LossTerm.full_blended: 0.25,
+                    LossTerm.full_warped: 0.25,
+                    LossTerm.full_grid_change: 0.5,
+                    LossTerm.full_color_change: 2.0,
+                })),
+            TrainingPhase(
+                num_examples_upper_bound=600_000,
+                learning_rate=3e-5,
+                loss_weights=LossWeights(weights={
+                    LossTerm.full_blended: 1.0,
+                    LossTerm.full_warped: 2.5,
+                    LossTerm.full_grid_change: 5.0,
+                    LossTerm.full_color_change: 1.0,
+                })),
+            TrainingPhase(
+                num_examples_upper_bound=800_000,
+                learning_rate=1e-5,
+                loss_weights=LossWeights(weights={
+                    LossTerm.full_blended: 1.0,
+                    LossTerm.full_warped: 2.5,
+                    LossTerm.full_grid_change: 5.0,
+                    LossTerm.full_color_change: 1.0,
+                })),
+            TrainingPhase(
+                num_examples_upper_bound=1_300_000,
+                learning_rate=1e-5,
+                loss_weights=LossWeights(weights={
+                    LossTerm.full_blended: 10.0,
+                    LossTerm.full_warped: 1.0,
+                    LossTerm.full_grid_change: 1.0,
+                    LossTerm.full_color_change: 1.0,
+                })),
+            TrainingPhase(
+                num_examples_upper_bound=1_500_000,
+                learning_rate=3e-6,
+                loss_weights=LossWeights(weights={
+                    LossTerm.full_blended: 10.0,
+                    LossTerm.full_warped: 1.0,
+                    LossTerm.full_grid_change: 1.0,
+                    LossTerm.full_color_change: 1.0,
+                })),
+        ])
+
+    @staticmethod
+    def get_warm_start_body_morpher_training_phases() -> TrainingPhases:
+        return TrainingPhases([
+            TrainingPhase(
+                num_examples_upper_bound=100_000,
+                learning_rate=3e-5,
+                loss_weights=LossWeights(weights={
+                    LossTerm.full_blended: 10.0,
+                    LossTerm.full_warped: 1.0,
+                    LossTerm.full_grid_change: 1.0,
+                    LossTerm.full_color_change: 1.0,
+                })),
+            TrainingPhase(
+                num_examples_upper_bound=200_000,
+                learning_rate=1e-5,
+                loss_weights=LossWeights(weights={
+                    LossTerm.full_blended: 10.0,
+                    LossTerm.full_warped: 1.0,
+                    LossTerm.full_grid_change: 1.0,
+                    LossTerm.full_color_change: 1.0,
+                })),
+            TrainingPhase(
+                num_examples_upper_bound=300_000,
+                learning_rate=3e-6,
+                loss_weights=LossWeights(weights={
+                    LossTerm.full_blended: 10.0,
+                    LossTerm.full_warped: 1.0,
+                    LossTerm.full_grid_change: 1.0,
+                    LossTerm.full_color_change: 1.0,
+                })),
+        ])
 
     def character_model_prefix(self):
         return f"{self.prefix}/character_model"
@@ -270,25 +453,22 @@ class DistillerConfig:
                 self.config_yaml_file_name(),
             ])
 
+        face_morpher_file_name = DistributedTrainingState.get_module_file_name(
+            self.face_morpher_final_checkpoint_prefix(), "module")
+        body_morpher_file_name = DistributedTrainingState.get_module_file_name(
+            self.body_morpher_final_checkpoint_prefix(), "module")
+
         @file_task(workspace, self.character_model_character_png_file_name(), [self.character_image_file_name])
         def copy_character_image_file_name():
             copy_file(self.character_image_file_name, self.character_model_character_png_file_name())
 
-        @file_task(workspace, self.character_model_face_morpher_file_name(), [
-            f"{self.face_morpher_prefix()}/checkpoint/0010/module_module.pt",
-        ])
+        @file_task(workspace, self.character_model_face_morpher_file_name(), [face_morpher_file_name])
         def copy_face_morpher():
-            copy_file(
-                f"{self.face_morpher_prefix()}/checkpoint/0010/module_module.pt",
-                self.character_model_face_morpher_file_name())
+            copy_file(face_morpher_file_name, self.character_model_face_morpher_file_name())
 
-        @file_task(workspace, self.character_model_body_morpher_file_name(), [
-            f"{self.body_morpher_prefix()}/checkpoint/0015/module_module.pt",
-        ])
+        @file_task(workspace, self.character_model_body_morpher_file_name(), [body_morpher_file_name])
         def copy_face_morpher():
-            copy_file(
-                f"{self.body_morpher_prefix()}/checkpoint/0015/module_module.pt",
-                self.character_model_body_morpher_file_name())
+            copy_file(body_morpher_file_name, self.character_model_body_morpher_file_name())
 
         @file_task(workspace, self.character_model_yaml_file_name(), [])
         def create_character_model_yaml_file():
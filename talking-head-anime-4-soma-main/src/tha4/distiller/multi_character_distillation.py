@@ -0,0 +1,284 @@
+import os
+from typing import List, Callable, Dict, Optional, Any, Union
+
+import torch
+from torch import Tensor
+from torch.nn import Module
+from torch.optim import Optimizer
+from torch.utils.data import Dataset
+
+from tha4.distiller.online_teacher_service import load_pose_tensor
+from tha4.shion.core.cached_computation import ComputationState
+from tha4.shion.core.loss import Loss
+from tha4.shion.core.optimizer_factory import OptimizerFactory
+from tha4.shion.core.training.distrib.distributed_trainer import DistributedTrainer
+from tha4.shion.core.training.sample_output_protocol import SampleOutputProtocol
+from tha4.shion.core.training.training_protocol import AbstractTrainingProtocol, TrainingProtocol
+from tha4.nn.siren.face_morpher.siren_face_morpher_00_trainer import SirenFaceMorpher00TrainerArgs
+from tha4.nn.siren.morpher.siren_morpher_03_trainer import SirenMorpher03TrainerArgs
+from tha4.nn.siren.morpher.siren_morpher_protocols_03 import KEY_MODULE, KEY_POSER, KEY_EXAMPLES_SEEN_SO_FAR
+from tha4.poser.general_poser_02 import GeneralPoser02
+
+
+def get_character_module_key(character_index: int) -> str:
+    return f"{KEY_MODULE}_{character_index}"
+
+
+def get_character_modules(modules: Dict[str, Module], module_key: str, key_module: str = KEY_MODULE):
+    output = {**modules}
+    if module_key in modules:
+        output[key_module] = modules[module_key]
+    return output
+
+
+class MultiCharacterLearningRateFunc:
+    def __init__(self, protocols: List[TrainingProtocol], module_keys: List[str], key_module: str = KEY_MODULE):
+        assert len(protocols) == len(module_keys)
+        self.key_module = key_module
+        self.module_keys = module_keys
+        self.protocols = protocols
+
+    def __call__(self, examples_seen_so_far: int) -> Dict[str, float]:
+        output = {}
+        for protocol, module_key in zip(self.protocols, self.module_keys):
+            output[module_key] = protocol.get_learning_rate(examples_seen_so_far)[self.key_module]
+        return output
+
+
+class MultiCharacterSirenTrainingProtocol(AbstractTrainingProtocol):
+    def __init__(self,
+                 check_point_examples: List[int],
+                 batch_size: int,
+                 learning_rate: Callable[[int], Dict[str, float]],
+                 optimizer_factories: Dict[str, OptimizerFactory],
+                 random_seed: int,
+                 poser_func: Callable[[], GeneralPoser02],
+                 module_keys: List[str],
+                 character_batch_funcs: List[Callable[[List[Tensor], torch.device], List[Tensor]]],
+                 iteration_callbacks: Optional[List[List[Callable[[ComputationState], None]]]] = None,
+                 max_teacher_batch_size: Optional[int] = None,
+                 batch_image_index: int = 0,
+                 batch_pose_index: int = 1,
+                 key_module: str = KEY_MODULE,
+                 key_poser: str = KEY_POSER,
+                 key_poser_output: str = "poser_output",
+                 key_examples_seen_so_far: str = KEY_EXAMPLES_SEEN_SO_FAR):
+        super().__init__(check_point_examples, batch_size, learning_rate, optimizer_factories, random_seed)
+        assert len(module_keys) == len(character_batch_funcs)
+        if iteration_callbacks is None:
+            iteration_callbacks = [[] for i in range(len(module_keys))]
+        assert len(iteration_callbacks) == len(module_keys)
+        self.key_examples_seen_so_far = key_examples_seen_so_far
+        self.key_poser_output = key_poser_output
+        self.key_poser = key_poser
+        self.key_module = key_module
+        self.batch_pose_index = batch_pose_index
+        self.batch_image_index = batch_image_index
+        self.max_teacher_batch_size = max_teacher_batch_size
+        self.iteration_callbacks = iteration_callbacks
+        self.character_batch_funcs = character_batch_funcs
+        self.module_keys = module_keys
+        self.poser_func = poser_func
+        self.poser = None
+
+    def get_teacher_outputs(self, image: Tensor, pose: Tensor) -> List[Tensor]:
+        n = pose.shape[0]
+        if self.max_teacher_batch_size is None or n <= self.max_teacher_batch_size:
+            return self.poser.get_posing_outputs(image, pose)
+        chunks = []
+        for start in range(0, n, self.max_teacher_batch_size):
+            end = min(n, start + self.max_teacher_batch_size)
+            chunks.append(self.poser.get_posing_outputs(image[start:end], pose[start:end]))
+        return [torch.cat([chunk[i] for chunk in chunks], dim=0) for i in range(len(chunks[0]))]
+
+    def run_training_iteration(
+            self,
+            batch: Any,
+            examples_seen_so_far: int,
+            modules: Dict[str, Module],
+            accumulated_modules: Dict[str, Module],
+            optimizers: Dict[str, Optimizer],
+            losses: Dict[str, Loss],
+            create_log_func: Optional[Callable[[str, int], Callable[[str, float], None]]],
+            device: torch.device):
+        if self.poser is None:
+            self.poser = self.poser_func()
+            self.poser.to(device)
+
+        character_batches = [func(batch, device) for func in self.character_batch_funcs]
+        n = character_batches[0][self.batch_pose_index].shape[0]
+        with torch.no_grad():
+            teacher_outputs = self.get_teacher_outputs(
+                torch.cat([b[self.batch_image_index] for b in character_batches], dim=0),
+                torch.cat([b[self.batch_pose_index] for b in character_batches], dim=0))
+
+        for i, module_key in enumerate(self.module_keys):
+            module = modules[module_key]
+            module.train(True)
+            module_optimizer = optimizers[module_key]
+            module_optimizer.zero_grad(set_to_none=True)
+
+            loss = losses[module_key]
+            if create_log_func is not None:
+                log_func = create_log_func(f"training_{module_key}", examples_seen_so_far)
+            else:
+                log_func = None
+            state = ComputationState(
+                modules={
+                    **get_character_modules(modules, module_key, self.key_module),
+                    self.key_poser: self.poser,
+                },
+                accumulated_modules=get_character_modules(accumulated_modules, module_key, self.key_module),
+                batch=character_batches[i],
+                outputs={
+                    self.key_examples_seen_so_far: examples_seen_so_far,
+                    self.key_poser_output: [output[i * n:(i + 1) * n] for output in teacher_outputs],
+                })
+            loss_value = loss.compute(state, log_func)
+            loss_value.backward()
+            module_optimizer.step()
+
+            for callback in self.iteration_callbacks[i]:
+                callback(state)
+
+
+class MultiCharacterSampleOutputProtocol(SampleOutputProtocol):
+    def __init__(self,
+                 module_keys: List[str],
+                 protocols: List[SampleOutputProtocol],
+                 validation_datasets: List[Dataset],
+                 key_module: str = KEY_MODULE):
+        assert len(module_keys) >= 1
+        assert len(module_keys) == len(protocols)
+        assert len(module_keys) == len(validation_datasets)
+        self.key_module = key_module
+        self.validation_datasets = validation_datasets
+        self.protocols = protocols
+        self.module_keys = module_keys
+
+    def get_examples_per_sample_output(self) -> int:
+        return self.protocols[0].get_examples_per_sample_output()
+
+    def get_random_seed(self) -> int:
+        return self.protocols[0].get_random_seed()
+
+    def get_sample_output_data(self, validation_dataset: Dataset, device: torch.device) -> Any:
+        output = []
+        for protocol, dataset in zip(self.protocols, self.validation_datasets):
+            torch.manual_seed(protocol.get_random_seed())
+            output.append(protocol.get_sample_output_data(dataset, device))
+        return output
+
+    def save_sample_output_data(
+            self,
+            modules: Dict[str, Module],
+            accumulated_modules: Dict[str, Module],
+            sample_output_data: Any,
+            prefix: str,
+            examples_seen_so_far: int,
+            device: torch.device):
+        for i, module_key in enumerate(self.module_keys):
+            self.protocols[i].save_sample_output_data(
+                get_character_modules(modules, module_key, self.key_module),
+                get_character_modules(accumulated_modules, module_key, self.key_module),
+                sample_output_data[i],
+                f"{prefix}/{module_key}",
+                examples_seen_so_far,
+                device)
+
+
+# The characters are trained on one shared stream of pose batches, so their pose datasets must hold the same poses.
+def check_shared_pose_dataset(character_args: List[Union[SirenFaceMorpher00TrainerArgs, SirenMorpher03TrainerArgs]]):
+    file_name = character_args[0].pose_dataset_file_name
+    poses = None
+    for i, args in enumerate(character_args[1:], start=1):
+        if os.path.realpath(args.pose_dataset_file_name) == os.path.realpath(file_name):
+            continue
+        if poses is None:
+            poses = load_pose_tensor(file_name)
+        if not torch.equal(load_pose_tensor(args.pose_dataset_file_name), poses):
+            raise RuntimeError(
+                f"Character {i} uses the pose dataset {args.pose_dataset_file_name}, which differs from "
+                f"{file_name} used by character 0. All characters must share the same pose dataset.")
+
+
+def create_multi_character_trainer(
+        prefix: str,
+        character_args: List[Union[SirenFaceMorpher00TrainerArgs, SirenMorpher03TrainerArgs]],
+        world_size: int,
+        distrib_backend: str = 'gloo',
+        num_data_loader_workers: int = 8,
+        max_teacher_batch_size: Optional[int] = None) -> DistributedTrainer:
+    assert len(character_args) >= 1
+    for args in character_args:
+        assert args.online_teacher_devices is None, \
+            "Online teacher workers are not supported in multi-character distillation."
+        assert not args.adaptive_pose_sampling, \
+            "Adaptive pose sampling is not supported in multi-character distillation."
+
+    check_shared_pose_dataset(character_args)
+    accumulators = [args.module_accumulator for args in character_args if args.module_accumulator is not None]
+    assert len(set(id(accumulator) for accumulator in accumulators)) == len(accumulators), \
+        "Each character needs its own module accumulator."
+
+    module_keys = [get_character_module_key(i) for i in range(len(character_args))]
+    protocols = [args.get_training_protocol(world_size) for args in character_args]
+    for protocol in protocols[1:]:
+        assert protocol.get_checkpoint_examples() == protocols[0].get_checkpoint_examples(), \
+            "All characters must share the same checkpoint schedule."
+        assert protocol.get_batch_size() == protocols[0].get_batch_size(), \
+            "All characters must share the same batch size."
+
+    training_datasets = [args.get_broadcast_training_dataset() for args in character_args]
+    training_protocol = MultiCharacterSirenTrainingProtocol(
+        check_point_examples=protocols[0].get_checkpoint_examples(),
+        batch_size=protocols[0].get_batch_size(),
+        learning_rate=MultiCharacterLearningRateFunc(protocols, module_keys),
+        optimizer_factories={
+            module_key: protocol.get_optimizer_factories()[KEY_MODULE]
+            for module_key, protocol in zip(module_keys, protocols)
+        },
+        random_seed=protocols[0].get_random_seed(),
+        poser_func=character_args[0].get_poser,
+        module_keys=module_keys,
+        character_batch_funcs=[dataset.attach_constant_images for dataset in training_datasets],
+        iteration_callbacks=[protocol.iteration_callbacks for protocol in protocols],
+        max_teacher_batch_size=max_teacher_batch_size)
+
+    pretrained_module_file_names = {}
+    for module_key, args in zip(module_keys, character_args):
+        if args.pretrained_module_file_name is not None:
+            pretrained_module_file_names[module_key] = args.pretrained_module_file_name
+
+    if character_args[0].num_training_examples_per_sample_output is not None:
+        sample_output_protocol = MultiCharacterSampleOutputProtocol(
+            module_keys=module_keys,
+            protocols=[args.get_sample_output_protocol() for args in character_args],
+            validation_datasets=[args.get_training_dataset() for args in character_args])
+    else:
+        sample_output_protocol = None
+
+    return DistributedTrainer(
+        prefix=prefix,
+        module_factories={
+            module_key: args.get_module_factory()
+            for module_key, args in zip(module_keys, character_args)
+        },
+        accumulators={
+            module_key: args.module_accumulator
+            for module_key, args in zip(module_keys, character_args)
+            if args.module_accumulator is not None
+        },
+        losses={
+            module_key: args.get_loss()
+            for module_key, args in zip(module_keys, character_args)
+        },
+        training_dataset=training_datasets[0],
+        validation_dataset=character_args[0].get_training_dataset(),
+        training_protocol=training_protocol,
+        validation_protocol=None,
+        sample_output_protocol=sample_output_protocol,
+        pretrained_module_file_names=pretrained_module_file_names,
+        example_per_snapshot=character_args[0].num_training_examples_per_snapshot,
+        num_data_loader_workers=num_data_loader_workers,
+        distrib_backend=distrib_backend)
@@ -0,0 +1,189 @@
+import os.path
+from dataclasses import dataclass
+from typing import Optional, List
+
+from omegaconf import OmegaConf
+from tha4.charmodel.character_model import CharacterModel
+from tha4.pytasuku.workspace import Workspace
+from tha4.distiller.config_based_training_tasks import define_standalone_config_based_training_tasks
+from tha4.distiller.distiller_config import DistillerConfig, copy_file, get_final_checkpoint_prefix
+from tha4.distiller.multi_character_distillation import create_multi_character_trainer, get_character_module_key
+from tha4.shion.core.training.distrib.distributed_training_states import DistributedTrainingState
+
+
+@dataclass
+class MultiCharacterDistillerConfig:
+    prefix: str
+    character_config_file_names: List[str]
+
+    max_teacher_batch_size: Optional[int] = None
+
+    num_cpu_workers: int = 1
+    num_gpus: int = 1
+
+    def __post_init__(self):
+        self.character_configs = None
+
+    def check(self):
+        DistillerConfig.check_prefix(self.prefix)
+        DistillerConfig.check_num_cpu_workers(self.num_cpu_workers)
+        DistillerConfig.check_num_gpus(self.num_gpus)
+        MultiCharacterDistillerConfig.check_max_teacher_batch_size(self.max_teacher_batch_size)
+        assert len(self.character_config_file_names) >= 1, "There must be at least one character config file."
+        for file_name in self.character_config_file_names:
+            assert os.path.isfile(file_name), f"The character config file {file_name} does not exist."
+
+        character_configs = self.get_character_configs()
+        for config in character_configs[1:]:
+            assert config.face_morpher_batch_size == character_configs[0].face_morpher_batch_size, \
+                "All characters must have the same face_morpher_batch_size."
+            assert config.body_morpher_batch_size == character_configs[0].body_morpher_batch_size, \
+                "All characters must have the same body_morpher_batch_size."
+        prefixes = [config.prefix for config in character_configs]
+        assert len(set(prefixes)) == len(prefixes), "All characters must have different prefixes."
+
+    @staticmethod
+    def check_max_teacher_batch_size(value):
+        if value is None:
+            return
+        assert isinstance(value, int), "The value of 'max_teacher_batch_size' must be an integer or None."
+        assert value >= 1, "The value of 'max_teacher_batch_size' must be at least 1."
+
+    def get_character_configs(self) -> List[DistillerConfig]:
+        if self.character_configs is None:
+            self.character_configs = [
+                DistillerConfig.load(file_name) for file_name in self.character_config_file_names
+            ]
+        return self.character_configs
+
+    def save(self, file_name: str):
+        conf = OmegaConf.create({
+            'prefix': self.prefix,
+            'character_config_file_names': self.character_config_file_names,
+            'max_teacher_batch_size': self.max_teacher_batch_size,
+            'num_cpu_workers': self.num_cpu_workers,
+            'num_gpus': self.num_gpus,
+        })
+        os.makedirs(self.prefix, exist_ok=True)
+        with open(file_name, "wt") as fout:
+            fout.write(OmegaConf.to_yaml(conf))
+
+    def config_yaml_file_name(self):
+        return f"{self.prefix}/config.yaml"
+
+    def create_config_yaml_file(self):
+        if os.path.exists(self.config_yaml_file_name()):
+            return
+        self.save(self.config_yaml_file_name())
+
+    @staticmethod
+    def load(file_name: str) -> 'MultiCharacterDistillerConfig':
+        conf = OmegaConf.to_container(OmegaConf.load(file_name))
+        args = MultiCharacterDistillerConfig(**conf)
+        args.check()
+        return args
+
+    def face_morpher_prefix(self):
+        return f"{self.prefix}/face_morpher"
+
+    def get_face_morpher_trainer(self, world_size: Optional[int] = None, backend: str = 'gloo'):
+        if world_size is None:
+            world_size = self.num_gpus
+        return create_multi_character_trainer(
+            self.face_morpher_prefix(),
+            [config.get_face_morpher_trainer_args() for config in self.get_character_configs()],
+            world_size,
+            backend,
+            num_data_loader_workers=max(1, self.num_cpu_workers // world_size),
+            max_teacher_batch_size=self.max_teacher_batch_size)
+
+    def body_morpher_prefix(self):
+        return f"{self.prefix}/body_morpher"
+
+    def get_body_morpher_trainer(self, world_size: Optional[int] = None, backend: str = 'gloo'):
+        if world_size is None:
+            world_size = self.num_gpus
+        return create_multi_character_trainer(
+            self.body_morpher_prefix(),
+            [config.get_body_morpher_trainer_args() for config in self.get_character_configs()],
+            world_size,
+            backend,
+            num_data_loader_workers=max(1, self.num_cpu_workers // world_size),
+            max_teacher_batch_size=self.max_teacher_batch_size)
+
+    def define_tasks(self, workspace: Workspace):
+        workspace.create_file_task(self.config_yaml_file_name(), [], self.create_config_yaml_file)
+
+        define_standalone_config_based_training_tasks(
+            workspace,
+            self.get_face_morpher_trainer,
+            "src/tha4/distiller/distill_multi_character_face_morpher.py",
+            self.config_yaml_file_name(),
+            num_proc_per_node=self.num_gpus,
+            dependencies=[
+                self.config_yaml_file_name(),
+            ])
+
+        define_standalone_config_based_training_tasks(
+            workspace,
+            self.get_body_morpher_trainer,
+            "src/tha4/distiller/distill_multi_character_body_morpher.py",
+            self.config_yaml_file_name(),
+            num_proc_per_node=self.num_gpus,
+            dependencies=[
+                self.config_yaml_file_name(),
+            ])
+
+        # All characters share one checkpoint schedule, so the first character's arguments determine it.
+        character_configs = self.get_character_configs()
+        face_checkpoint_prefix = get_final_checkpoint_prefix(
+            self.face_morpher_prefix(), character_configs[0].get_face_morpher_trainer_args())
+        body_checkpoint_prefix = get_final_checkpoint_prefix(
+            self.body_morpher_prefix(), character_configs[0].get_body_morpher_trainer_args())
+
+        all_dependencies = [
+            f"{self.face_morpher_prefix()}/train_standalone",
+            f"{self.body_morpher_prefix()}/train_standalone",
+        ]
+        for i, config in enumerate(character_configs):
+            module_key = get_character_module_key(i)
+            self.define_character_model_tasks(
+                workspace,
+                config,
+                DistributedTrainingState.get_module_file_name(face_checkpoint_prefix, module_key),
+                DistributedTrainingState.get_module_file_name(body_checkpoint_prefix, module_key))
+            all_dependencies += [
+                config.character_model_character_png_file_name(),
+                config.character_model_face_morpher_file_name(),
+                config.character_model_body_morpher_file_name(),
+                config.character_model_yaml_file_name(),
+            ]
+
+        workspace.create_command_task(f"{self.prefix}/all", all_dependencies)
+
+    def define_character_model_tasks(self,
+                                     workspace: Workspace,
+                                     config: DistillerConfig,
+                                     face_morpher_file_name: str,
+                                     body_morpher_file_name: str):
+        workspace.create_file_task(
+            config.character_model_character_png_file_name(),
+            [config.character_image_file_name],
+            lambda: copy_file(config.character_image_file_name, config.character_model_character_png_file_name()))
+        workspace.create_file_task(
+            config.character_model_face_morpher_file_name(),
+            [face_morpher_file_name],
+            lambda: copy_file(face_morpher_file_name, config.character_model_face_morpher_file_name()))
+        workspace.create_file_task(
+            config.character_model_body_morpher_file_name(),
+            [body_morpher_file_name],
+            lambda: copy_file(body_morpher_file_name, config.character_model_body_morpher_file_name()))
+
+        def create_character_model_yaml_file():
+            character_model = CharacterModel(
+                config.character_model_character_png_file_name(),
+                config.character_model_face_morpher_file_name(),
+                config.character_model_body_morpher_file_name())
+            character_model.save(config.character_model_yaml_file_name())
+
+        workspace.create_file_task(config.character_model_yaml_file_name(), [], create_character_model_yaml_file)
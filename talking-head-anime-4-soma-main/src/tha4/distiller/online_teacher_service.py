@@ -0,0 +1,295 @@
+import logging
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, List, Optional, Tuple
+
+import torch
+import torch.multiprocessing
+from torch import Tensor
+from torch.utils.data import Dataset
+
+from tha4.poser.poser import Poser
+from tha4.shion.core.load_save import torch_load
+
+
+def load_pose_tensor(file_name: str) -> Tensor:
+    data = torch_load(file_name)
+    if isinstance(data, (list, tuple)):
+        data = data[0]
+    return data
+
+
+# Stands in for the pose dataset of a trainer whose poses come from the online teacher service. It has the length
+# and pose shape of the real dataset, so the data loader keeps its epoch bookkeeping, but it never holds the poses.
+class PlaceholderPoseDataset(Dataset):
+    def __init__(self, num_poses: int, pose_shape: Tuple[int, ...]):
+        self.pose_shape = pose_shape
+        self.num_poses = num_poses
+
+    @staticmethod
+    def from_file(file_name: str) -> 'PlaceholderPoseDataset':
+        poses = load_pose_tensor(file_name)
+        return PlaceholderPoseDataset(poses.shape[0], tuple(poses.shape[1:]))
+
+    def __len__(self):
+        return self.num_poses
+
+    def __getitem__(self, item):
+        return (torch.zeros(self.pose_shape),)
+
+
+class OnlineTeacherServiceArgs:
+    def __init__(self,
+                 poser_func: Callable[[], Poser],
+                 image_func: Callable[[], Tensor],
+                 pose_dataset_file_name: str,
+                 output_indices: List[int],
+                 teacher_devices: List[str],
+                 teacher_batch_size: int = 32,
+                 num_slots: int = 4,
+                 random_seed: int = 1853502993,
+                 report_interval: float = 60.0):
+        assert len(teacher_devices) >= 1
+        assert teacher_batch_size >= 1
+        assert num_slots >= 1
+        self.report_interval = report_interval
+        self.random_seed = random_seed
+        self.num_slots = num_slots
+        self.teacher_batch_size = teacher_batch_size
+        self.teacher_devices = teacher_devices
+        self.output_indices = output_indices
+        self.pose_dataset_file_name = pose_dataset_file_name
+        self.image_func = image_func
+        self.poser_func = poser_func
+
+
+def run_online_teacher_worker(
+        worker_index: int,
+        args: OnlineTeacherServiceArgs,
+        probe_queue,
+        setup_queue,
+        index_queue,
+        free_slot_queue,
+        full_slot_queue,
+        produced_counter,
+        error_queue):
+    try:
+        run_online_teacher_worker_loop(
+            worker_index, args, probe_queue, setup_queue, index_queue, free_slot_queue, full_slot_queue,
+            produced_counter)
+    except BaseException:
+        error_queue.put((worker_index, traceback.format_exc()))
+        raise
+
+
+def run_online_teacher_worker_loop(
+        worker_index: int,
+        args: OnlineTeacherServiceArgs,
+        probe_queue,
+        setup_queue,
+        index_queue,
+        free_slot_queue,
+        full_slot_queue,
+        produced_counter):
+    torch.set_grad_enabled(False)
+    device = torch.device(args.teacher_devices[worker_index])
+    poser = args.poser_func()
+    poser.to(device)
+    image = args.image_func().to(device)
+    if len(image.shape) == 3:
+        image = image.unsqueeze(0)
+    poses = load_pose_tensor(args.pose_dataset_file_name)
+
+    if worker_index == 0:
+        outputs = poser.get_posing_outputs(image, poses[0:1].to(device))
+        probe_queue.put((
+            poses.shape[0],
+            tuple(poses.shape[1:]),
+            [tuple(outputs[i].shape[1:]) for i in args.output_indices]))
+    buffers = setup_queue.get()
+
+    while True:
+        indices = index_queue.get()
+        if indices is None:
+            return
+        pose = poses[indices].to(device)
+        outputs = poser.get_posing_outputs(image, pose)
+        slot = free_slot_queue.get()
+        buffers[0][slot].copy_(pose)
+        for k, output_index in enumerate(args.output_indices):
+            buffers[k + 1][slot].copy_(outputs[output_index])
+        full_slot_queue.put(slot)
+        with produced_counter.get_lock():
+            produced_counter.value += indices.shape[0]
+
+
+class OnlineTeacherService:
+    def __init__(self, args: OnlineTeacherServiceArgs, rank: int = 0):
+        self.rank = rank
+        self.args = args
+
+        self.processes = []
+        self.buffers: Optional[List[Tensor]] = None
+        self.index_queue = None
+        self.free_slot_queue = None
+        self.full_slot_queue = None
+        self.produced_counter = None
+        self.error_queue = None
+        self.index_thread = None
+        self.stop_event = threading.Event()
+        self.num_poses = None
+
+        self.current_slot = None
+        self.current_offset = 0
+
+        self.num_consumed_examples = 0
+        self.consumer_wait_time = 0.0
+        self.last_report_time = None
+        self.last_report_produced = 0
+        self.last_report_consumed = 0
+        self.last_report_wait_time = 0.0
+
+    def start(self):
+        if len(self.processes) > 0:
+            return
+        context = torch.multiprocessing.get_context('spawn')
+        num_workers = len(self.args.teacher_devices)
+        self.index_queue = context.Queue(maxsize=2 * num_workers)
+        self.free_slot_queue = context.Queue()
+        self.full_slot_queue = context.Queue()
+        self.produced_counter = context.Value('q', 0)
+        self.error_queue = context.Queue()
+        probe_queue = context.Queue()
+        setup_queues = [context.Queue() for i in range(num_workers)]
+
+        for i in range(num_workers):
+            process = context.Process(
+                target=run_online_teacher_worker,
+                args=(
+                    i,
+                    self.args,
+                    probe_queue,
+                    setup_queues[i],
+                    self.index_queue,
+                    self.free_slot_queue,
+                    self.full_slot_queue,
+                    self.produced_counter,
+                    self.error_queue),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        self.num_poses, pose_shape, output_shapes = self.get_from_worker_queue(probe_queue)
+        num_slots, batch_size = self.args.num_slots, self.args.teacher_batch_size
+        self.buffers = [torch.zeros(num_slots, batch_size, *pose_shape).share_memory_()]
+        for shape in output_shapes:
+            self.buffers.append(torch.zeros(num_slots, batch_size, *shape).share_memory_())
+        for setup_queue in setup_queues:
+            setup_queue.put(self.buffers)
+        for slot in range(num_slots):
+            self.free_slot_queue.put(slot)
+
+        self.index_thread = threading.Thread(target=self.produce_indices, daemon=True)
+        self.index_thread.start()
+        self.last_report_time = time.time()
+        logging.info(f"Started the online teacher service with {num_workers} worker(s).")
+
+    def check_workers(self):
+        dead_workers = [i for i, process in enumerate(self.processes) if not process.is_alive()]
+        try:
+            # A worker that died of an exception reports it just before exiting, so give the report a moment.
+            worker_index, error = self.error_queue.get(timeout=1.0 if len(dead_workers) > 0 else 0.0)
+        except queue.Empty:
+            worker_index, error = None, None
+        if error is not None:
+            raise RuntimeError(f"Online teacher worker {worker_index} failed:\n{error}")
+        if len(dead_workers) > 0:
+            i = dead_workers[0]
+            raise RuntimeError(
+                f"Online teacher worker {i} exited unexpectedly with exit code {self.processes[i].exitcode}.")
+
+    def get_from_worker_queue(self, worker_queue, poll_interval: float = 1.0):
+        # Waits for a worker without hanging forever when one of them dies.
+        while True:
+            try:
+                return worker_queue.get(timeout=poll_interval)
+            except queue.Empty:
+                self.check_workers()
+
+    def produce_indices(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.args.random_seed + self.rank)
+        batch_size = self.args.teacher_batch_size
+        while not self.stop_event.is_set():
+            permutation = torch.randperm(self.num_poses, generator=generator)
+            for start in range(0, self.num_poses - batch_size + 1, batch_size):
+                indices = permutation[start:start + batch_size].clone()
+                while not self.stop_event.is_set():
+                    try:
+                        self.index_queue.put(indices, timeout=1.0)
+                        break
+                    except queue.Full:
+                        pass
+                if self.stop_event.is_set():
+                    return
+
+    def get_batch(self, batch_size: int, device: torch.device) -> Tuple[Tensor, List[Optional[Tensor]]]:
+        assert self.args.teacher_batch_size % batch_size == 0
+        if self.current_slot is None:
+            start_time = time.time()
+            self.current_slot = self.get_from_worker_queue(self.full_slot_queue)
+            self.consumer_wait_time += time.time() - start_time
+            self.current_offset = 0
+
+        slot, start, end = self.current_slot, self.current_offset, self.current_offset + batch_size
+        pose = self.buffers[0][slot, start:end].to(device, copy=True)
+        outputs = [None for i in range(max(self.args.output_indices) + 1)]
+        for k, output_index in enumerate(self.args.output_indices):
+            outputs[output_index] = self.buffers[k + 1][slot, start:end].to(device, copy=True)
+
+        self.current_offset = end
+        if self.current_offset >= self.args.teacher_batch_size:
+            self.free_slot_queue.put(self.current_slot)
+            self.current_slot = None
+        self.num_consumed_examples += batch_size
+        return pose, outputs
+
+    def report(self,
+               create_log_func: Optional[Callable[[str, int], Callable[[str, float], None]]],
+               examples_seen_so_far: int):
+        now = time.time()
+        elapsed_time = now - self.last_report_time
+        if elapsed_time < self.args.report_interval:
+            return
+        produced = self.produced_counter.value
+        produced_per_second = (produced - self.last_report_produced) / elapsed_time
+        consumed_per_second = (self.num_consumed_examples - self.last_report_consumed) / elapsed_time
+        wait_fraction = (self.consumer_wait_time - self.last_report_wait_time) / elapsed_time
+        logging.info(
+            f"Online teacher service (rank {self.rank}): "
+            f"produced {produced_per_second:.1f} examples/s, "
+            f"consumed {consumed_per_second:.1f} examples/s, "
+            f"trainer waited {100 * wait_fraction:.1f}% of the time")
+        if create_log_func is not None:
+            log_func = create_log_func("teacher_service", examples_seen_so_far)
+            log_func("produced_examples_per_second", produced_per_second)
+            log_func("consumed_examples_per_second", consumed_per_second)
+            log_func("trainer_wait_fraction", wait_fraction)
+        self.last_report_time = now
+        self.last_report_produced = produced
+        self.last_report_consumed = self.num_consumed_examples
+        self.last_report_wait_time = self.consumer_wait_time
+
+    def close(self):
+        self.stop_event.set()
+        if self.index_thread is not None:
+            self.index_thread.join()
+            self.index_thread = None
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        self.processes = []
+        self.buffers = None
+        self.current_slot = None
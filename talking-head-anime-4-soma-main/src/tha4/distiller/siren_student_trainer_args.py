@@ -0,0 +1,163 @@
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, List, Optional
+
+import torch
+from torch import Tensor
+from torch.utils.data import Dataset
+
+from tha4.dataset.adaptive_pose_sampler import AdaptivePoseSampler, AdaptivePoseSamplerErrorFeedback
+from tha4.distiller.online_teacher_service import OnlineTeacherService, OnlineTeacherServiceArgs, \
+    PlaceholderPoseDataset
+from tha4.nn.siren.morpher.siren_morpher_protocols_03 import KEY_MODULE, KEY_POSER, SirenMorpherTrainingProtocol03, \
+    SirenMorpherValidationProtocol
+from tha4.nn.siren.pixel_sampling import PixelSamplerErrorFeedback
+from tha4.shion.base.dataset.lazy_tensor_dataset import LazyTensorDataset
+from tha4.shion.base.optimizer_factories import AdamOptimizerFactory
+from tha4.shion.core.cached_computation import create_batch_element_func
+from tha4.shion.core.module_accumulator import ModuleAccumulator
+from tha4.shion.core.training.plateau_detector import PlateauDetector
+
+
+# The parts of the SIREN face and body morpher trainer arguments that do not depend on the student. Subclasses set the
+# attributes that these methods read (pose_dataset_file_name, online_teacher_*, pixel_sampler, adaptive_pose_sampling,
+# early_stopping_*, num_validation_examples, ...) in their constructors.
+class SirenStudentTrainerArgs(ABC):
+    @abstractmethod
+    def get_character_image(self) -> Tensor:
+        pass
+
+    @abstractmethod
+    def get_training_computation_protocol(self):
+        pass
+
+    @abstractmethod
+    def get_training_dataset(self, return_pose_index: bool = False, pose_dataset: Optional[Dataset] = None):
+        pass
+
+    @abstractmethod
+    def get_learning_rate_func(self) -> Callable[[int], Dict[str, float]]:
+        pass
+
+    @abstractmethod
+    def get_num_checkpoints(self) -> int:
+        pass
+
+    # The indices of the teacher poser outputs that the computation protocol reads.
+    @abstractmethod
+    def get_online_teacher_output_indices(self) -> List[int]:
+        pass
+
+    # Where the pose index is in a training batch when the dataset returns it.
+    @abstractmethod
+    def get_batch_pose_index_index(self) -> int:
+        pass
+
+    def get_accumulators(self) -> Dict[str, ModuleAccumulator]:
+        if self.module_accumulator is None:
+            return {}
+        return {
+            KEY_MODULE: self.module_accumulator,
+        }
+
+    def get_optimizer_factories(self):
+        return {
+            KEY_MODULE: AdamOptimizerFactory(betas=(0.9, 0.999)),
+        }
+
+    def get_poser(self):
+        return self.poser_func()
+
+    def get_training_pose_dataset(self) -> Dataset:
+        # The online teacher service supplies the training poses, so the data loader would only load poses to
+        # throw them away.
+        if self.online_teacher_devices is not None:
+            return PlaceholderPoseDataset.from_file(self.pose_dataset_file_name)
+        return LazyTensorDataset(self.pose_dataset_file_name)
+
+    def create_online_teacher_service(self):
+        if torch.distributed.is_initialized():
+            rank = torch.distributed.get_rank()
+        else:
+            rank = 0
+        return OnlineTeacherService(
+            OnlineTeacherServiceArgs(
+                poser_func=self.get_poser,
+                image_func=self.get_character_image,
+                pose_dataset_file_name=self.pose_dataset_file_name,
+                output_indices=self.get_online_teacher_output_indices(),
+                teacher_devices=self.online_teacher_devices,
+                teacher_batch_size=self.online_teacher_batch_size,
+                num_slots=self.online_teacher_num_slots,
+                random_seed=self.training_random_seed),
+            rank)
+
+    def get_pose_sampler(self):
+        return self.pose_sampler
+
+    def create_pose_sampler(self, dataset: Dataset):
+        self.pose_sampler = AdaptivePoseSampler(
+            num_poses=len(dataset),
+            random_seed=self.training_random_seed,
+            record_dir=self.pose_sampler_record_dir)
+        return self.pose_sampler
+
+    def get_iteration_callbacks(self):
+        protocol = self.get_training_computation_protocol()
+        if self.pixel_sampler is not None:
+            expected_func = protocol.get_output_func(protocol.keys.sampled_groundtruth_posed_image)
+            actual_func = protocol.get_output_func(protocol.keys.sampled_predicted_posed_image)
+        else:
+            expected_func = protocol.get_output_func(protocol.keys.groundtruth_posed_image)
+            actual_func = protocol.get_output_func(protocol.keys.predicted_posed_image)
+
+        callbacks = []
+        if self.pixel_sampler is not None:
+            callbacks.append(PixelSamplerErrorFeedback(
+                sampler=self.pixel_sampler,
+                sample_func=protocol.get_output_func(protocol.keys.pixel_sample),
+                expected_func=expected_func,
+                actual_func=actual_func))
+        if self.adaptive_pose_sampling:
+            callbacks.append(AdaptivePoseSamplerErrorFeedback(
+                sampler_func=self.get_pose_sampler,
+                pose_index_func=create_batch_element_func(self.get_batch_pose_index_index()),
+                expected_func=expected_func,
+                actual_func=actual_func))
+        return callbacks
+
+    def get_training_protocol(self, world_size: int):
+        per_checkpoint_examples = self.num_training_examples_per_checkpoint
+        num_checkpoints = self.get_num_checkpoints()
+        batch_size = self.total_batch_size // world_size
+        if self.online_teacher_devices is not None:
+            teacher_service_func = self.create_online_teacher_service
+        else:
+            teacher_service_func = None
+        return SirenMorpherTrainingProtocol03(
+            check_point_examples=[per_checkpoint_examples * (i + 1) for i in range(num_checkpoints)],
+            batch_size=batch_size,
+            learning_rate=self.get_learning_rate_func(),
+            optimizer_factories=self.get_optimizer_factories(),
+            random_seed=self.training_random_seed,
+            poser_func=self.get_poser,
+            key_module=KEY_MODULE,
+            key_poser=KEY_POSER,
+            teacher_service_func=teacher_service_func,
+            iteration_callbacks=self.get_iteration_callbacks())
+
+    def get_validation_protocol(self):
+        if self.early_stopping_patience is None:
+            return None
+        return SirenMorpherValidationProtocol(
+            example_per_validation_iteration=self.num_training_examples_per_validation,
+            batch_size=self.total_batch_size,
+            poser_func=self.get_poser,
+            key_module=KEY_MODULE,
+            key_poser=KEY_POSER,
+            plateau_detector=PlateauDetector(
+                window_size=self.early_stopping_window_size,
+                patience=self.early_stopping_patience,
+                min_relative_improvement=self.early_stopping_min_relative_improvement),
+            validation_dataset_func=self.get_training_dataset,
+            num_validation_examples=self.num_validation_examples,
+            random_seed=self.training_random_seed)
@@ -3,12 +3,13 @@ import math
 import PIL.Image
 import numpy
 import torch
-from matplotlib import cm
 from tha4.shion.base.image_util import numpy_linear_to_srgb, pytorch_rgba_to_numpy_image, pytorch_rgb_to_numpy_image, \
     torch_linear_to_srgb
 
 
 def grid_change_to_numpy_image(torch_image, num_channels=3):
+    from matplotlib import cm
+
     height = torch_image.shape[1]
     width = torch_image.shape[2]
     size_image = (torch_image[0, :, :] ** 2 + torch_image[1, :, :] ** 2).sqrt().view(height, width, 1).numpy()
@@ -0,0 +1,72 @@
+import argparse
+import time
+
+import numpy
+
+from tha4.mocap.pose_converter_core import PoseConverterCore
+
+
+# The per-frame solve that the iFacialMocap and MediaPipe converters used before PoseConverterCore.
+def decompose_mouth_shapes_with_scipy(core: PoseConverterCore, mouth_points: numpy.ndarray) -> numpy.ndarray:
+    import scipy.optimize
+
+    M = core.mouth_shape_points
+    output = numpy.zeros(mouth_points.shape, dtype=numpy.float64)
+    for i in range(mouth_points.shape[0]):
+        mouth_point = mouth_points[i]
+
+        def loss(decomp):
+            return numpy.linalg.norm(numpy.matmul(decomp, M) - mouth_point) \
+                + core.mouth_decomposition_l1_weight * numpy.linalg.norm(decomp, ord=1)
+
+        opt_result = scipy.optimize.minimize(
+            loss, numpy.array([0, 0, 0, 0]), bounds=[(0.0, 1.0), (0.0, 1.0), (0.0, 1.0), (0.0, 1.0)])
+        output[i] = opt_result["x"]
+    return output
+
+
+def create_mouth_points(num_points: int, seed: int) -> numpy.ndarray:
+    rng = numpy.random.default_rng(seed)
+    core = PoseConverterCore()
+    # Arbitrary blendshape values, mixtures of the four mouth shapes, and a closed mouth.
+    return numpy.concatenate([
+        rng.uniform(0.0, 1.0, (num_points, 4)),
+        numpy.matmul(rng.uniform(0.0, 1.0, (num_points, 4)), core.mouth_shape_points) * 0.8,
+        numpy.zeros((1, 4)),
+    ], axis=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Check the batched mouth shape decomposition against the old per-frame scipy solve.')
+    parser.add_argument('--num_points', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--loss_tolerance', type=float, default=1e-6)
+    parser.add_argument('--decomp_tolerance', type=float, default=1e-3)
+    args = parser.parse_args()
+
+    core = PoseConverterCore()
+    mouth_points = create_mouth_points(args.num_points, args.seed)
+
+    start_time = time.perf_counter()
+    decomp = core.decompose_mouth_shapes(mouth_points)
+    batched_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    expected_decomp = decompose_mouth_shapes_with_scipy(core, mouth_points)
+    scipy_time = time.perf_counter() - start_time
+
+    loss = core.compute_mouth_decomposition_loss(mouth_points, decomp)
+    expected_loss = core.compute_mouth_decomposition_loss(mouth_points, expected_decomp)
+    loss_diff = loss - expected_loss
+    # Where scipy stops at a worse point than the batched solve, the two decompositions need not be close.
+    same_minimum = loss_diff > -args.loss_tolerance
+    decomp_diff = numpy.abs(decomp - expected_decomp).max(axis=1)
+
+    print("points: %d, batched = %.2f ms, scipy = %.2f ms" % (
+        mouth_points.shape[0], batched_time * 1000, scipy_time * 1000))
+    print("max loss excess over scipy = %e, points where scipy does worse = %d" % (
+        loss_diff.max(), (~same_minimum).sum()))
+    print("max abs decomposition diff where the losses agree = %e" % decomp_diff[same_minimum].max())
+    if loss_diff.max() > args.loss_tolerance or decomp_diff[same_minimum].max() > args.decomp_tolerance:
+        raise RuntimeError("The batched mouth shape decomposition does not match the scipy solve.")
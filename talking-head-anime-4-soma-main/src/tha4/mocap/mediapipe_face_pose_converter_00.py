@@ -1,34 +1,17 @@
 import math
 import time
-from enum import Enum
-from typing import Optional, List, Callable
+from typing import Optional, List, Callable, TYPE_CHECKING
 
 import numpy
-import scipy.optimize
-import wx
-from scipy.spatial.transform import Rotation
-
-from tha4.poser.modes.pose_parameters import get_pose_parameters
-from tha4.mocap.mediapipe_constants import MOUTH_SMILE_LEFT, MOUTH_SHRUG_UPPER, MOUTH_SMILE_RIGHT, \
-    BROW_INNER_UP, BROW_OUTER_UP_RIGHT, BROW_OUTER_UP_LEFT, BROW_DOWN_LEFT, BROW_DOWN_RIGHT, EYE_WIDE_LEFT, \
-    EYE_WIDE_RIGHT, EYE_BLINK_LEFT, EYE_BLINK_RIGHT, CHEEK_SQUINT_LEFT, CHEEK_SQUINT_RIGHT, EYE_LOOK_IN_LEFT, \
-    EYE_LOOK_OUT_LEFT, EYE_LOOK_IN_RIGHT, EYE_LOOK_OUT_RIGHT, EYE_LOOK_UP_LEFT, EYE_LOOK_UP_RIGHT, EYE_LOOK_DOWN_RIGHT, \
-    EYE_LOOK_DOWN_LEFT, JAW_OPEN, MOUTH_FROWN_LEFT, MOUTH_FROWN_RIGHT, \
-    MOUTH_LOWER_DOWN_LEFT, MOUTH_LOWER_DOWN_RIGHT, MOUTH_FUNNEL, MOUTH_PUCKER
+
+from tha4.mocap.mediapipe_constants import BLENDSHAPE_NAMES
 from tha4.mocap.mediapipe_face_pose import MediaPipeFacePose
 from tha4.mocap.mediapipe_face_pose_converter import MediaPipeFacePoseConverter
+from tha4.mocap.pose_converter_core import EyebrowDownMode, WinkMode, PoseConverterCore, compute_breathing_values, \
+    extract_euler_angles_from_matrices
 
-
-class EyebrowDownMode(Enum):
-    TROUBLED = 1
-    ANGRY = 2
-    LOWERED = 3
-    SERIOUS = 4
-
-
-class WinkMode(Enum):
-    NORMAL = 1
-    RELAXED = 2
+if TYPE_CHECKING:
+    import wx
 
 
 def rad_to_deg(rad):
@@ -139,57 +122,8 @@ class MediaPoseFacePoseConverter00(MediaPipeFacePoseConverter):
         if args is None:
             args = MediaPipeFacePoseConverter00Args()
         self.args = args
-        pose_parameters = get_pose_parameters()
-        self.pose_size = 45
-
-        self.eyebrow_troubled_left_index = pose_parameters.get_parameter_index("eyebrow_troubled_left")
-        self.eyebrow_troubled_right_index = pose_parameters.get_parameter_index("eyebrow_troubled_right")
-        self.eyebrow_angry_left_index = pose_parameters.get_parameter_index("eyebrow_angry_left")
-        self.eyebrow_angry_right_index = pose_parameters.get_parameter_index("eyebrow_angry_right")
-        self.eyebrow_happy_left_index = pose_parameters.get_parameter_index("eyebrow_happy_left")
-        self.eyebrow_happy_right_index = pose_parameters.get_parameter_index("eyebrow_happy_right")
-        self.eyebrow_raised_left_index = pose_parameters.get_parameter_index("eyebrow_raised_left")
-        self.eyebrow_raised_right_index = pose_parameters.get_parameter_index("eyebrow_raised_right")
-        self.eyebrow_lowered_left_index = pose_parameters.get_parameter_index("eyebrow_lowered_left")
-        self.eyebrow_lowered_right_index = pose_parameters.get_parameter_index("eyebrow_lowered_right")
-        self.eyebrow_serious_left_index = pose_parameters.get_parameter_index("eyebrow_serious_left")
-        self.eyebrow_serious_right_index = pose_parameters.get_parameter_index("eyebrow_serious_right")
-
-        self.eye_surprised_left_index = pose_parameters.get_parameter_index("eye_surprised_left")
-        self.eye_surprised_right_index = pose_parameters.get_parameter_index("eye_surprised_right")
-        self.eye_wink_left_index = pose_parameters.get_parameter_index("eye_wink_left")
-        self.eye_wink_right_index = pose_parameters.get_parameter_index("eye_wink_right")
-        self.eye_happy_wink_left_index = pose_parameters.get_parameter_index("eye_happy_wink_left")
-        self.eye_happy_wink_right_index = pose_parameters.get_parameter_index("eye_happy_wink_right")
-        self.eye_relaxed_left_index = pose_parameters.get_parameter_index("eye_relaxed_left")
-        self.eye_relaxed_right_index = pose_parameters.get_parameter_index("eye_relaxed_right")
-        self.eye_raised_lower_eyelid_left_index = pose_parameters.get_parameter_index("eye_raised_lower_eyelid_left")
-        self.eye_raised_lower_eyelid_right_index = pose_parameters.get_parameter_index("eye_raised_lower_eyelid_right")
-
-        self.iris_small_left_index = pose_parameters.get_parameter_index("iris_small_left")
-        self.iris_small_right_index = pose_parameters.get_parameter_index("iris_small_right")
-
-        self.iris_rotation_x_index = pose_parameters.get_parameter_index("iris_rotation_x")
-        self.iris_rotation_y_index = pose_parameters.get_parameter_index("iris_rotation_y")
-
-        self.head_x_index = pose_parameters.get_parameter_index("head_x")
-        self.head_y_index = pose_parameters.get_parameter_index("head_y")
-        self.neck_z_index = pose_parameters.get_parameter_index("neck_z")
-
-        self.mouth_aaa_index = pose_parameters.get_parameter_index("mouth_aaa")
-        self.mouth_iii_index = pose_parameters.get_parameter_index("mouth_iii")
-        self.mouth_uuu_index = pose_parameters.get_parameter_index("mouth_uuu")
-        self.mouth_eee_index = pose_parameters.get_parameter_index("mouth_eee")
-        self.mouth_ooo_index = pose_parameters.get_parameter_index("mouth_ooo")
-
-        self.mouth_lowered_corner_left_index = pose_parameters.get_parameter_index("mouth_lowered_corner_left")
-        self.mouth_lowered_corner_right_index = pose_parameters.get_parameter_index("mouth_lowered_corner_right")
-        self.mouth_raised_corner_left_index = pose_parameters.get_parameter_index("mouth_raised_corner_left")
-        self.mouth_raised_corner_right_index = pose_parameters.get_parameter_index("mouth_raised_corner_right")
-
-        self.body_y_index = pose_parameters.get_parameter_index("body_y")
-        self.body_z_index = pose_parameters.get_parameter_index("body_z")
-        self.breathing_index = pose_parameters.get_parameter_index("breathing")
+        self.core = PoseConverterCore(BLENDSHAPE_NAMES)
+        self.pose_size = self.core.pose_size
 
         self.breathing_start_time = time.time()
 
@@ -200,6 +134,8 @@ class MediaPoseFacePoseConverter00(MediaPipeFacePoseConverter):
             self,
             parent,
             current_pose_supplier: Callable[[], Optional[MediaPipeFacePose]]):
+        import wx
+
         self.panel = wx.Panel(parent, style=wx.SIMPLE_BORDER)
         self.panel_sizer = wx.BoxSizer(wx.VERTICAL)
         self.panel.SetSizer(self.panel_sizer)
@@ -350,6 +286,8 @@ class MediaPoseFacePoseConverter00(MediaPipeFacePoseConverter):
         self.panel_sizer.Fit(self.panel)
 
     def create_spin_control(self, parent, label: str, initial_value: float, set_func: Callable[[float], None]):
+        import wx
+
         sizer = parent.GetSizer()
 
         text = wx.StaticText(parent, label=label)
@@ -364,7 +302,7 @@ class MediaPoseFacePoseConverter00(MediaPipeFacePoseConverter):
             inc=0.01)
         sizer.Add(spin_ctrl, wx.SizerFlags().Border(wx.ALL, 2).Expand())
 
-        def handler(event: wx.Event):
+        def handler(event: 'wx.Event'):
             new_value = spin_ctrl.GetValue()
             set_func(new_value)
 
@@ -373,11 +311,9 @@ class MediaPoseFacePoseConverter00(MediaPipeFacePoseConverter):
         return spin_ctrl
 
     def extract_euler_angles(self, mediapipe_face_pose: MediaPipeFacePose):
-        M = mediapipe_face_pose.xform_matrix[0:3, 0:3]
-        rot = Rotation.from_matrix(M)
-        return rot.as_euler('xyz', degrees=False)
+        return extract_euler_angles_from_matrices(mediapipe_face_pose.xform_matrix)
 
-    def calibrate_face_orientation_clicked(self, event: wx.Event):
+    def calibrate_face_orientation_clicked(self, event: 'wx.Event'):
         if self.current_pose_supplier is None:
             return
 
@@ -390,10 +326,10 @@ class MediaPoseFacePoseConverter00(MediaPipeFacePoseConverter):
         self.args.head_y_offset = euler_angles[1]
         self.args.head_z_offset = euler_angles[2]
 
-    def restart_breathing_cycle_clicked(self, event: wx.Event):
+    def restart_breathing_cycle_clicked(self, event: 'wx.Event'):
         self.breathing_start_time = time.time()
 
-    def change_eyebrow_down_mode(self, event: wx.Event):
+    def change_eyebrow_down_mode(self, event: 'wx.Event'):
         selected_index = self.eyebrow_down_mode_choice.GetSelection()
         if selected_index == 0:
             self.args.eyebrow_down_mode = EyebrowDownMode.ANGRY
@@ -404,14 +340,14 @@ class MediaPoseFacePoseConverter00(MediaPipeFacePoseConverter):
         else:
             self.args.eyebrow_down_mode = EyebrowDownMode.LOWERED
 
-    def change_wink_mode(self, event: wx.Event):
+    def change_wink_mode(self, event: 'wx.Event'):
         selected_index = self.wink_mode_choice.GetSelection()
         if selected_index == 0:
             self.args.wink_mode = WinkMode.NORMAL
         else:
             self.args.wink_mode = WinkMode.RELAXED
 
-    def change_iris_size(self, event: wx.Event):
+    def change_iris_size(self, event: 'wx.Event'):
         if self.link_left_right_irises.GetValue():
             left_value = self.iris_left_slider.GetValue()
             right_value = self.iris_right_slider.GetValue()
@@ -423,7 +359,7 @@ class MediaPoseFacePoseConverter00(MediaPipeFacePoseConverter):
             self.args.iris_small_left = self.iris_left_slider.GetValue() / 1000.0
             self.args.iris_small_right = self.iris_right_slider.GetValue() / 1000.0
 
-    def link_left_right_irises_clicked(self, event: wx.Event):
+    def link_left_right_irises_clicked(self, event: 'wx.Event'):
         if self.link_left_right_irises.GetValue():
             self.iris_right_slider.Enable(False)
         else:
@@ -440,223 +376,30 @@ class MediaPoseFacePoseConverter00(MediaPipeFacePoseConverter):
                 sign = 1.0
             return (threshold * sign, (abs(param) - threshold) * sign)
 
-    def convert(self, mediapipe_face_pose: MediaPipeFacePose) -> List[float]:
-        pose = [0.0 for i in range(self.pose_size)]
-
-        blendshape_params = mediapipe_face_pose.blendshape_params
+    def get_breathing_values(self) -> Optional[numpy.ndarray]:
+        if self.panel is None:
+            return None
+        frequency = self.breathing_frequency_slider.GetValue()
+        if frequency == 0:
+            self.breathing_start_time = time.time()
+        breathing_values = compute_breathing_values(
+            numpy.array([time.time() - self.breathing_start_time]), frequency)
+        self.breathing_gauge.SetValue(int(1000 * breathing_values[0]))
+        return breathing_values
+
+    def get_head_rotations(self, xform_matrices: numpy.ndarray) -> numpy.ndarray:
+        euler_angles = extract_euler_angles_from_matrices(xform_matrices)
+        offsets = numpy.array([self.args.head_x_offset, self.args.head_y_offset, self.args.head_z_offset])
+        return euler_angles - offsets
 
-        smile_value = \
-            (blendshape_params[MOUTH_SMILE_LEFT] + blendshape_params[MOUTH_SMILE_RIGHT]) / 2.0 \
-            + blendshape_params[MOUTH_SHRUG_UPPER]
-        if self.args.smile_threshold_min >= self.args.smile_threshold_max:
-            smile_degree = 0.0
-        else:
-            if smile_value < self.args.smile_threshold_min:
-                smile_degree = 0.0
-            elif smile_value > self.args.smile_threshold_max:
-                smile_degree = 1.0
-            else:
-                smile_degree = (smile_value - self.args.smile_threshold_min) / (
-                        self.args.smile_threshold_max - self.args.smile_threshold_min)
-
-        # Eyebrow
-        if True:
-            brow_inner_up = blendshape_params[BROW_INNER_UP]
-            brow_outer_up_right = blendshape_params[BROW_OUTER_UP_RIGHT]
-            brow_outer_up_left = blendshape_params[BROW_OUTER_UP_LEFT]
-
-            brow_up_left = clamp(brow_inner_up + brow_outer_up_left, 0.0, 1.0)
-            brow_up_right = clamp(brow_inner_up + brow_outer_up_right, 0.0, 1.0)
-            pose[self.eyebrow_raised_left_index] = brow_up_left
-            pose[self.eyebrow_raised_right_index] = brow_up_right
-
-            if self.args.eyebrow_down_max <= 0.0:
-                brow_down_left = 0.0
-                brow_down_right = 0.0
-            else:
-                brow_down_left = (1.0 - smile_degree) \
-                                 * clamp(blendshape_params[BROW_DOWN_LEFT] / self.args.eyebrow_down_max, 0.0, 1.0)
-                brow_down_right = (1.0 - smile_degree) \
-                                  * clamp(blendshape_params[BROW_DOWN_RIGHT] / self.args.eyebrow_down_max, 0.0, 1.0)
-
-            if self.args.eyebrow_down_mode == EyebrowDownMode.TROUBLED:
-                pose[self.eyebrow_troubled_left_index] = brow_down_left
-                pose[self.eyebrow_troubled_right_index] = brow_down_right
-            elif self.args.eyebrow_down_mode == EyebrowDownMode.ANGRY:
-                pose[self.eyebrow_angry_left_index] = brow_down_left
-                pose[self.eyebrow_angry_right_index] = brow_down_right
-            elif self.args.eyebrow_down_mode == EyebrowDownMode.LOWERED:
-                pose[self.eyebrow_lowered_left_index] = brow_down_left
-                pose[self.eyebrow_lowered_right_index] = brow_down_right
-            elif self.args.eyebrow_down_mode == EyebrowDownMode.SERIOUS:
-                pose[self.eyebrow_serious_left_index] = brow_down_left
-                pose[self.eyebrow_serious_right_index] = brow_down_right
-
-            brow_happy_value = clamp(smile_value, 0.0, 1.0) * smile_degree
-            pose[self.eyebrow_happy_left_index] = brow_happy_value
-            pose[self.eyebrow_happy_right_index] = brow_happy_value
-
-        # Eye
-        if True:
-            # Surprised
-            if self.args.eye_surprised_max <= 0.0:
-                pose[self.eye_surprised_left_index] = 0.0
-                pose[self.eye_surprised_right_index] = 0.0
-            else:
-                pose[self.eye_surprised_left_index] = clamp(
-                    blendshape_params[EYE_WIDE_LEFT] / self.args.eye_surprised_max, 0.0, 1.0)
-                pose[self.eye_surprised_right_index] = clamp(
-                    blendshape_params[EYE_WIDE_RIGHT] / self.args.eye_surprised_max, 0.0, 1.0)
-
-            # Wink
-            if self.args.wink_mode == WinkMode.NORMAL:
-                wink_left_index = self.eye_wink_left_index
-                wink_right_index = self.eye_wink_right_index
-            else:
-                wink_left_index = self.eye_relaxed_left_index
-                wink_right_index = self.eye_relaxed_right_index
-            if self.args.eye_blink_max <= 0:
-                pose[wink_left_index] = 0.0
-                pose[wink_right_index] = 0.0
-                pose[self.eye_happy_wink_left_index] = 0.0
-                pose[self.eye_happy_wink_right_index] = 0.0
-            else:
-                pose[wink_left_index] = (1.0 - smile_degree) * clamp(
-                    blendshape_params[EYE_BLINK_LEFT] / self.args.eye_blink_max, 0.0, 1.0)
-                pose[wink_right_index] = (1.0 - smile_degree) * clamp(
-                    blendshape_params[EYE_BLINK_RIGHT] / self.args.eye_blink_max, 0.0, 1.0)
-                pose[self.eye_happy_wink_left_index] = smile_degree * clamp(
-                    blendshape_params[EYE_BLINK_LEFT] / self.args.eye_blink_max, 0.0, 1.0)
-                pose[self.eye_happy_wink_right_index] = smile_degree * clamp(
-                    blendshape_params[EYE_BLINK_RIGHT] / self.args.eye_blink_max, 0.0, 1.0)
-
-            # Lower eyelid
-            cheek_squint_denom = self.args.cheek_squint_max - self.args.cheek_squint_min
-            if cheek_squint_denom <= 0.0:
-                pose[self.eye_raised_lower_eyelid_left_index] = 0.0
-                pose[self.eye_raised_lower_eyelid_right_index] = 0.0
-            else:
-                pose[self.eye_raised_lower_eyelid_left_index] = \
-                    clamp(
-                        (blendshape_params[CHEEK_SQUINT_LEFT] - self.args.cheek_squint_min) / cheek_squint_denom,
-                        0.0, 1.0)
-                pose[self.eye_raised_lower_eyelid_right_index] = \
-                    clamp(
-                        (blendshape_params[CHEEK_SQUINT_RIGHT] - self.args.cheek_squint_min) / cheek_squint_denom,
-                        0.0, 1.0)
-
-        # Iris rotation
-        if True:
-            eye_rotation_y = (blendshape_params[EYE_LOOK_IN_LEFT]
-                              - blendshape_params[EYE_LOOK_OUT_LEFT]
-                              - blendshape_params[EYE_LOOK_IN_RIGHT]
-                              + blendshape_params[EYE_LOOK_OUT_RIGHT]) / 2.0 * self.args.eye_rotation_factor
-            pose[self.iris_rotation_y_index] = clamp(eye_rotation_y, -1.0, 1.0)
-
-            eye_rotation_x = (blendshape_params[EYE_LOOK_UP_LEFT]
-                              + blendshape_params[EYE_LOOK_UP_RIGHT]
-                              - blendshape_params[EYE_LOOK_DOWN_LEFT]
-                              - blendshape_params[EYE_LOOK_DOWN_RIGHT]) / 2.0 * self.args.eye_rotation_factor
-            pose[self.iris_rotation_x_index] = clamp(eye_rotation_x, -1.0, 1.0)
-
-        # Iris size
-        if True:
-            pose[self.iris_small_left_index] = self.args.iris_small_left
-            pose[self.iris_small_right_index] = self.args.iris_small_right
-
-        # Head rotation
-        if True:
-            euler_angles = self.extract_euler_angles(mediapipe_face_pose)
-            euler_angles[0] -= self.args.head_x_offset
-            euler_angles[1] -= self.args.head_y_offset
-            euler_angles[2] -= self.args.head_z_offset
-
-            x_param = clamp(-euler_angles[0] * 180.0 / math.pi, -15.0, 15.0) / 15.0
-            pose[self.head_x_index] = x_param
-
-            y_param = clamp(-euler_angles[1] * 180.0 / math.pi, -10.0, 10.0) / 10.0
-            pose[self.head_y_index] = y_param
-            pose[self.body_y_index] = y_param
-
-            z_param = clamp(euler_angles[2] * 180.0 / math.pi, -15.0, 15.0) / 15.0
-            pose[self.neck_z_index] = z_param
-            pose[self.body_z_index] = z_param
-
-        # Mouth
-        if True:
-            jaw_open_denom = self.args.jaw_open_max - self.args.jaw_open_min
-            if jaw_open_denom <= 0:
-                mouth_open = 0.0
-            else:
-                mouth_open = clamp((blendshape_params[JAW_OPEN] - self.args.jaw_open_min) / jaw_open_denom, 0.0, 1.0)
-            pose[self.mouth_aaa_index] = mouth_open
-            pose[self.mouth_raised_corner_left_index] = clamp(smile_value, 0.0, 1.0)
-            pose[self.mouth_raised_corner_right_index] = clamp(smile_value, 0.0, 1.0)
-
-            is_mouth_open = mouth_open > 0.0
-            if not is_mouth_open:
-                if self.args.mouth_frown_max <= 0:
-                    mouth_frown_value = 0.0
-                else:
-                    mouth_frown_value = clamp(
-                        (blendshape_params[MOUTH_FROWN_LEFT] + blendshape_params[
-                            MOUTH_FROWN_RIGHT]) / self.args.mouth_frown_max, 0.0, 1.0)
-                pose[self.mouth_lowered_corner_left_index] = mouth_frown_value
-                pose[self.mouth_lowered_corner_right_index] = mouth_frown_value
-            else:
-                mouth_lower_down = clamp(
-                    blendshape_params[MOUTH_LOWER_DOWN_LEFT] + blendshape_params[MOUTH_LOWER_DOWN_RIGHT], 0.0, 1.0)
-                mouth_funnel = blendshape_params[MOUTH_FUNNEL]
-                mouth_pucker = blendshape_params[MOUTH_PUCKER]
-
-                mouth_point = [mouth_open, mouth_lower_down, mouth_funnel, mouth_pucker]
-
-                aaa_point = [1.0, 1.0, 0.0, 0.0]
-                iii_point = [0.0, 1.0, 0.0, 0.0]
-                uuu_point = [0.5, 0.3, 0.25, 0.75]
-                ooo_point = [1.0, 0.5, 0.5, 0.4]
-
-                decomp = numpy.array([0, 0, 0, 0])
-                M = numpy.array([
-                    aaa_point,
-                    iii_point,
-                    uuu_point,
-                    ooo_point
-                ])
-
-                def loss(decomp):
-                    return numpy.linalg.norm(numpy.matmul(decomp, M) - mouth_point) \
-                        + 0.01 * numpy.linalg.norm(decomp, ord=1)
-
-                opt_result = scipy.optimize.minimize(
-                    loss, decomp, bounds=[(0.0, 1.0), (0.0, 1.0), (0.0, 1.0), (0.0, 1.0)])
-                decomp = opt_result["x"]
-                restricted_decomp = [decomp.item(0), decomp.item(1), decomp.item(2), decomp.item(3)]
-                pose[self.mouth_aaa_index] = restricted_decomp[0]
-                pose[self.mouth_iii_index] = restricted_decomp[1]
-                mouth_funnel_denom = self.args.mouth_funnel_max - self.args.mouth_funnel_min
-                if mouth_funnel_denom <= 0:
-                    ooo_alpha = 0.0
-                    uo_value = 0.0
-                else:
-                    ooo_alpha = clamp((mouth_funnel - self.args.mouth_funnel_min) / mouth_funnel_denom, 0.0, 1.0)
-                    uo_value = clamp(restricted_decomp[2] + restricted_decomp[3], 0.0, 1.0)
-                pose[self.mouth_uuu_index] = uo_value * (1.0 - ooo_alpha)
-                pose[self.mouth_ooo_index] = uo_value * ooo_alpha
-
-        if self.panel is not None:
-            frequency = self.breathing_frequency_slider.GetValue()
-            if frequency == 0:
-                value = 0.0
-                pose[self.breathing_index] = value
-                self.breathing_start_time = time.time()
-            else:
-                period = 60.0 / frequency
-                now = time.time()
-                diff = now - self.breathing_start_time
-                frac = (diff % period) / period
-                value = (-math.cos(2 * math.pi * frac) + 1.0) / 2.0
-                pose[self.breathing_index] = value
-            self.breathing_gauge.SetValue(int(1000 * value))
-
-        return pose
+    def convert(self, mediapipe_face_pose: MediaPipeFacePose) -> List[float]:
+        blendshapes = self.core.get_blendshape_array(mediapipe_face_pose.blendshape_params)
+        head_rotations = self.get_head_rotations(mediapipe_face_pose.xform_matrix[None, :, :])
+        pose = self.core.convert(self.args, blendshapes[None, :], head_rotations, self.get_breathing_values())
+        return pose[0].tolist()
+
+    def convert_batch(self,
+                      blendshapes: numpy.ndarray,
+                      xform_matrices: numpy.ndarray,
+                      breathing_values: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+        return self.core.convert(self.args, blendshapes, self.get_head_rotations(xform_matrices), breathing_values)
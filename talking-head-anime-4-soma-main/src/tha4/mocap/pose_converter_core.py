@@ -0,0 +1,330 @@
+import math
+from enum import Enum
+from typing import Optional, Dict, List
+
+import numpy
+
+from tha4.mocap.ifacialmocap_constants import MOUTH_SMILE_LEFT, MOUTH_SHRUG_UPPER, MOUTH_SMILE_RIGHT, \
+    BROW_INNER_UP, BROW_OUTER_UP_RIGHT, BROW_OUTER_UP_LEFT, BROW_DOWN_LEFT, BROW_DOWN_RIGHT, EYE_WIDE_LEFT, \
+    EYE_WIDE_RIGHT, EYE_BLINK_LEFT, EYE_BLINK_RIGHT, CHEEK_SQUINT_LEFT, CHEEK_SQUINT_RIGHT, EYE_LOOK_IN_LEFT, \
+    EYE_LOOK_OUT_LEFT, EYE_LOOK_IN_RIGHT, EYE_LOOK_OUT_RIGHT, EYE_LOOK_UP_LEFT, EYE_LOOK_UP_RIGHT, EYE_LOOK_DOWN_RIGHT, \
+    EYE_LOOK_DOWN_LEFT, JAW_OPEN, MOUTH_FROWN_LEFT, MOUTH_FROWN_RIGHT, MOUTH_LOWER_DOWN_LEFT, MOUTH_LOWER_DOWN_RIGHT, \
+    MOUTH_FUNNEL, MOUTH_PUCKER, BLENDSHAPE_NAMES
+from tha4.poser.modes.pose_parameters import get_pose_parameters
+
+
+class EyebrowDownMode(Enum):
+    TROUBLED = 1
+    ANGRY = 2
+    LOWERED = 3
+    SERIOUS = 4
+
+
+class WinkMode(Enum):
+    NORMAL = 1
+    RELAXED = 2
+
+
+# Rows are the (jaw open, lower lip down, funnel, pucker) signatures of the "aaa", "iii", "uuu", and "ooo" shapes.
+MOUTH_SHAPE_POINTS = [
+    [1.0, 1.0, 0.0, 0.0],
+    [0.0, 1.0, 0.0, 0.0],
+    [0.5, 0.3, 0.25, 0.75],
+    [1.0, 0.5, 0.5, 0.4],
+]
+
+
+def compute_breathing_values(elapsed_times: numpy.ndarray, frequency: float) -> numpy.ndarray:
+    elapsed_times = numpy.asarray(elapsed_times, dtype=numpy.float64)
+    if frequency == 0:
+        return numpy.zeros(elapsed_times.shape, dtype=numpy.float32)
+    period = 60.0 / frequency
+    frac = numpy.mod(elapsed_times, period) / period
+    return ((-numpy.cos(2 * math.pi * frac) + 1.0) / 2.0).astype(numpy.float32)
+
+
+def extract_euler_angles_from_matrices(xform_matrices: numpy.ndarray) -> numpy.ndarray:
+    from scipy.spatial.transform import Rotation
+
+    xform_matrices = numpy.asarray(xform_matrices, dtype=numpy.float64)
+    rot = Rotation.from_matrix(xform_matrices[..., 0:3, 0:3])
+    return rot.as_euler('xyz', degrees=False)
+
+
+class PoseConverterCore:
+    def __init__(self,
+                 blendshape_names: Optional[List[str]] = None,
+                 mouth_decomposition_l1_weight: float = 0.01,
+                 num_mouth_decomposition_iterations: int = 100,
+                 num_mouth_decomposition_reweightings: int = 5):
+        if blendshape_names is None:
+            blendshape_names = BLENDSHAPE_NAMES
+        assert num_mouth_decomposition_iterations >= 1
+        assert num_mouth_decomposition_reweightings >= 1
+        self.num_mouth_decomposition_reweightings = num_mouth_decomposition_reweightings
+        self.num_mouth_decomposition_iterations = num_mouth_decomposition_iterations
+        self.mouth_decomposition_l1_weight = mouth_decomposition_l1_weight
+        self.blendshape_names = list(blendshape_names)
+        self.blendshape_index = {name: i for i, name in enumerate(self.blendshape_names)}
+
+        self.mouth_shape_points = numpy.array(MOUTH_SHAPE_POINTS, dtype=numpy.float64)
+        self.mouth_decomposition_step_size = \
+            1.0 / (2.0 * numpy.linalg.norm(self.mouth_shape_points, ord=2) ** 2)
+
+        pose_parameters = get_pose_parameters()
+        self.pose_size = pose_parameters.get_parameter_count()
+
+        self.eyebrow_troubled_left_index = pose_parameters.get_parameter_index("eyebrow_troubled_left")
+        self.eyebrow_troubled_right_index = pose_parameters.get_parameter_index("eyebrow_troubled_right")
+        self.eyebrow_angry_left_index = pose_parameters.get_parameter_index("eyebrow_angry_left")
+        self.eyebrow_angry_right_index = pose_parameters.get_parameter_index("eyebrow_angry_right")
+        self.eyebrow_happy_left_index = pose_parameters.get_parameter_index("eyebrow_happy_left")
+        self.eyebrow_happy_right_index = pose_parameters.get_parameter_index("eyebrow_happy_right")
+        self.eyebrow_raised_left_index = pose_parameters.get_parameter_index("eyebrow_raised_left")
+        self.eyebrow_raised_right_index = pose_parameters.get_parameter_index("eyebrow_raised_right")
+        self.eyebrow_lowered_left_index = pose_parameters.get_parameter_index("eyebrow_lowered_left")
+        self.eyebrow_lowered_right_index = pose_parameters.get_parameter_index("eyebrow_lowered_right")
+        self.eyebrow_serious_left_index = pose_parameters.get_parameter_index("eyebrow_serious_left")
+        self.eyebrow_serious_right_index = pose_parameters.get_parameter_index("eyebrow_serious_right")
+
+        self.eye_surprised_left_index = pose_parameters.get_parameter_index("eye_surprised_left")
+        self.eye_surprised_right_index = pose_parameters.get_parameter_index("eye_surprised_right")
+        self.eye_wink_left_index = pose_parameters.get_parameter_index("eye_wink_left")
+        self.eye_wink_right_index = pose_parameters.get_parameter_index("eye_wink_right")
+        self.eye_happy_wink_left_index = pose_parameters.get_parameter_index("eye_happy_wink_left")
+        self.eye_happy_wink_right_index = pose_parameters.get_parameter_index("eye_happy_wink_right")
+        self.eye_relaxed_left_index = pose_parameters.get_parameter_index("eye_relaxed_left")
+        self.eye_relaxed_right_index = pose_parameters.get_parameter_index("eye_relaxed_right")
+        self.eye_raised_lower_eyelid_left_index = pose_parameters.get_parameter_index("eye_raised_lower_eyelid_left")
+        self.eye_raised_lower_eyelid_right_index = pose_parameters.get_parameter_index("eye_raised_lower_eyelid_right")
+
+        self.iris_small_left_index = pose_parameters.get_parameter_index("iris_small_left")
+        self.iris_small_right_index = pose_parameters.get_parameter_index("iris_small_right")
+
+        self.iris_rotation_x_index = pose_parameters.get_parameter_index("iris_rotation_x")
+        self.iris_rotation_y_index = pose_parameters.get_parameter_index("iris_rotation_y")
+
+        self.head_x_index = pose_parameters.get_parameter_index("head_x")
+        self.head_y_index = pose_parameters.get_parameter_index("head_y")
+        self.neck_z_index = pose_parameters.get_parameter_index("neck_z")
+
+        self.mouth_aaa_index = pose_parameters.get_parameter_index("mouth_aaa")
+        self.mouth_iii_index = pose_parameters.get_parameter_index("mouth_iii")
+        self.mouth_uuu_index = pose_parameters.get_parameter_index("mouth_uuu")
+        self.mouth_ooo_index = pose_parameters.get_parameter_index("mouth_ooo")
+
+        self.mouth_lowered_corner_left_index = pose_parameters.get_parameter_index("mouth_lowered_corner_left")
+        self.mouth_lowered_corner_right_index = pose_parameters.get_parameter_index("mouth_lowered_corner_right")
+        self.mouth_raised_corner_left_index = pose_parameters.get_parameter_index("mouth_raised_corner_left")
+        self.mouth_raised_corner_right_index = pose_parameters.get_parameter_index("mouth_raised_corner_right")
+
+        self.body_y_index = pose_parameters.get_parameter_index("body_y")
+        self.body_z_index = pose_parameters.get_parameter_index("body_z")
+        self.breathing_index = pose_parameters.get_parameter_index("breathing")
+
+    def get_blendshape_array(self, blendshape_params: Dict[str, float]) -> numpy.ndarray:
+        return numpy.array(
+            [blendshape_params.get(name, 0.0) for name in self.blendshape_names], dtype=numpy.float32)
+
+    def get_blendshape_arrays(self, blendshape_params_list: List[Dict[str, float]]) -> numpy.ndarray:
+        output = numpy.zeros((len(blendshape_params_list), len(self.blendshape_names)), dtype=numpy.float32)
+        for i, blendshape_params in enumerate(blendshape_params_list):
+            output[i] = self.get_blendshape_array(blendshape_params)
+        return output
+
+    def solve_mouth_least_squares(self,
+                                  mouth_points: numpy.ndarray,
+                                  l1_weights: numpy.ndarray,
+                                  initial_decomp: numpy.ndarray) -> numpy.ndarray:
+        # Minimizes |decomp M - point|^2 + l1_weight * |decomp|_1 over [0, 1]^4 for all frames at once with FISTA.
+        M = self.mouth_shape_points
+        MMt = numpy.matmul(M, M.T)
+        PMt = numpy.matmul(mouth_points, M.T)
+        decomp = initial_decomp
+        momentum_point = decomp
+        t = 1.0
+        for i in range(self.num_mouth_decomposition_iterations):
+            grad = 2.0 * (numpy.matmul(momentum_point, MMt) - PMt) + l1_weights
+            next_decomp = numpy.clip(momentum_point - self.mouth_decomposition_step_size * grad, 0.0, 1.0)
+            next_t = (1.0 + math.sqrt(1.0 + 4.0 * t * t)) / 2.0
+            momentum_point = next_decomp + ((t - 1.0) / next_t) * (next_decomp - decomp)
+            decomp = next_decomp
+            t = next_t
+        return decomp
+
+    def decompose_mouth_shapes(self, mouth_points: numpy.ndarray) -> numpy.ndarray:
+        # Minimizes |decomp M - point| + l1_weight * |decomp|_1 over [0, 1]^4, the objective of the old per-frame
+        # scipy.optimize.minimize call. Where the residual r is not zero, a minimizer of this objective is also a
+        # minimizer of the squared residual with the L1 weight scaled by 2|r|, so the squared problem is re-solved
+        # with the weight taken from the previous solution until the two agree.
+        mouth_points = numpy.asarray(mouth_points, dtype=numpy.float64)
+        decomp = numpy.zeros(mouth_points.shape, dtype=numpy.float64)
+        for i in range(self.num_mouth_decomposition_reweightings):
+            residual = numpy.matmul(decomp, self.mouth_shape_points) - mouth_points
+            l1_weights = 2.0 * self.mouth_decomposition_l1_weight * numpy.linalg.norm(residual, axis=1, keepdims=True)
+            decomp = self.solve_mouth_least_squares(mouth_points, l1_weights, decomp)
+        return decomp
+
+    def compute_mouth_decomposition_loss(self, mouth_points: numpy.ndarray, decomp: numpy.ndarray) -> numpy.ndarray:
+        residual = numpy.matmul(decomp, self.mouth_shape_points) - mouth_points
+        return numpy.linalg.norm(residual, axis=1) + self.mouth_decomposition_l1_weight * numpy.abs(decomp).sum(axis=1)
+
+    def convert(self,
+                args,
+                blendshapes: numpy.ndarray,
+                head_rotations: numpy.ndarray,
+                breathing_values: Optional[numpy.ndarray] = None) -> numpy.ndarray:
+        blendshapes = numpy.asarray(blendshapes, dtype=numpy.float64)
+        head_rotations = numpy.asarray(head_rotations, dtype=numpy.float64)
+        assert len(blendshapes.shape) == 2
+        assert blendshapes.shape[1] == len(self.blendshape_names)
+        assert head_rotations.shape == (blendshapes.shape[0], 3)
+        num_frames = blendshapes.shape[0]
+        pose = numpy.zeros((num_frames, self.pose_size), dtype=numpy.float64)
+
+        def column(name: str) -> numpy.ndarray:
+            return blendshapes[:, self.blendshape_index[name]]
+
+        smile_value = (column(MOUTH_SMILE_LEFT) + column(MOUTH_SMILE_RIGHT)) / 2.0 + column(MOUTH_SHRUG_UPPER)
+        if args.smile_threshold_min >= args.smile_threshold_max:
+            smile_degree = numpy.zeros(num_frames)
+        else:
+            smile_degree = numpy.clip(
+                (smile_value - args.smile_threshold_min) / (args.smile_threshold_max - args.smile_threshold_min),
+                0.0, 1.0)
+
+        # Eyebrow
+        if True:
+            brow_inner_up = column(BROW_INNER_UP)
+            pose[:, self.eyebrow_raised_left_index] = numpy.clip(brow_inner_up + column(BROW_OUTER_UP_LEFT), 0.0, 1.0)
+            pose[:, self.eyebrow_raised_right_index] = numpy.clip(
+                brow_inner_up + column(BROW_OUTER_UP_RIGHT), 0.0, 1.0)
+
+            if args.eyebrow_down_max > 0.0:
+                brow_down_left = (1.0 - smile_degree) \
+                                 * numpy.clip(column(BROW_DOWN_LEFT) / args.eyebrow_down_max, 0.0, 1.0)
+                brow_down_right = (1.0 - smile_degree) \
+                                  * numpy.clip(column(BROW_DOWN_RIGHT) / args.eyebrow_down_max, 0.0, 1.0)
+                if args.eyebrow_down_mode == EyebrowDownMode.TROUBLED:
+                    pose[:, self.eyebrow_troubled_left_index] = brow_down_left
+                    pose[:, self.eyebrow_troubled_right_index] = brow_down_right
+                elif args.eyebrow_down_mode == EyebrowDownMode.ANGRY:
+                    pose[:, self.eyebrow_angry_left_index] = brow_down_left
+                    pose[:, self.eyebrow_angry_right_index] = brow_down_right
+                elif args.eyebrow_down_mode == EyebrowDownMode.LOWERED:
+                    pose[:, self.eyebrow_lowered_left_index] = brow_down_left
+                    pose[:, self.eyebrow_lowered_right_index] = brow_down_right
+                elif args.eyebrow_down_mode == EyebrowDownMode.SERIOUS:
+                    pose[:, self.eyebrow_serious_left_index] = brow_down_left
+                    pose[:, self.eyebrow_serious_right_index] = brow_down_right
+
+            brow_happy_value = numpy.clip(smile_value, 0.0, 1.0) * smile_degree
+            pose[:, self.eyebrow_happy_left_index] = brow_happy_value
+            pose[:, self.eyebrow_happy_right_index] = brow_happy_value
+
+        # Eye
+        if True:
+            # Surprised
+            if args.eye_surprised_max > 0.0:
+                pose[:, self.eye_surprised_left_index] = numpy.clip(
+                    column(EYE_WIDE_LEFT) / args.eye_surprised_max, 0.0, 1.0)
+                pose[:, self.eye_surprised_right_index] = numpy.clip(
+                    column(EYE_WIDE_RIGHT) / args.eye_surprised_max, 0.0, 1.0)
+
+            # Wink
+            if args.wink_mode == WinkMode.NORMAL:
+                wink_left_index = self.eye_wink_left_index
+                wink_right_index = self.eye_wink_right_index
+            else:
+                wink_left_index = self.eye_relaxed_left_index
+                wink_right_index = self.eye_relaxed_right_index
+            if args.eye_blink_max > 0:
+                blink_left = numpy.clip(column(EYE_BLINK_LEFT) / args.eye_blink_max, 0.0, 1.0)
+                blink_right = numpy.clip(column(EYE_BLINK_RIGHT) / args.eye_blink_max, 0.0, 1.0)
+                pose[:, wink_left_index] = (1.0 - smile_degree) * blink_left
+                pose[:, wink_right_index] = (1.0 - smile_degree) * blink_right
+                pose[:, self.eye_happy_wink_left_index] = smile_degree * blink_left
+                pose[:, self.eye_happy_wink_right_index] = smile_degree * blink_right
+
+            # Lower eyelid
+            cheek_squint_denom = args.cheek_squint_max - args.cheek_squint_min
+            if cheek_squint_denom > 0.0:
+                pose[:, self.eye_raised_lower_eyelid_left_index] = numpy.clip(
+                    (column(CHEEK_SQUINT_LEFT) - args.cheek_squint_min) / cheek_squint_denom, 0.0, 1.0)
+                pose[:, self.eye_raised_lower_eyelid_right_index] = numpy.clip(
+                    (column(CHEEK_SQUINT_RIGHT) - args.cheek_squint_min) / cheek_squint_denom, 0.0, 1.0)
+
+        # Iris rotation
+        if True:
+            eye_rotation_y = (column(EYE_LOOK_IN_LEFT)
+                              - column(EYE_LOOK_OUT_LEFT)
+                              - column(EYE_LOOK_IN_RIGHT)
+                              + column(EYE_LOOK_OUT_RIGHT)) / 2.0 * args.eye_rotation_factor
+            pose[:, self.iris_rotation_y_index] = numpy.clip(eye_rotation_y, -1.0, 1.0)
+
+            eye_rotation_x = (column(EYE_LOOK_UP_LEFT)
+                              + column(EYE_LOOK_UP_RIGHT)
+                              - column(EYE_LOOK_DOWN_LEFT)
+                              - column(EYE_LOOK_DOWN_RIGHT)) / 2.0 * args.eye_rotation_factor
+            pose[:, self.iris_rotation_x_index] = numpy.clip(eye_rotation_x, -1.0, 1.0)
+
+        # Iris size
+        if True:
+            pose[:, self.iris_small_left_index] = args.iris_small_left
+            pose[:, self.iris_small_right_index] = args.iris_small_right
+
+        # Head rotation
+        if True:
+            head_rotations_deg = head_rotations * 180.0 / math.pi
+
+            x_param = numpy.clip(-head_rotations_deg[:, 0], -15.0, 15.0) / 15.0
+            pose[:, self.head_x_index] = x_param
+
+            y_param = numpy.clip(-head_rotations_deg[:, 1], -10.0, 10.0) / 10.0
+            pose[:, self.head_y_index] = y_param
+            pose[:, self.body_y_index] = y_param
+
+            z_param = numpy.clip(head_rotations_deg[:, 2], -15.0, 15.0) / 15.0
+            pose[:, self.neck_z_index] = z_param
+            pose[:, self.body_z_index] = z_param
+
+        # Mouth
+        if True:
+            jaw_open_denom = args.jaw_open_max - args.jaw_open_min
+            if jaw_open_denom <= 0:
+                mouth_open = numpy.zeros(num_frames)
+            else:
+                mouth_open = numpy.clip((column(JAW_OPEN) - args.jaw_open_min) / jaw_open_denom, 0.0, 1.0)
+            pose[:, self.mouth_aaa_index] = mouth_open
+            pose[:, self.mouth_raised_corner_left_index] = numpy.clip(smile_value, 0.0, 1.0)
+            pose[:, self.mouth_raised_corner_right_index] = numpy.clip(smile_value, 0.0, 1.0)
+
+            is_mouth_open = mouth_open > 0.0
+            is_mouth_closed = numpy.logical_not(is_mouth_open)
+            if args.mouth_frown_max > 0:
+                mouth_frown_value = numpy.clip(
+                    (column(MOUTH_FROWN_LEFT) + column(MOUTH_FROWN_RIGHT)) / args.mouth_frown_max, 0.0, 1.0)
+                pose[is_mouth_closed, self.mouth_lowered_corner_left_index] = mouth_frown_value[is_mouth_closed]
+                pose[is_mouth_closed, self.mouth_lowered_corner_right_index] = mouth_frown_value[is_mouth_closed]
+
+            if numpy.any(is_mouth_open):
+                mouth_lower_down = numpy.clip(column(MOUTH_LOWER_DOWN_LEFT) + column(MOUTH_LOWER_DOWN_RIGHT), 0.0, 1.0)
+                mouth_funnel = column(MOUTH_FUNNEL)
+                mouth_points = numpy.stack(
+                    [mouth_open, mouth_lower_down, mouth_funnel, column(MOUTH_PUCKER)], axis=1)[is_mouth_open]
+                decomp = self.decompose_mouth_shapes(mouth_points)
+                pose[is_mouth_open, self.mouth_aaa_index] = decomp[:, 0]
+                pose[is_mouth_open, self.mouth_iii_index] = decomp[:, 1]
+                mouth_funnel_denom = args.mouth_funnel_max - args.mouth_funnel_min
+                if mouth_funnel_denom > 0:
+                    ooo_alpha = numpy.clip(
+                        (mouth_funnel[is_mouth_open] - args.mouth_funnel_min) / mouth_funnel_denom, 0.0, 1.0)
+                    uo_value = numpy.clip(decomp[:, 2] + decomp[:, 3], 0.0, 1.0)
+                    pose[is_mouth_open, self.mouth_uuu_index] = uo_value * (1.0 - ooo_alpha)
+                    pose[is_mouth_open, self.mouth_ooo_index] = uo_value * ooo_alpha
+
+        # Breathing
+        if breathing_values is not None:
+            pose[:, self.breathing_index] = breathing_values
+
+        return pose.astype(numpy.float32)
@@ -0,0 +1,264 @@
+import math
+from enum import Enum
+from typing import Optional, Dict, List, Tuple
+
+import numpy
+
+from tha4.poser.modes.pose_parameters import get_pose_parameters
+from tha4.poser.poser import PoseParameterCategory, PoseParameters
+
+
+class PoseFilterType(Enum):
+    NONE = 0
+    ONE_EURO = 1
+    KALMAN = 2
+
+
+def one_euro_smoothing_factor(elapsed_time: float, cutoff):
+    r = 2.0 * math.pi * cutoff * elapsed_time
+    return r / (r + 1.0)
+
+
+class OneEuroFilter:
+    def __init__(self, min_cutoff: float = 1.0, beta: float = 0.0, derivative_cutoff: float = 1.0):
+        assert min_cutoff > 0.0
+        assert derivative_cutoff > 0.0
+        self.derivative_cutoff = derivative_cutoff
+        self.beta = beta
+        self.min_cutoff = min_cutoff
+        self.reset()
+
+    def reset(self):
+        self.last_value: Optional[numpy.ndarray] = None
+        self.last_derivative: Optional[numpy.ndarray] = None
+        self.last_timestamp: Optional[float] = None
+
+    def update(self, value: numpy.ndarray, timestamp: float) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        if self.last_value is None:
+            self.last_value = value.copy()
+            self.last_derivative = numpy.zeros_like(value)
+            self.last_timestamp = timestamp
+            return self.last_value, self.last_derivative
+
+        elapsed_time = max(timestamp - self.last_timestamp, 1e-6)
+        derivative = (value - self.last_value) / elapsed_time
+        derivative_alpha = one_euro_smoothing_factor(elapsed_time, self.derivative_cutoff)
+        self.last_derivative = derivative_alpha * derivative + (1.0 - derivative_alpha) * self.last_derivative
+
+        cutoff = self.min_cutoff + self.beta * numpy.abs(self.last_derivative)
+        alpha = one_euro_smoothing_factor(elapsed_time, cutoff)
+        self.last_value = alpha * value + (1.0 - alpha) * self.last_value
+        self.last_timestamp = timestamp
+        return self.last_value, self.last_derivative
+
+
+# A constant-velocity Kalman filter run independently on every element of the state vector.
+class KalmanFilter:
+    def __init__(self, process_noise: float = 50.0, measurement_noise: float = 1e-3):
+        assert process_noise > 0.0
+        assert measurement_noise > 0.0
+        self.measurement_noise = measurement_noise
+        self.process_noise = process_noise
+        self.reset()
+
+    def reset(self):
+        self.value: Optional[numpy.ndarray] = None
+        self.velocity: Optional[numpy.ndarray] = None
+        self.p00 = None
+        self.p01 = None
+        self.p11 = None
+        self.last_timestamp: Optional[float] = None
+
+    def update(self, value: numpy.ndarray, timestamp: float) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        if self.value is None:
+            self.value = value.copy()
+            self.velocity = numpy.zeros_like(value)
+            self.p00 = numpy.full_like(value, self.measurement_noise)
+            self.p01 = numpy.zeros_like(value)
+            self.p11 = numpy.full_like(value, 1.0)
+            self.last_timestamp = timestamp
+            return self.value, self.velocity
+
+        dt = max(timestamp - self.last_timestamp, 1e-6)
+        q = self.process_noise
+
+        # Predict
+        self.value = self.value + dt * self.velocity
+        self.p00 = self.p00 + 2.0 * dt * self.p01 + dt * dt * self.p11 + q * dt ** 3 / 3.0
+        self.p01 = self.p01 + dt * self.p11 + q * dt ** 2 / 2.0
+        self.p11 = self.p11 + q * dt
+
+        # Correct
+        s = self.p00 + self.measurement_noise
+        k0 = self.p00 / s
+        k1 = self.p01 / s
+        residual = value - self.value
+        self.value = self.value + k0 * residual
+        self.velocity = self.velocity + k1 * residual
+        self.p11 = self.p11 - k1 * self.p01
+        self.p01 = (1.0 - k0) * self.p01
+        self.p00 = (1.0 - k0) * self.p00
+
+        self.last_timestamp = timestamp
+        return self.value, self.velocity
+
+
+class PoseFilterGroupArgs:
+    def __init__(self,
+                 filter_type: Optional[PoseFilterType] = None,
+                 min_cutoff: float = 1.0,
+                 beta: float = 0.5,
+                 derivative_cutoff: float = 1.0,
+                 process_noise: float = 50.0,
+                 measurement_noise: float = 1e-3,
+                 predict: bool = False,
+                 dead_band: float = 0.005):
+        assert dead_band >= 0.0
+        self.dead_band = dead_band
+        self.predict = predict
+        self.measurement_noise = measurement_noise
+        self.process_noise = process_noise
+        self.derivative_cutoff = derivative_cutoff
+        self.beta = beta
+        self.min_cutoff = min_cutoff
+        self.filter_type = filter_type
+
+    def create_filter(self, default_filter_type: PoseFilterType):
+        filter_type = self.filter_type if self.filter_type is not None else default_filter_type
+        if filter_type == PoseFilterType.ONE_EURO:
+            return OneEuroFilter(self.min_cutoff, self.beta, self.derivative_cutoff)
+        elif filter_type == PoseFilterType.KALMAN:
+            return KalmanFilter(self.process_noise, self.measurement_noise)
+        else:
+            return None
+
+
+def get_default_pose_filter_group_args() -> Dict[PoseParameterCategory, PoseFilterGroupArgs]:
+    # Blinks and mouth shapes change too abruptly to be extrapolated, so only the rotations are predicted.
+    return {
+        PoseParameterCategory.EYEBROW: PoseFilterGroupArgs(min_cutoff=2.0, beta=0.5),
+        PoseParameterCategory.EYE: PoseFilterGroupArgs(min_cutoff=4.0, beta=1.0, process_noise=500.0),
+        PoseParameterCategory.IRIS_MORPH: PoseFilterGroupArgs(filter_type=PoseFilterType.NONE),
+        PoseParameterCategory.IRIS_ROTATION: PoseFilterGroupArgs(min_cutoff=1.5, beta=0.3),
+        PoseParameterCategory.MOUTH: PoseFilterGroupArgs(min_cutoff=3.0, beta=1.0, process_noise=500.0),
+        PoseParameterCategory.FACE_ROTATION: PoseFilterGroupArgs(min_cutoff=1.0, beta=0.5, predict=True),
+        PoseParameterCategory.BODY_ROTATION: PoseFilterGroupArgs(min_cutoff=1.0, beta=0.5, predict=True),
+        PoseParameterCategory.BREATHING: PoseFilterGroupArgs(filter_type=PoseFilterType.NONE, dead_band=0.0),
+    }
+
+
+class PoseFilterGroup:
+    def __init__(self, indices: numpy.ndarray, args: PoseFilterGroupArgs, default_filter_type: PoseFilterType):
+        self.indices = indices
+        self.args = args
+        self.filter = args.create_filter(default_filter_type)
+        self.value: Optional[numpy.ndarray] = None
+        self.velocity: Optional[numpy.ndarray] = None
+        self.last_timestamp: Optional[float] = None
+
+    def update(self, pose: numpy.ndarray, timestamp: float):
+        values = pose[self.indices]
+        if self.filter is None:
+            self.value = values
+            self.velocity = numpy.zeros_like(values)
+        elif self.last_timestamp is None or timestamp > self.last_timestamp:
+            self.value, self.velocity = self.filter.update(values, timestamp)
+        self.last_timestamp = timestamp
+
+    def get_output(self, prediction_horizon: float) -> numpy.ndarray:
+        if self.args.predict and prediction_horizon > 0.0:
+            return self.value + self.velocity * prediction_horizon
+        return self.value
+
+    def reset(self):
+        if self.filter is not None:
+            self.filter.reset()
+        self.value = None
+        self.velocity = None
+        self.last_timestamp = None
+
+
+class PosePredictionFilter:
+    def __init__(self,
+                 filter_type: PoseFilterType = PoseFilterType.ONE_EURO,
+                 group_args: Optional[Dict[PoseParameterCategory, PoseFilterGroupArgs]] = None,
+                 additional_latency: float = 0.0,
+                 max_prediction_horizon: float = 0.1,
+                 latency_smoothing: float = 0.1,
+                 pose_parameters: Optional[PoseParameters] = None):
+        if group_args is None:
+            group_args = get_default_pose_filter_group_args()
+        if pose_parameters is None:
+            pose_parameters = get_pose_parameters()
+        assert additional_latency >= 0.0
+        assert max_prediction_horizon >= 0.0
+        assert 0.0 < latency_smoothing <= 1.0
+        self.latency_smoothing = latency_smoothing
+        self.max_prediction_horizon = max_prediction_horizon
+        self.additional_latency = additional_latency
+        self.filter_type = filter_type
+
+        num_parameters = pose_parameters.get_parameter_count()
+        self.min_values = numpy.zeros(num_parameters)
+        self.max_values = numpy.zeros(num_parameters)
+        self.dead_bands = numpy.zeros(num_parameters)
+        indices_by_category: Dict[PoseParameterCategory, List[int]] = {}
+        for group in pose_parameters.get_pose_parameter_groups():
+            indices = list(range(group.get_parameter_index(), group.get_parameter_index() + group.get_arity()))
+            indices_by_category.setdefault(group.get_category(), []).extend(indices)
+            self.min_values[indices] = group.get_range()[0]
+            self.max_values[indices] = group.get_range()[1]
+            args = group_args.get(group.get_category(), PoseFilterGroupArgs(filter_type=PoseFilterType.NONE))
+            self.dead_bands[indices] = args.dead_band
+
+        self.groups = [
+            PoseFilterGroup(
+                numpy.array(indices, dtype=numpy.int64),
+                group_args.get(category, PoseFilterGroupArgs(filter_type=PoseFilterType.NONE)),
+                filter_type)
+            for category, indices in indices_by_category.items()
+        ]
+
+        self.render_latency: Optional[float] = None
+        self.last_output: Optional[numpy.ndarray] = None
+
+    def add_latency_sample(self, latency: float):
+        if self.render_latency is None:
+            self.render_latency = latency
+        else:
+            self.render_latency += self.latency_smoothing * (latency - self.render_latency)
+
+    def get_prediction_horizon(self, measurement_time: float, current_time: float) -> float:
+        render_latency = self.render_latency if self.render_latency is not None else 0.0
+        horizon = max(0.0, current_time - measurement_time) + render_latency + self.additional_latency
+        return min(horizon, self.max_prediction_horizon)
+
+    def filter(self, pose: List[float], measurement_time: float, current_time: Optional[float] = None) -> List[float]:
+        if current_time is None:
+            current_time = measurement_time
+        pose = numpy.asarray(pose, dtype=numpy.float64)
+        prediction_horizon = self.get_prediction_horizon(measurement_time, current_time)
+
+        output = numpy.zeros_like(pose)
+        for group in self.groups:
+            group.update(pose, measurement_time)
+            output[group.indices] = group.get_output(prediction_horizon)
+        output = numpy.clip(output, self.min_values, self.max_values)
+
+        if self.last_output is not None:
+            changed = numpy.abs(output - self.last_output) > self.dead_bands
+            output = numpy.where(changed, output, self.last_output)
+        self.last_output = output
+        return output.tolist()
+
+    def reset(self):
+        for group in self.groups:
+            group.reset()
+        self.last_output = None
+
+
+def create_pose_filter(filter_type_name: str, additional_latency: float = 0.0) -> Optional[PosePredictionFilter]:
+    filter_type = PoseFilterType[filter_type_name.upper()]
+    if filter_type == PoseFilterType.NONE:
+        return None
+    return PosePredictionFilter(filter_type, additional_latency=additional_latency)
@@ -0,0 +1,188 @@
+import json
+import os
+import time
+from typing import Dict, List, Optional, Iterator, Tuple
+
+import numpy
+
+from tha4.mocap.ifacialmocap_constants import BLENDSHAPE_NAMES as IFACIALMOCAP_BLENDSHAPE_NAMES, HEAD_BONE_ROTATIONS
+from tha4.mocap.mediapipe_constants import BLENDSHAPE_NAMES as MEDIAPIPE_BLENDSHAPE_NAMES
+from tha4.poser.modes.pose_parameters import get_pose_parameters
+
+STREAM_BLENDSHAPES = "blendshapes"
+STREAM_HEAD_ROTATIONS = "head_rotations"
+STREAM_XFORM_MATRIX = "xform_matrix"
+STREAM_POSE = "pose"
+
+XFORM_MATRIX_COLUMN_NAMES = ["m%d%d" % (i, j) for i in range(4) for j in range(4)]
+
+HEADER_FILE_NAME = "header.json"
+TIMESTAMPS_FILE_NAME = "timestamps.f64"
+
+
+def get_stream_file_name(directory: str, stream_name: str) -> str:
+    return os.path.join(directory, stream_name + ".f32")
+
+
+def get_pose_column_names() -> List[str]:
+    pose_parameters = get_pose_parameters()
+    return [pose_parameters.get_parameter_name(i) for i in range(pose_parameters.get_parameter_count())]
+
+
+class PoseRecordingWriter:
+    def __init__(self, directory: str, stream_column_names: Dict[str, List[str]], flush_interval: int = 64):
+        assert len(stream_column_names) >= 1
+        assert flush_interval >= 1
+        self.flush_interval = flush_interval
+        self.stream_column_names = {name: list(columns) for name, columns in stream_column_names.items()}
+        self.directory = directory
+
+        os.makedirs(directory, exist_ok=True)
+        header_file_name = os.path.join(directory, HEADER_FILE_NAME)
+        if os.path.exists(header_file_name):
+            with open(header_file_name, "rt") as fin:
+                header = json.load(fin)
+            if header["streams"] != self.stream_column_names:
+                raise RuntimeError(f"Recording {directory} already exists with different streams.")
+            self.truncate_to_complete_frames()
+        else:
+            with open(header_file_name, "wt") as fout:
+                json.dump({"version": 1, "streams": self.stream_column_names}, fout, indent=2)
+
+        self.timestamps_file = open(os.path.join(directory, TIMESTAMPS_FILE_NAME), "ab")
+        self.stream_files = {
+            name: open(get_stream_file_name(directory, name), "ab") for name in self.stream_column_names
+        }
+        self.num_frames_since_flush = 0
+
+    def truncate_to_complete_frames(self):
+        num_frames = get_num_complete_frames(self.directory, self.stream_column_names)
+        with open(os.path.join(self.directory, TIMESTAMPS_FILE_NAME), "ab") as fout:
+            fout.truncate(num_frames * 8)
+        for name, columns in self.stream_column_names.items():
+            with open(get_stream_file_name(self.directory, name), "ab") as fout:
+                fout.truncate(num_frames * len(columns) * 4)
+
+    def add(self, timestamp: float, frames: Dict[str, numpy.ndarray]):
+        rows = {}
+        for name, columns in self.stream_column_names.items():
+            if name not in frames:
+                raise RuntimeError(f"Stream {name} is missing from the recorded frame.")
+            row = numpy.ascontiguousarray(frames[name], dtype=numpy.float32).reshape(-1)
+            if row.shape[0] != len(columns):
+                raise RuntimeError(
+                    f"Stream {name} expects {len(columns)} values per frame but got {row.shape[0]}.")
+            rows[name] = row
+        for name, row in rows.items():
+            self.stream_files[name].write(row.tobytes())
+        self.timestamps_file.write(numpy.array([timestamp], dtype=numpy.float64).tobytes())
+
+        self.num_frames_since_flush += 1
+        if self.num_frames_since_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        for stream_file in self.stream_files.values():
+            stream_file.flush()
+        self.timestamps_file.flush()
+        self.num_frames_since_flush = 0
+
+    def close(self):
+        self.flush()
+        for stream_file in self.stream_files.values():
+            stream_file.close()
+        self.timestamps_file.close()
+
+
+def get_num_complete_frames(directory: str, stream_column_names: Dict[str, List[str]]) -> int:
+    timestamps_file_name = os.path.join(directory, TIMESTAMPS_FILE_NAME)
+    if not os.path.exists(timestamps_file_name):
+        return 0
+    num_frames = os.path.getsize(timestamps_file_name) // 8
+    for name, columns in stream_column_names.items():
+        file_name = get_stream_file_name(directory, name)
+        if not os.path.exists(file_name):
+            return 0
+        num_frames = min(num_frames, os.path.getsize(file_name) // (4 * len(columns)))
+    return num_frames
+
+
+class PoseRecording:
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, HEADER_FILE_NAME), "rt") as fin:
+            header = json.load(fin)
+        self.stream_column_names: Dict[str, List[str]] = header["streams"]
+        self.num_frames = get_num_complete_frames(directory, self.stream_column_names)
+
+        self.timestamps = self.map_file(os.path.join(directory, TIMESTAMPS_FILE_NAME), numpy.float64, 1)[:, 0]
+        self.streams = {
+            name: self.map_file(get_stream_file_name(directory, name), numpy.float32, len(columns))
+            for name, columns in self.stream_column_names.items()
+        }
+
+    def map_file(self, file_name: str, dtype, num_columns: int) -> numpy.ndarray:
+        if self.num_frames == 0:
+            return numpy.zeros((0, num_columns), dtype=dtype)
+        return numpy.memmap(file_name, dtype=dtype, mode='r', shape=(self.num_frames, num_columns))
+
+    def get_stream_names(self) -> List[str]:
+        return list(self.stream_column_names.keys())
+
+    def get_column_names(self, stream_name: str) -> List[str]:
+        return self.stream_column_names[stream_name]
+
+    def get_stream(self, stream_name: str) -> numpy.ndarray:
+        return self.streams[stream_name]
+
+    def get_frame(self, index: int) -> Dict[str, numpy.ndarray]:
+        return {name: stream[index] for name, stream in self.streams.items()}
+
+    def get_frame_index(self, timestamp: float) -> int:
+        index = int(numpy.searchsorted(self.timestamps, timestamp, side='right')) - 1
+        return max(0, min(self.num_frames - 1, index))
+
+    def get_duration(self) -> float:
+        if self.num_frames == 0:
+            return 0.0
+        return float(self.timestamps[-1] - self.timestamps[0])
+
+    def replay(self,
+               real_time: bool = True,
+               speed: float = 1.0,
+               start_index: int = 0,
+               end_index: Optional[int] = None) -> Iterator[Tuple[int, float, Dict[str, numpy.ndarray]]]:
+        assert speed > 0.0
+        if end_index is None:
+            end_index = self.num_frames
+        if start_index >= end_index:
+            return
+        first_timestamp = float(self.timestamps[start_index])
+        replay_start_time = time.perf_counter()
+        for index in range(start_index, end_index):
+            timestamp = float(self.timestamps[index])
+            if real_time:
+                wait_time = (timestamp - first_timestamp) / speed - (time.perf_counter() - replay_start_time)
+                if wait_time > 0:
+                    time.sleep(wait_time)
+            yield index, timestamp, self.get_frame(index)
+
+
+def create_ifacialmocap_recording_writer(directory: str, record_pose: bool = True) -> PoseRecordingWriter:
+    stream_column_names = {
+        STREAM_BLENDSHAPES: IFACIALMOCAP_BLENDSHAPE_NAMES,
+        STREAM_HEAD_ROTATIONS: HEAD_BONE_ROTATIONS,
+    }
+    if record_pose:
+        stream_column_names[STREAM_POSE] = get_pose_column_names()
+    return PoseRecordingWriter(directory, stream_column_names)
+
+
+def create_mediapipe_recording_writer(directory: str, record_pose: bool = True) -> PoseRecordingWriter:
+    stream_column_names = {
+        STREAM_BLENDSHAPES: MEDIAPIPE_BLENDSHAPE_NAMES,
+        STREAM_XFORM_MATRIX: XFORM_MATRIX_COLUMN_NAMES,
+    }
+    if record_pose:
+        stream_column_names[STREAM_POSE] = get_pose_column_names()
+    return PoseRecordingWriter(directory, stream_column_names)
@@ -4,12 +4,12 @@ from typing import List, Optional
 import torch
 from torch import Tensor
 from torch.nn import ModuleList, Sequential, Sigmoid, Tanh, Module
-from torch.nn.functional import affine_grid, grid_sample
 
 from tha4.shion.core.module_factory import ModuleFactory
 from tha4.nn.conv import create_conv3_block_from_block_args, \
     create_downsample_block_from_block_args, create_upsample_block_from_block_args, create_conv3_from_block_args, \
     create_conv3
+from tha4.nn.image_processing_util import GridChangeApplier
 from tha4.nn.nonlinearity_factory import LeakyReLUFactory
 from tha4.nn.normalization import InstanceNorm2dFactory
 from tha4.nn.resnet_block import ResnetBlock
@@ -101,6 +101,8 @@ class FaceMorpher08(Module):
         self.eye_color_change = self.create_color_change_block()
         self.eye_alpha = self.create_alpha_block()
 
+        self.grid_change_applier = GridChangeApplier()
+
     def create_alpha_block(self):
         return Sequential(
             create_conv3(
@@ -140,17 +142,7 @@ class FaceMorpher08(Module):
         return bottom_layer * (1 - top_layer_a) + torch.cat([top_layer_rgb * top_layer_a, top_layer_a], dim=1)
 
     def apply_grid_change(self, grid_change, image: Tensor) -> Tensor:
-        n, c, h, w = image.shape
-        device = grid_change.device
-        grid_change = torch.transpose(grid_change.view(n, 2, h * w), 1, 2).view(n, h, w, 2)
-        identity = torch.tensor(
-            [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
-            device=device,
-            dtype=grid_change.dtype).unsqueeze(0).repeat(n, 1, 1)
-        base_grid = affine_grid(identity, [n, c, h, w], align_corners=False)
-        grid = base_grid + grid_change
-        resampled_image = grid_sample(image, grid, mode='bilinear', padding_mode='border', align_corners=False)
-        return resampled_image
+        return self.grid_change_applier.apply(grid_change, image, align_corners=False)
 
     def apply_color_change(self, alpha, color_change, image: Tensor) -> Tensor:
         return color_change * alpha + image * (1 - alpha)
@@ -1,3 +1,7 @@
+import threading
+from collections import OrderedDict
+from typing import Tuple
+
 import torch
 from torch import Tensor
 from torch.nn.functional import affine_grid, grid_sample
@@ -10,48 +14,84 @@ def apply_rgb_change(alpha: Tensor, color_change: Tensor, image: Tensor):
     return torch.cat([output_rgb, image[:, 3:4, :, :]], dim=1)
 
 
-def apply_grid_change(grid_change, image: Tensor) -> Tensor:
-    n, c, h, w = image.shape
-    device = grid_change.device
-    grid_change = torch.transpose(grid_change.view(n, 2, h * w), 1, 2).view(n, h, w, 2)
-    identity = torch.tensor(
-        [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
-        dtype=grid_change.dtype,
-        device=device).unsqueeze(0).repeat(n, 1, 1)
-    base_grid = affine_grid(identity, [n, c, h, w], align_corners=False)
-    grid = base_grid + grid_change
-    resampled_image = grid_sample(image, grid, mode='bilinear', padding_mode='border', align_corners=False)
-    return resampled_image
+class GridChangeApplier:
+    def __init__(self, max_base_grids: int = 16):
+        assert max_base_grids >= 1
+        self.max_base_grids = max_base_grids
+        # Maps (h, w, dtype, device, align_corners) to a (1, h, w, 2) identity sampling grid, least recently used
+        # first. Threads share it, so it is only touched while holding base_grid_cache_lock.
+        self.base_grid_cache: OrderedDict[Tuple[int, int, torch.dtype, torch.device, bool], Tensor] = OrderedDict()
+        self.base_grid_cache_lock = threading.Lock()
+        # Grid buffers reused across calls that do not need gradients. They are per thread so that concurrent
+        # calls never write into a grid another call is still sampling with.
+        self.local = threading.local()
 
+    def __getstate__(self):
+        # Modules holding an applier get deep-copied and sent to other processes, which cannot take the lock and the
+        # thread-local buffers along. They are recreated on demand.
+        with self.base_grid_cache_lock:
+            return {
+                "max_base_grids": self.max_base_grids,
+                "base_grid_cache": list(self.base_grid_cache.items()),
+            }
 
-class GridChangeApplier:
-    def __init__(self):
-        self.last_n = None
-        self.last_device = None
-        self.last_identity = None
+    def __setstate__(self, state):
+        self.__init__(state["max_base_grids"])
+        self.base_grid_cache.update(state["base_grid_cache"])
+
+    def get_base_grid(self, h: int, w: int, dtype: torch.dtype, device: torch.device, align_corners: bool) -> Tensor:
+        key = (h, w, dtype, device, align_corners)
+        with self.base_grid_cache_lock:
+            base_grid = self.base_grid_cache.get(key, None)
+            if base_grid is not None:
+                self.base_grid_cache.move_to_end(key)
+                return base_grid
+        identity = torch.tensor(
+            [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
+            dtype=dtype,
+            device=device,
+            requires_grad=False).unsqueeze(0)
+        base_grid = affine_grid(identity, [1, 1, h, w], align_corners=align_corners)
+        with self.base_grid_cache_lock:
+            self.base_grid_cache[key] = base_grid
+            self.base_grid_cache.move_to_end(key)
+            while len(self.base_grid_cache) > self.max_base_grids:
+                self.base_grid_cache.popitem(last=False)
+        return base_grid
+
+    def get_grid_buffer(self, n: int, h: int, w: int, dtype: torch.dtype, device: torch.device) -> Tensor:
+        buffers = getattr(self.local, "grid_buffers", None)
+        if buffers is None:
+            buffers = {}
+            self.local.grid_buffers = buffers
+        key = (n, h, w, dtype, device)
+        buffer = buffers.get(key, None)
+        if buffer is None:
+            buffer = torch.empty(n, h, w, 2, dtype=dtype, device=device)
+            buffers[key] = buffer
+        return buffer
+
+    def get_grid(self, grid_change: Tensor, align_corners: bool = False, reuse_buffer: bool = False) -> Tensor:
+        n, _, h, w = grid_change.shape
+        base_grid = self.get_base_grid(h, w, grid_change.dtype, grid_change.device, align_corners)
+        grid_change = grid_change.permute(0, 2, 3, 1)
+        if not reuse_buffer:
+            return base_grid + grid_change
+        buffer = self.get_grid_buffer(n, h, w, grid_change.dtype, grid_change.device)
+        return torch.add(base_grid, grid_change, out=buffer)
 
     def apply(self, grid_change: Tensor, image: Tensor, align_corners: bool = False) -> Tensor:
-        n, c, h, w = image.shape
-        device = grid_change.device
-        grid_change = torch.transpose(grid_change.view(n, 2, h * w), 1, 2).view(n, h, w, 2)
-
-        if n == self.last_n and device == self.last_device:
-            identity = self.last_identity
-        else:
-            identity = torch.tensor(
-                [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
-                dtype=grid_change.dtype,
-                device=device,
-                requires_grad=False) \
-                .unsqueeze(0).repeat(n, 1, 1)
-            self.last_identity = identity
-            self.last_n = n
-            self.last_device = device
-        base_grid = affine_grid(identity, [n, c, h, w], align_corners=align_corners)
-
-        grid = base_grid + grid_change
-        resampled_image = grid_sample(image, grid, mode='bilinear', padding_mode='border', align_corners=align_corners)
-        return resampled_image
+        # Autograd keeps the grid for the backward pass, so the buffer is reused only when nothing needs gradients.
+        reuse_buffer = not torch.is_grad_enabled() or not (grid_change.requires_grad or image.requires_grad)
+        grid = self.get_grid(grid_change, align_corners, reuse_buffer)
+        return grid_sample(image, grid, mode='bilinear', padding_mode='border', align_corners=align_corners)
+
+
+default_grid_change_applier = GridChangeApplier()
+
+
+def apply_grid_change(grid_change, image: Tensor) -> Tensor:
+    return default_grid_change_applier.apply(grid_change, image)
 
 
 def apply_color_change(alpha, color_change, image: Tensor) -> Tensor:
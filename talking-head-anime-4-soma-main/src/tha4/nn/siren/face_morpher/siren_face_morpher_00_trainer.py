@@ -5,16 +5,19 @@ from tha4.shion.base.dataset.lazy_tensor_dataset import LazyTensorDataset
 from tha4.shion.base.image_util import extract_pytorch_image_from_filelike
 from tha4.shion.base.loss.l1_loss import L1Loss, MaskedL1Loss
 from tha4.shion.base.loss.sum_loss import SumLoss
-from tha4.shion.base.optimizer_factories import AdamOptimizerFactory
+from tha4.shion.core.module_accumulator import ModuleAccumulator
 from tha4.shion.core.training.distrib.distributed_trainer import DistributedTrainer
-from tha4.dataset.image_poses_and_aother_images_dataset import ImagePosesAndOtherImagesDataset
+from tha4.distiller.siren_student_trainer_args import SirenStudentTrainerArgs
+from tha4.dataset.image_poses_and_aother_images_dataset import ImagePosesAndOtherImagesDataset, \
+    PosesWithBroadcastImagesDataset
 from tha4.nn.siren.face_morpher.siren_face_morpher_00 import SirenFaceMorpher00Factory, SirenFaceMorpher00Args
 from tha4.nn.siren.face_morpher.siren_face_morpher_protocols_00 import SirenFaceMorpherComputationProtocol00, \
     SirenFaceMorpherSampleOutputProtocol00
-from tha4.nn.siren.morpher.siren_morpher_protocols_03 import SirenMorpherTrainingProtocol03
+from tha4.nn.siren.pixel_sampling import ImportancePixelSampler
 from tha4.nn.siren.vanilla.siren import SirenArgs
 from tha4.poser.poser import Poser
 from torch import Tensor
+from torch.utils.data import Dataset
 
 KEY_MODULE = "module"
 KEY_POSER = "poser"
@@ -26,7 +29,7 @@ def get_poser():
     return poser
 
 
-class SirenFaceMorpher00TrainerArgs:
+class SirenFaceMorpher00TrainerArgs(SirenStudentTrainerArgs):
     def __init__(self,
                  character_file_name: str,
                  face_mask_file_name: str,
@@ -41,7 +44,20 @@ class SirenFaceMorpher00TrainerArgs:
                  sample_output_random_seed: int = 3522651501,
                  total_worker: int = 16,
                  poser_func: Optional[Callable[[], Poser]] = None,
-                 base_learning_rate: float = 1e-4):
+                 base_learning_rate: float = 1e-4,
+                 pretrained_module_file_name: Optional[str] = None,
+                 broadcast_constant_images: bool = False,
+                 online_teacher_devices: Optional[List[str]] = None,
+                 online_teacher_batch_size: int = 32,
+                 online_teacher_num_slots: int = 4,
+                 num_pixel_samples: Optional[int] = None,
+                 adaptive_pose_sampling: bool = False,
+                 early_stopping_patience: Optional[int] = None,
+                 early_stopping_window_size: int = 10,
+                 early_stopping_min_relative_improvement: float = 0.01,
+                 num_training_examples_per_validation: int = 10_000,
+                 num_validation_examples: int = 256,
+                 module_accumulator: Optional[ModuleAccumulator] = None):
         assert num_training_total_examples % num_training_examples_per_checkpoint == 0
 
         if num_training_examples_lr_boundaries is None:
@@ -57,6 +73,34 @@ class SirenFaceMorpher00TrainerArgs:
         if poser_func is None:
             poser_func = get_poser
 
+        if online_teacher_devices is not None:
+            assert online_teacher_batch_size % total_batch_size == 0
+            assert not adaptive_pose_sampling
+
+        if num_pixel_samples is not None:
+            self.pixel_sampler = ImportancePixelSampler(image_size=128, num_samples=num_pixel_samples)
+        else:
+            self.pixel_sampler = None
+
+        if early_stopping_patience is not None:
+            assert early_stopping_patience >= 1
+        assert num_validation_examples >= 1
+
+        self.module_accumulator = module_accumulator
+        self.num_validation_examples = num_validation_examples
+        self.num_training_examples_per_validation = num_training_examples_per_validation
+        self.early_stopping_min_relative_improvement = early_stopping_min_relative_improvement
+        self.early_stopping_window_size = early_stopping_window_size
+        self.early_stopping_patience = early_stopping_patience
+        self.adaptive_pose_sampling = adaptive_pose_sampling
+        self.pose_sampler = None
+        self.pose_sampler_record_dir = None
+        self.num_pixel_samples = num_pixel_samples
+        self.online_teacher_num_slots = online_teacher_num_slots
+        self.online_teacher_batch_size = online_teacher_batch_size
+        self.online_teacher_devices = online_teacher_devices
+        self.broadcast_constant_images = broadcast_constant_images
+        self.pretrained_module_file_name = pretrained_module_file_name
         self.face_mask_file_name = face_mask_file_name
         self.base_learning_rate = base_learning_rate
         self.poser_func = poser_func
@@ -94,11 +138,24 @@ class SirenFaceMorpher00TrainerArgs:
             output_image[i, :, :] = loaded_image[0, center_y - 64:center_y + 64, center_x - 64:center_x + 64]
         return output_image
 
-    def get_training_dataset(self):
+    def get_training_dataset(self, return_pose_index: bool = False, pose_dataset: Optional[Dataset] = None):
+        if pose_dataset is None:
+            pose_dataset = LazyTensorDataset(self.pose_dataset_file_name)
         return ImagePosesAndOtherImagesDataset(
             main_image_func=self.get_character_image,
             other_image_funcs=[self.get_face_mask_image],
-            pose_dataset=LazyTensorDataset(self.pose_dataset_file_name))
+            pose_dataset=pose_dataset,
+            return_pose_index=return_pose_index)
+
+    def get_broadcast_training_dataset(self, return_pose_index: bool = False, pose_dataset: Optional[Dataset] = None):
+        if pose_dataset is None:
+            pose_dataset = LazyTensorDataset(self.pose_dataset_file_name)
+        return PosesWithBroadcastImagesDataset(
+            main_image_func=self.get_character_image,
+            other_image_funcs=[self.get_face_mask_image],
+            pose_dataset=pose_dataset,
+            expand_to_batch_size=True,
+            return_pose_index=return_pose_index)
 
     def get_module_factory(self):
         return SirenFaceMorpher00Factory(
@@ -129,7 +186,8 @@ class SirenFaceMorpher00TrainerArgs:
         return SirenFaceMorpherComputationProtocol00(
             transform_pose_to_module_input_func=self.transform_pose_to_module_input,
             transform_original_image_to_module_input_func=self.transform_original_image_to_module_input,
-            transform_poser_posed_image_to_groundtruth_func=self.transform_poser_posed_image_to_groundtruth)
+            transform_poser_posed_image_to_groundtruth_func=self.transform_poser_posed_image_to_groundtruth,
+            pixel_sampler=self.pixel_sampler)
 
     def get_learning_rate(self, examples_seen_so_far) -> Dict[str, float]:
         if examples_seen_so_far < self.num_training_examples_lr_boundaries[0]:
@@ -149,28 +207,18 @@ class SirenFaceMorpher00TrainerArgs:
                 KEY_MODULE: self.base_learning_rate / 30.0,
             }
 
-    def get_optimizer_factories(self):
-        return {
-            KEY_MODULE: AdamOptimizerFactory(betas=(0.9, 0.999)),
-        }
-
-    def get_poser(self):
-        return self.poser_func()
-
-    def get_training_protocol(self, world_size: int):
-        total_examples = self.num_training_total_examples
-        per_checkpoint_examples = self.num_training_examples_per_checkpoint
-        num_checkpoints = total_examples // per_checkpoint_examples
-        batch_size = self.total_batch_size // world_size
-        return SirenMorpherTrainingProtocol03(
-            check_point_examples=[per_checkpoint_examples * (i + 1) for i in range(num_checkpoints)],
-            batch_size=batch_size,
-            learning_rate=self.get_learning_rate,
-            optimizer_factories=self.get_optimizer_factories(),
-            random_seed=self.training_random_seed,
-            poser_func=self.get_poser,
-            key_module=KEY_MODULE,
-            key_poser=KEY_POSER)
+    def get_learning_rate_func(self):
+        return self.get_learning_rate
+
+    def get_online_teacher_output_indices(self) -> List[int]:
+        return [0]
+
+    def get_batch_pose_index_index(self) -> int:
+        # The face morpher batch is [image, pose, face_mask, pose_index].
+        return 3
+
+    def get_num_checkpoints(self) -> int:
+        return self.num_training_total_examples // self.num_training_examples_per_checkpoint
 
     def get_sample_output_protocol(self):
         return SirenFaceMorpherSampleOutputProtocol00(
@@ -184,6 +232,8 @@ class SirenFaceMorpher00TrainerArgs:
 
     def get_loss(self):
         protocol = self.get_training_computation_protocol()
+        if self.pixel_sampler is not None:
+            return self.get_sampled_loss(protocol)
         return SumLoss([
             (
                 'full',
@@ -202,27 +252,68 @@ class SirenFaceMorpher00TrainerArgs:
             ),
         ])
 
+    def get_sampled_loss(self, protocol: SirenFaceMorpherComputationProtocol00):
+        return SumLoss([
+            (
+                'full',
+                MaskedL1Loss(
+                    expected_func=protocol.get_output_func(protocol.keys.sampled_groundtruth_posed_image),
+                    actual_func=protocol.get_output_func(protocol.keys.sampled_predicted_posed_image),
+                    mask_func=protocol.get_output_func(protocol.keys.sampled_weight),
+                    weight=1.0)
+            ),
+            (
+                'eye_mouth',
+                MaskedL1Loss(
+                    expected_func=protocol.get_output_func(protocol.keys.sampled_groundtruth_posed_image),
+                    actual_func=protocol.get_output_func(protocol.keys.sampled_predicted_posed_image),
+                    mask_func=protocol.get_output_func(protocol.keys.sampled_eye_mouth_weight),
+                    weight=20.0)
+            ),
+        ])
+
     def create_trainer(self, prefix: str, world_size: int, distrib_backend: str = 'gloo'):
         if self.num_training_examples_per_sample_output is not None:
             sample_output_protocol = self.get_sample_output_protocol()
         else:
             sample_output_protocol = None
 
+        if self.broadcast_constant_images:
+            training_dataset = self.get_broadcast_training_dataset(
+                self.adaptive_pose_sampling, self.get_training_pose_dataset())
+            training_batch_func = training_dataset.attach_constant_images
+        else:
+            training_dataset = self.get_training_dataset(
+                self.adaptive_pose_sampling, self.get_training_pose_dataset())
+            training_batch_func = None
+
+        if self.adaptive_pose_sampling:
+            self.pose_sampler_record_dir = prefix + "/pose_sampler"
+            training_sampler_factory = self.create_pose_sampler
+        else:
+            training_sampler_factory = None
+
+        pretrained_module_file_names = {}
+        if self.pretrained_module_file_name is not None:
+            pretrained_module_file_names[KEY_MODULE] = self.pretrained_module_file_name
+
         return DistributedTrainer(
             prefix=prefix,
             module_factories={
                 KEY_MODULE: self.get_module_factory(),
             },
-            accumulators={},
+            accumulators=self.get_accumulators(),
             losses={
                 KEY_MODULE: self.get_loss(),
             },
-            training_dataset=self.get_training_dataset(),
+            training_dataset=training_dataset,
             validation_dataset=self.get_training_dataset(),
             training_protocol=self.get_training_protocol(world_size),
-            validation_protocol=None,
+            validation_protocol=self.get_validation_protocol(),
             sample_output_protocol=sample_output_protocol,
-            pretrained_module_file_names={},
+            pretrained_module_file_names=pretrained_module_file_names,
             example_per_snapshot=self.num_training_examples_per_snapshot,
             num_data_loader_workers=max(1, self.total_worker // world_size),
-            distrib_backend=distrib_backend)
+            distrib_backend=distrib_backend,
+            training_batch_func=training_batch_func,
+            training_sampler_factory=training_sampler_factory)
@@ -6,10 +6,12 @@ import PIL.Image
 import numpy
 import torch
 from tha4.shion.base.dataset.util import get_indexed_batch
-from tha4.shion.base.image_util import pytorch_rgba_to_numpy_image
+from tha4.sampleoutput.sample_output_writer import get_sample_output_writer
+from tha4.shion.base.image_util import numpy_linear_to_srgb
 from tha4.shion.core.cached_computation import CachedComputationProtocol, ComputationState, \
     ComposableCachedComputationProtocol, batch_indexing_func, add_step
 from tha4.shion.core.training.sample_output_protocol import SampleOutputProtocol
+from tha4.nn.siren.pixel_sampling import ImportancePixelSampler, get_foreground_weight
 from tha4.poser.general_poser_02 import GeneralPoser02
 from torch import Tensor
 from torch.nn import Module
@@ -38,6 +40,12 @@ class SirenMorpherProtocol00Keys:
 
     eye_mouth_mask: str = 'eye_mouth_mask'
 
+    pixel_sample: str = "pixel_sample"
+    sampled_weight: str = "sampled_weight"
+    sampled_groundtruth_posed_image: str = "sampled_groundtruth_posed_image"
+    sampled_predicted_posed_image: str = "sampled_predicted_posed_image"
+    sampled_eye_mouth_weight: str = "sampled_eye_mouth_weight"
+
 
 @dataclass
 class SirenMorpherProtocol00Indices:
@@ -53,7 +61,8 @@ class SirenFaceMorpherComputationProtocol00(ComposableCachedComputationProtocol)
                  transform_original_image_to_module_input_func: Callable[[Tensor], Tensor],
                  transform_poser_posed_image_to_groundtruth_func: Callable[[Tensor], Tensor],
                  keys: Optional[SirenMorpherProtocol00Keys] = None,
-                 indices: Optional[SirenMorpherProtocol00Indices] = None):
+                 indices: Optional[SirenMorpherProtocol00Indices] = None,
+                 pixel_sampler: Optional[ImportancePixelSampler] = None):
         super().__init__()
 
         if keys is None:
@@ -61,6 +70,7 @@ class SirenFaceMorpherComputationProtocol00(ComposableCachedComputationProtocol)
         if indices is None:
             indices = SirenMorpherProtocol00Indices()
 
+        self.pixel_sampler = pixel_sampler
         self.keys = keys
         self.indices = indices
         self.transform_image_to_module_input_func = transform_original_image_to_module_input_func
@@ -106,6 +116,59 @@ class SirenFaceMorpherComputationProtocol00(ComposableCachedComputationProtocol)
 
         self.computation_steps[keys.eye_mouth_mask] = batch_indexing_func(indices.batch_eye_mouth_mask)
 
+        if pixel_sampler is not None:
+            @add_step(self.computation_steps, keys.pixel_sample)
+            def get_pixel_sample(protocol: CachedComputationProtocol, state: ComputationState):
+                groundtruth_posed_image = protocol.get_output(keys.groundtruth_posed_image, state)
+                return pixel_sampler.sample(
+                    get_foreground_weight(groundtruth_posed_image),
+                    groundtruth_posed_image.shape[0],
+                    groundtruth_posed_image.device)
+
+            @add_step(self.computation_steps, keys.sampled_weight)
+            def get_sampled_weight(protocol: CachedComputationProtocol, state: ComputationState):
+                return protocol.get_output(keys.pixel_sample, state).get_weight()
+
+            @add_step(self.computation_steps, keys.sampled_groundtruth_posed_image)
+            def get_sampled_groundtruth_posed_image(protocol: CachedComputationProtocol, state: ComputationState):
+                pixel_sample = protocol.get_output(keys.pixel_sample, state)
+                return pixel_sample.gather(protocol.get_output(keys.groundtruth_posed_image, state))
+
+            @add_step(self.computation_steps, keys.sampled_predicted_posed_image)
+            def get_sampled_predicted_posed_image(protocol: CachedComputationProtocol, state: ComputationState):
+                module_input_pose = protocol.get_output(keys.module_input_pose, state)
+                pixel_sample = protocol.get_output(keys.pixel_sample, state)
+                module = state.modules[keys.module]
+                return module.forward(module_input_pose, pixel_sample.get_position(module_input_pose.dtype))
+
+            @add_step(self.computation_steps, keys.sampled_eye_mouth_weight)
+            def get_sampled_eye_mouth_weight(protocol: CachedComputationProtocol, state: ComputationState):
+                pixel_sample = protocol.get_output(keys.pixel_sample, state)
+                eye_mouth_mask = pixel_sample.gather(protocol.get_output(keys.eye_mouth_mask, state))
+                return eye_mouth_mask * pixel_sample.get_weight()
+
+
+def write_face_morpher_sample_output_image(cells: numpy.ndarray, images_per_row: int, file_name: str) -> str:
+    num_images, num_cells_per_image, image_channels, image_size, _ = cells.shape
+    num_rows = num_images // images_per_row
+    if num_images % images_per_row > 0:
+        num_rows += 1
+    padded_cells = numpy.zeros(
+        [num_rows * images_per_row, num_cells_per_image, image_size, image_size, image_channels], dtype=cells.dtype)
+    padded_cells[0:num_images] = (cells.transpose(0, 1, 3, 4, 2) + 1.0) / 2.0
+    padded_cells[..., 0:3] = numpy_linear_to_srgb(padded_cells[..., 0:3])
+    padded_cells[..., 3] = numpy.clip(padded_cells[..., 3], 0.0, 1.0)
+    num_cols = images_per_row * num_cells_per_image
+    output_image = padded_cells \
+        .reshape(num_rows, num_cols, image_size, image_size, image_channels) \
+        .transpose(0, 2, 1, 3, 4) \
+        .reshape(num_rows * image_size, num_cols * image_size, image_channels)
+
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    pil_image = PIL.Image.fromarray(numpy.uint8(numpy.rint(output_image * 255.0)), mode='RGBA')
+    pil_image.save(file_name)
+    return file_name
+
 
 class SirenFaceMorpherSampleOutputProtocol00(SampleOutputProtocol):
     def __init__(self,
@@ -192,29 +255,7 @@ class SirenFaceMorpherSampleOutputProtocol00(SampleOutputProtocol):
                 start = end
             poser_output_images = torch.cat(poser_output_images_list, dim=0)
 
-        num_rows = self.num_images // self.images_per_row
-        if self.num_images % self.images_per_row > 0:
-            num_rows += 1
-        num_cols = 2 * self.images_per_row
-
-        image_channels = 4
-        output_image = numpy.zeros([self.image_size * num_rows, self.image_size * num_cols, image_channels])
-
-        for image_index in range(self.num_images):
-            row = image_index // self.images_per_row
-            start_row = row * self.image_size
-
-            col = 2 * (image_index % self.images_per_row)
-            start_col = col * self.image_size
-            output_image[start_row:start_row + self.image_size, start_col:start_col + self.image_size, :] \
-                = pytorch_rgba_to_numpy_image(ground_truth[image_index].detach().cpu())
-
-            start_col += self.image_size
-            output_image[start_row:start_row + self.image_size, start_col:start_col + self.image_size, :] \
-                = pytorch_rgba_to_numpy_image(poser_output_images[image_index].detach().cpu())
-
+        cells = torch.stack([ground_truth.detach(), poser_output_images.detach()], dim=1).float().cpu().numpy()
         file_name = "%s/sample_output_%010d.png" % (prefix, examples_seen_so_far)
-        os.makedirs(os.path.dirname(file_name), exist_ok=True)
-        pil_image = PIL.Image.fromarray(numpy.uint8(numpy.rint(output_image * 255.0)), mode='RGBA')
-        pil_image.save(file_name)
-        print("Saved %s" % file_name)
+        get_sample_output_writer().submit(
+            write_face_morpher_sample_output_image, cells, self.images_per_row, file_name)
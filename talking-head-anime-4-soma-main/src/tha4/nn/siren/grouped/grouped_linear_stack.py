@@ -0,0 +1,110 @@
+from typing import Dict, Hashable, List, Tuple
+
+import torch
+from torch import Tensor
+from torch.nn import Conv2d
+
+
+class GroupedSlotSelection:
+    def __init__(self, slots: List[int], device: torch.device):
+        self.slots = slots
+        if slots == list(range(len(slots))):
+            self.index = None
+        else:
+            self.index = torch.tensor(slots, dtype=torch.long, device=device)
+
+    def __len__(self):
+        return len(self.slots)
+
+    def select(self, tensor: Tensor) -> Tensor:
+        if self.index is None:
+            return tensor.narrow(0, 0, len(self.slots))
+        else:
+            return tensor.index_select(0, self.index)
+
+
+class GroupedModelSlots:
+    def __init__(self, initial_capacity: int = 4):
+        assert initial_capacity >= 1
+        self.capacity = initial_capacity
+        self.key_to_slot: Dict[Hashable, int] = {}
+        self.free_slots = list(range(initial_capacity))
+
+    def has_key(self, key: Hashable) -> bool:
+        return key in self.key_to_slot
+
+    def get_keys(self) -> List[Hashable]:
+        return list(self.key_to_slot.keys())
+
+    def acquire(self, key: Hashable) -> Tuple[int, bool]:
+        if key in self.key_to_slot:
+            return self.key_to_slot[key], False
+        grown = False
+        if len(self.free_slots) == 0:
+            self.free_slots = list(range(self.capacity, 2 * self.capacity))
+            self.capacity = 2 * self.capacity
+            grown = True
+        slot = self.free_slots.pop(0)
+        self.key_to_slot[key] = slot
+        return slot, grown
+
+    def release(self, key: Hashable) -> int:
+        if key not in self.key_to_slot:
+            raise RuntimeError("Unknown model key: " + str(key))
+        slot = self.key_to_slot.pop(key)
+        self.free_slots.append(slot)
+        self.free_slots.sort()
+        return slot
+
+    def select(self, keys: List[Hashable], device: torch.device) -> GroupedSlotSelection:
+        slots = []
+        for key in keys:
+            if key not in self.key_to_slot:
+                raise RuntimeError("Unknown model key: " + str(key))
+            slots.append(self.key_to_slot[key])
+        return GroupedSlotSelection(slots, device)
+
+
+class GroupedLinearStack:
+    def __init__(self,
+                 in_channels: int,
+                 out_channels: int,
+                 capacity: int,
+                 device: torch.device,
+                 dtype: torch.dtype = torch.float):
+        self.dtype = dtype
+        self.device = device
+        self.out_channels = out_channels
+        self.in_channels = in_channels
+        self.weight = torch.zeros(capacity, in_channels, out_channels, device=device, dtype=dtype)
+        self.bias = torch.zeros(capacity, 1, out_channels, device=device, dtype=dtype)
+
+    def set_slot(self, slot: int, linear: Conv2d, scale: float = 1.0):
+        assert linear.weight.shape[0] == self.out_channels
+        assert linear.weight.shape[1] == self.in_channels
+        with torch.no_grad():
+            weight = linear.weight.detach().view(self.out_channels, self.in_channels)
+            self.weight[slot].copy_(weight.t() * scale)
+            self.bias[slot, 0].copy_(linear.bias.detach() * scale)
+
+    def clear_slot(self, slot: int):
+        self.weight[slot].zero_()
+        self.bias[slot].zero_()
+
+    def resize(self, capacity: int):
+        weight = torch.zeros(capacity, self.in_channels, self.out_channels, device=self.device, dtype=self.dtype)
+        bias = torch.zeros(capacity, 1, self.out_channels, device=self.device, dtype=self.dtype)
+        n = min(capacity, self.weight.shape[0])
+        weight[0:n].copy_(self.weight[0:n])
+        bias[0:n].copy_(self.bias[0:n])
+        self.weight = weight
+        self.bias = bias
+
+    def get(self, selection: GroupedSlotSelection) -> Tuple[Tensor, Tensor]:
+        return selection.select(self.weight), selection.select(self.bias)
+
+    def to(self, device: torch.device) -> 'GroupedLinearStack':
+        self.device = device
+        self.weight = self.weight.to(device)
+        self.bias = self.bias.to(device)
+        return self
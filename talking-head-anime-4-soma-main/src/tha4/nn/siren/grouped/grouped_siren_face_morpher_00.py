@@ -0,0 +1,80 @@
+from typing import Hashable, List
+
+import torch
+from torch import Tensor
+
+from tha4.nn.siren.face_morpher.siren_face_morpher_00 import SirenFaceMorpher00Args, SirenFaceMorpher00
+from tha4.nn.siren.grouped.grouped_linear_stack import GroupedModelSlots, GroupedLinearStack
+from tha4.nn.siren.row_util import PositionRowsCache, rows_to_image
+
+
+class GroupedSirenFaceMorpher00Executor:
+    def __init__(self,
+                 args: SirenFaceMorpher00Args,
+                 device: torch.device,
+                 initial_capacity: int = 4,
+                 dtype: torch.dtype = torch.float):
+        self.dtype = dtype
+        self.device = device
+        self.args = args
+
+        siren_args = args.siren_args
+        self.slots = GroupedModelSlots(initial_capacity)
+        self.sine_layer_stacks = [
+            GroupedLinearStack(siren_args.in_channels, siren_args.intermediate_channels, initial_capacity, device,
+                               dtype)
+        ]
+        for i in range(siren_args.num_sine_layers - 1):
+            self.sine_layer_stacks.append(
+                GroupedLinearStack(
+                    siren_args.intermediate_channels, siren_args.intermediate_channels, initial_capacity, device,
+                    dtype))
+        self.last_linear_stack = GroupedLinearStack(
+            siren_args.intermediate_channels, siren_args.out_channels, initial_capacity, device, dtype)
+        self.position_rows_cache = PositionRowsCache()
+
+    def get_stacks(self) -> List[GroupedLinearStack]:
+        return self.sine_layer_stacks + [self.last_linear_stack]
+
+    def add_model(self, key: Hashable, module: SirenFaceMorpher00):
+        slot, grown = self.slots.acquire(key)
+        if grown:
+            for stack in self.get_stacks():
+                stack.resize(self.slots.capacity)
+        for i, stack in enumerate(self.sine_layer_stacks):
+            layer = module.siren.sine_layers[i]
+            stack.set_slot(slot, layer.linear, layer.omega_0)
+        self.last_linear_stack.set_slot(slot, module.siren.last_linear)
+
+    def remove_model(self, key: Hashable):
+        slot = self.slots.release(key)
+        for stack in self.get_stacks():
+            stack.clear_slot(slot)
+
+    def has_model(self, key: Hashable) -> bool:
+        return self.slots.has_key(key)
+
+    def to(self, device: torch.device) -> 'GroupedSirenFaceMorpher00Executor':
+        self.device = device
+        for stack in self.get_stacks():
+            stack.to(device)
+        return self
+
+    def forward(self, keys: List[Hashable], pose: Tensor) -> Tensor:
+        assert len(keys) == pose.shape[0]
+        n, p = pose.shape[0], pose.shape[1]
+        image_size = self.args.image_size
+        selection = self.slots.select(keys, self.device)
+
+        position = self.position_rows_cache.get(image_size, self.dtype, self.device)
+        weight, bias = self.sine_layer_stacks[0].get(selection)
+        x = torch.matmul(position, weight[:, 0:2, :])
+        x.add_(torch.baddbmm(bias, pose.view(n, 1, p), weight[:, 2:, :]))
+        x.sin_()
+        for stack in self.sine_layer_stacks[1:]:
+            weight, bias = stack.get(selection)
+            x = torch.baddbmm(bias, x, weight).sin_()
+        weight, bias = self.last_linear_stack.get(selection)
+        x = torch.baddbmm(bias, x, weight)
+
+        return rows_to_image(x, image_size)
@@ -0,0 +1,124 @@
+from typing import Hashable, List
+
+import torch
+from torch import Tensor
+
+from tha4.nn.image_processing_util import GridChangeApplier
+from tha4.nn.siren.grouped.grouped_linear_stack import GroupedModelSlots, GroupedLinearStack
+from tha4.nn.siren.row_util import PositionRowsCache, rows_to_image, resize_rows
+from tha4.nn.siren.morpher.siren_morpher_03 import SirenMorpher03Args, SirenMorpher03
+
+
+class GroupedSirenMorpher03Executor:
+    def __init__(self,
+                 args: SirenMorpher03Args,
+                 device: torch.device,
+                 initial_capacity: int = 4,
+                 dtype: torch.dtype = torch.float):
+        self.dtype = dtype
+        self.device = device
+        self.args = args
+
+        self.slots = GroupedModelSlots(initial_capacity)
+        self.level_stacks = []
+        for i in range(len(args.level_args)):
+            level_args = args.level_args[i]
+            if i == 0:
+                in_channels = args.pose_size + 2
+            else:
+                in_channels = level_args.intermediate_channels + args.pose_size + 2
+            stacks = [
+                GroupedLinearStack(in_channels, level_args.intermediate_channels, initial_capacity, device, dtype)
+            ]
+            for j in range(1, level_args.num_sine_layers - 1):
+                stacks.append(GroupedLinearStack(
+                    level_args.intermediate_channels, level_args.intermediate_channels, initial_capacity, device,
+                    dtype))
+            if i == len(args.level_args) - 1:
+                out_channels = level_args.intermediate_channels
+            else:
+                out_channels = args.level_args[i + 1].intermediate_channels
+            stacks.append(GroupedLinearStack(
+                level_args.intermediate_channels, out_channels, initial_capacity, device, dtype))
+            self.level_stacks.append(stacks)
+        self.last_linear_stack = GroupedLinearStack(
+            args.level_args[-1].intermediate_channels, args.image_channels + 2 + 1, initial_capacity, device, dtype)
+
+        self.position_rows_cache = PositionRowsCache()
+        self.grid_change_applier = GridChangeApplier()
+
+    def get_stacks(self) -> List[GroupedLinearStack]:
+        stacks = []
+        for level_stacks in self.level_stacks:
+            stacks += level_stacks
+        return stacks + [self.last_linear_stack]
+
+    def add_model(self, key: Hashable, module: SirenMorpher03):
+        slot, grown = self.slots.acquire(key)
+        if grown:
+            for stack in self.get_stacks():
+                stack.resize(self.slots.capacity)
+        for i, stacks in enumerate(self.level_stacks):
+            for j, stack in enumerate(stacks):
+                layer = module.siren_layers[i][j]
+                stack.set_slot(slot, layer.linear, layer.omega_0)
+        self.last_linear_stack.set_slot(slot, module.last_linear)
+
+    def remove_model(self, key: Hashable):
+        slot = self.slots.release(key)
+        for stack in self.get_stacks():
+            stack.clear_slot(slot)
+
+    def has_model(self, key: Hashable) -> bool:
+        return self.slots.has_key(key)
+
+    def to(self, device: torch.device) -> 'GroupedSirenMorpher03Executor':
+        self.device = device
+        for stack in self.get_stacks():
+            stack.to(device)
+        return self
+
+    def forward(self, keys: List[Hashable], image: Tensor, pose: Tensor) -> List[Tensor]:
+        assert len(keys) == pose.shape[0]
+        assert len(keys) == image.shape[0]
+        n, p = pose.shape[0], pose.shape[1]
+        selection = self.slots.select(keys, self.device)
+        pose_rows = pose.view(n, 1, p)
+
+        x = None
+        previous_size = None
+        for i in range(len(self.args.level_args)):
+            image_size = self.args.level_args[i].image_size
+            position = self.position_rows_cache.get(image_size, self.dtype, self.device)
+            stacks = self.level_stacks[i]
+
+            weight, bias = stacks[0].get(selection)
+            c = 0 if x is None else x.shape[2]
+            y = torch.matmul(position, weight[:, c:c + 2, :])
+            if x is not None:
+                x = resize_rows(x, previous_size, image_size)
+                y.baddbmm_(x, weight[:, 0:c, :])
+            y.add_(torch.baddbmm(bias, pose_rows, weight[:, c + 2:, :]))
+            x = y.sin_()
+
+            for stack in stacks[1:]:
+                weight, bias = stack.get(selection)
+                x = torch.baddbmm(bias, x, weight).sin_()
+            previous_size = image_size
+
+        weight, bias = self.last_linear_stack.get(selection)
+        siren_output = rows_to_image(torch.baddbmm(bias, x, weight), previous_size)
+
+        grid_change = siren_output[:, 0:2, :, :]
+        alpha = siren_output[:, 2:3, :, :]
+        color_change = siren_output[:, 3:, :, :]
+        warped_image = self.grid_change_applier.apply(grid_change, image, align_corners=False)
+        blended_image = (1 - alpha) * warped_image + alpha * color_change
+
+        return [
+            blended_image,
+            alpha,
+            color_change,
+            warped_image,
+            grid_change
+        ]
@@ -0,0 +1,72 @@
+import argparse
+import time
+from typing import Callable
+
+import torch
+
+from tha4.poser.modes.mode_14 import load_face_morpher, load_body_morpher, SirenEngine
+
+
+def measure_time(func: Callable[[], None], num_iterations: int, num_warmup_iterations: int) -> float:
+    for i in range(num_warmup_iterations):
+        func()
+    start_time = time.perf_counter()
+    for i in range(num_iterations):
+        func()
+    return (time.perf_counter() - start_time) / num_iterations
+
+
+def benchmark(face_morpher_file_name, body_morpher_file_name, batch_size, num_iterations, num_warmup_iterations):
+    conv_face_morpher = load_face_morpher(face_morpher_file_name, SirenEngine.CONV).train(False)
+    matmul_face_morpher = load_face_morpher(None, SirenEngine.MATMUL).train(False)
+    matmul_face_morpher.load_state_dict(conv_face_morpher.state_dict())
+
+    conv_body_morpher = load_body_morpher(body_morpher_file_name, SirenEngine.CONV).train(False)
+    matmul_body_morpher = load_body_morpher(None, SirenEngine.MATMUL).train(False)
+    matmul_body_morpher.load_state_dict(conv_body_morpher.state_dict())
+
+    face_pose = torch.rand(batch_size, 39) * 2 - 1
+    pose = torch.rand(batch_size, 45) * 2 - 1
+    image = torch.rand(batch_size, 4, 512, 512) * 2 - 1
+
+    with torch.no_grad():
+        face_diff = (conv_face_morpher(face_pose) - matmul_face_morpher(face_pose)).abs().max().item()
+        conv_body_outputs = conv_body_morpher(image, pose)
+        matmul_body_outputs = matmul_body_morpher(image, pose)
+        body_diff = max(
+            (a - b).abs().max().item() for a, b in zip(conv_body_outputs, matmul_body_outputs))
+
+        conv_face_time = measure_time(
+            lambda: conv_face_morpher(face_pose), num_iterations, num_warmup_iterations)
+        matmul_face_time = measure_time(
+            lambda: matmul_face_morpher(face_pose), num_iterations, num_warmup_iterations)
+        conv_body_time = measure_time(
+            lambda: conv_body_morpher(image, pose), num_iterations, num_warmup_iterations)
+        matmul_body_time = measure_time(
+            lambda: matmul_body_morpher(image, pose), num_iterations, num_warmup_iterations)
+
+    print("threads: %d, batch size: %d" % (torch.get_num_threads(), batch_size))
+    print("face morpher: conv = %.2f ms, matmul = %.2f ms, speedup = %.2fx, max abs diff = %e" % (
+        conv_face_time * 1000, matmul_face_time * 1000, conv_face_time / matmul_face_time, face_diff))
+    print("body morpher: conv = %.2f ms, matmul = %.2f ms, speedup = %.2fx, max abs diff = %e" % (
+        conv_body_time * 1000, matmul_body_time * 1000, conv_body_time / matmul_body_time, body_diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the conv and matmul SIREN engines on the CPU.')
+    parser.add_argument('--face_morpher_file_name', type=str, default=None)
+    parser.add_argument('--body_morpher_file_name', type=str, default=None)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_iterations', type=int, default=10)
+    parser.add_argument('--num_warmup_iterations', type=int, default=2)
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    benchmark(
+        args.face_morpher_file_name,
+        args.body_morpher_file_name,
+        args.batch_size,
+        args.num_iterations,
+        args.num_warmup_iterations)
@@ -0,0 +1,31 @@
+from typing import Tuple, Optional
+
+import torch
+from torch import Tensor
+from torch.nn import Conv2d
+
+
+class FoldedLinearCache:
+    def __init__(self):
+        # (key, weight, bias), replaced as a whole so that concurrent callers never mix entries of different keys.
+        self.entry: Optional[Tuple[tuple, Tensor, Tensor]] = None
+
+    def get(self, linear: Conv2d, scale: float = 1.0) -> Tuple[Tensor, Tensor]:
+        weight, bias = linear.weight, linear.bias
+        out_channels, in_channels = weight.shape[0], weight.shape[1]
+        if torch.is_grad_enabled() and (weight.requires_grad or bias.requires_grad):
+            return (weight.view(out_channels, in_channels) * scale).t(), bias * scale
+        key = (weight.data_ptr(), weight._version, bias.data_ptr(), bias._version, weight.dtype, weight.device)
+        entry = self.entry
+        if entry is None or entry[0] != key:
+            with torch.no_grad():
+                entry = (key, (weight.view(out_channels, in_channels) * scale).t().contiguous(), bias * scale)
+            self.entry = entry
+        return entry[1], entry[2]
+
+
+def sin_rows(x: Tensor) -> Tensor:
+    if x.requires_grad:
+        return torch.sin(x)
+    else:
+        return x.sin_()
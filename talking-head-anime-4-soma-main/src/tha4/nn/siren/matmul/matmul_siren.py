@@ -0,0 +1,35 @@
+from typing import Tuple
+
+import torch
+from torch import Tensor
+
+from tha4.nn.siren.matmul.folded_linear import FoldedLinearCache, sin_rows
+from tha4.nn.siren.vanilla.siren import Siren, SirenArgs
+
+
+class MatmulSiren(Siren):
+    def __init__(self, args: SirenArgs):
+        super().__init__(args)
+        self.folded_sine_layers = [FoldedLinearCache() for _ in range(args.num_sine_layers)]
+        self.folded_last_linear = FoldedLinearCache()
+
+    def get_folded_sine_layer(self, index: int) -> Tuple[Tensor, Tensor]:
+        layer = self.sine_layers[index]
+        return self.folded_sine_layers[index].get(layer.linear, layer.omega_0)
+
+    def forward_rows(self, x: Tensor, start_layer_index: int = 0) -> Tensor:
+        for i in range(start_layer_index, self.args.num_sine_layers):
+            weight, bias = self.get_folded_sine_layer(i)
+            x = sin_rows(torch.addmm(bias, x, weight))
+        weight, bias = self.folded_last_linear.get(self.last_linear)
+        x = torch.addmm(bias, x, weight)
+        if self.args.use_tanh:
+            return torch.tanh(x)
+        else:
+            return x
+
+    def forward(self, x: Tensor) -> Tensor:
+        n, c, h, w = x.shape
+        x = x.permute(0, 2, 3, 1).reshape(n * h * w, c)
+        x = self.forward_rows(x)
+        return x.view(n, h, w, x.shape[1]).permute(0, 3, 1, 2).contiguous()
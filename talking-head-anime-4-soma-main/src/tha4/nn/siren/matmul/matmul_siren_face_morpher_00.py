@@ -0,0 +1,34 @@
+from typing import Optional
+
+import torch
+from torch import Tensor
+
+from tha4.nn.siren.face_morpher.siren_face_morpher_00 import SirenFaceMorpher00, SirenFaceMorpher00Args
+from tha4.nn.siren.matmul.folded_linear import sin_rows
+from tha4.nn.siren.matmul.matmul_siren import MatmulSiren
+from tha4.nn.siren.row_util import PositionRowsCache
+
+
+class MatmulSirenFaceMorpher00(SirenFaceMorpher00):
+    def __init__(self, args: SirenFaceMorpher00Args):
+        super().__init__(args)
+        self.siren = MatmulSiren(self.args.siren_args)
+        self.position_rows_cache = PositionRowsCache()
+
+    def forward(self, pose: Tensor, position: Optional[Tensor] = None) -> Tensor:
+        n = pose.shape[0]
+
+        if position is None:
+            h, w = self.args.image_size, self.args.image_size
+            position_rows = self.position_rows_cache.get(h, pose.dtype, pose.device)
+        else:
+            h, w = position.shape[2], position.shape[3]
+            position_rows = position.permute(0, 2, 3, 1).reshape(n, h * w, 2)
+
+        weight, bias = self.siren.get_folded_sine_layer(0)
+        pose_term = torch.addmm(bias, pose, weight[2:, :]).view(n, 1, weight.shape[1])
+        x = torch.matmul(position_rows, weight[0:2, :]) + pose_term
+        x = sin_rows(x.view(n * h * w, weight.shape[1]))
+        x = self.siren.forward_rows(x, start_layer_index=1)
+
+        return x.view(n, h, w, x.shape[1]).permute(0, 3, 1, 2).contiguous()
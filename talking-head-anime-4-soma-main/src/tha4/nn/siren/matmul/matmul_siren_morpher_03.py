@@ -0,0 +1,51 @@
+from typing import List, Tuple
+
+import torch
+from torch import Tensor
+
+from tha4.nn.siren.matmul.folded_linear import FoldedLinearCache, sin_rows
+from tha4.nn.siren.row_util import PositionRowsCache, resize_rows, rows_to_image
+from tha4.nn.siren.morpher.siren_morpher_03 import SirenMorpher03, SirenMorpher03Args
+
+
+class MatmulSirenMorpher03(SirenMorpher03):
+    def __init__(self, args: SirenMorpher03Args):
+        super().__init__(args)
+        self.folded_siren_layers = [[FoldedLinearCache() for _ in level] for level in self.siren_layers]
+        self.folded_last_linear = FoldedLinearCache()
+        self.position_rows_cache = PositionRowsCache()
+
+    def get_folded_layer(self, level_index: int, layer_index: int) -> Tuple[Tensor, Tensor]:
+        layer = self.siren_layers[level_index][layer_index]
+        return self.folded_siren_layers[level_index][layer_index].get(layer.linear, layer.omega_0)
+
+    def forward(self, image: Tensor, pose: Tensor) -> List[Tensor]:
+        n = pose.shape[0]
+
+        x = None
+        previous_size = None
+        for i in range(len(self.args.level_args)):
+            image_size = self.args.level_args[i].image_size
+            num_pixels = image_size * image_size
+            position = self.position_rows_cache.get(image_size, pose.dtype, pose.device)
+
+            weight, bias = self.get_folded_layer(i, 0)
+            c = 0 if x is None else x.shape[1]
+            out_channels = weight.shape[1]
+            pose_term = torch.addmm(bias, pose, weight[c + 2:, :]).view(n, 1, out_channels)
+            y = (torch.matmul(position, weight[c:c + 2, :]) + pose_term).view(n * num_pixels, out_channels)
+            if x is not None:
+                x = resize_rows(x.view(n, previous_size * previous_size, c), previous_size, image_size)
+                y = y.addmm_(x.view(n * num_pixels, c), weight[0:c, :])
+            x = sin_rows(y)
+
+            for j in range(1, len(self.siren_layers[i])):
+                weight, bias = self.get_folded_layer(i, j)
+                x = sin_rows(torch.addmm(bias, x, weight))
+            previous_size = image_size
+
+        weight, bias = self.folded_last_linear.get(self.last_linear)
+        x = torch.addmm(bias, x, weight)
+        siren_output = rows_to_image(x.view(n, previous_size * previous_size, x.shape[1]), previous_size)
+
+        return self.apply_siren_output(image, siren_output)
@@ -3,11 +3,12 @@ from typing import List, Optional, Callable
 import torch
 from torch import Tensor
 from torch.nn import Module, ModuleList, Sequential, Conv2d
-from torch.nn.functional import affine_grid, interpolate
+from torch.nn.functional import affine_grid, interpolate, grid_sample
 
 from tha4.shion.core.module_factory import ModuleFactory
 from tha4.shion.nn00.initialization_funcs import HeInitialization
 from tha4.nn.image_processing_util import GridChangeApplier
+from tha4.nn.siren.pixel_sampling import get_bilinear_neighbors
 from tha4.nn.siren.vanilla.siren import SineLinearLayer
 
 
@@ -123,7 +124,63 @@ class SirenMorpher03(Module):
                 x = self.siren_layers[i].forward(x)
 
         siren_output = self.last_linear(x)
+        return self.apply_siren_output(image, siren_output)
 
+    def forward_sampled(self, image: Tensor, pose: Tensor, position: Tensor) -> List[Tensor]:
+        n, p, k = pose.shape[0], pose.shape[1], position.shape[3]
+        device = pose.device
+        num_levels = len(self.args.level_args)
+
+        level_positions = [None for i in range(num_levels)]
+        level_neighbors = [None for i in range(num_levels)]
+        level_positions[-1] = position.reshape(n, 2, k).transpose(1, 2)
+        for i in range(num_levels - 1, 0, -1):
+            indices, weights, neighbor_position = get_bilinear_neighbors(
+                level_positions[i], self.args.level_args[i - 1].image_size)
+            level_neighbors[i] = (indices, weights)
+            if i > 1:
+                level_positions[i - 1] = neighbor_position
+
+        x = None
+        for i in range(num_levels):
+            args = self.args.level_args[i]
+            if i == 0:
+                position_and_pose = torch.cat([
+                    self.get_position_grid(n, args.image_size, device),
+                    self.get_pose_image(pose, args.image_size)
+                ], dim=1)
+                x = self.siren_layers[i].forward(position_and_pose)
+                x = x.view(n, x.shape[1], args.image_size * args.image_size)
+            else:
+                indices, weights = level_neighbors[i]
+                m, c = indices.shape[1], x.shape[1]
+                if i == 1:
+                    x = x.gather(2, indices.view(n, 1, 4 * m).expand(n, c, 4 * m))
+                x = (x.view(n, c, m, 4) * weights.view(n, 1, m, 4)).sum(dim=3)
+                x = torch.cat([
+                    x,
+                    level_positions[i].transpose(1, 2),
+                    pose.view(n, p, 1).expand(n, p, m)
+                ], dim=1)
+                x = self.siren_layers[i].forward(x.unsqueeze(2)).squeeze(2)
+
+        siren_output = self.last_linear(x.unsqueeze(2))
+        grid_change = siren_output[:, 0:2, :, :]
+        alpha = siren_output[:, 2:3, :, :]
+        color_change = siren_output[:, 3:, :, :]
+        grid = (position + grid_change).permute(0, 2, 3, 1)
+        warped_image = grid_sample(image, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        blended_image = (1 - alpha) * warped_image + alpha * color_change
+
+        return [
+            blended_image,
+            alpha,
+            color_change,
+            warped_image,
+            grid_change
+        ]
+
+    def apply_siren_output(self, image: Tensor, siren_output: Tensor) -> List[Tensor]:
         grid_change = siren_output[:, 0:2, :, :]
         alpha = siren_output[:, 2:3, :, :]
         color_change = siren_output[:, 3:, :, :]
@@ -4,17 +4,20 @@ from typing import Dict, List, Optional, Callable
 import torch
 from tha4.shion.base.dataset.lazy_tensor_dataset import LazyTensorDataset
 from tha4.shion.base.image_util import extract_pytorch_image_from_filelike
-from tha4.shion.base.loss.l1_loss import L1Loss
+from tha4.shion.base.loss.l1_loss import L1Loss, MaskedL1Loss
 from tha4.shion.base.loss.sum_loss import SumLoss
 from tha4.shion.base.loss.time_dependently_weighted_loss import TimeDependentlyWeightedLoss
-from tha4.shion.base.optimizer_factories import AdamOptimizerFactory
+from tha4.shion.core.module_accumulator import ModuleAccumulator
 from tha4.shion.core.training.distrib.distributed_trainer import DistributedTrainer
-from tha4.dataset.image_poses_and_aother_images_dataset import ImagePosesAndOtherImagesDataset
+from tha4.distiller.siren_student_trainer_args import SirenStudentTrainerArgs
+from tha4.dataset.image_poses_and_aother_images_dataset import ImagePosesAndOtherImagesDataset, \
+    PosesWithBroadcastImagesDataset
+from tha4.nn.siren.pixel_sampling import ImportancePixelSampler
 from tha4.nn.siren.morpher.siren_morpher_03 import SirenMorpherLevelArgs, SirenMorpher03Factory, SirenMorpher03Args
 from tha4.nn.siren.morpher.siren_morpher_protocols_03 import SirenMorpherComputationProtocol03, \
-    SirenMorpherProtocol03Indices, KEY_MODULE, KEY_POSER, KEY_EXAMPLES_SEEN_SO_FAR, SirenMorpherTrainingProtocol03, \
-    SirenMorpherSampleOutputProtocol
+    SirenMorpherProtocol03Indices, KEY_MODULE, KEY_EXAMPLES_SEEN_SO_FAR, SirenMorpherSampleOutputProtocol
 from tha4.poser.poser import Poser
+from torch.utils.data import Dataset
 
 
 def get_poser():
@@ -30,6 +33,8 @@ class LossTerm(Enum):
     full_color_change = 4
 
     def get_loss(self, protocol: SirenMorpherComputationProtocol03):
+        if protocol.pixel_sampler is not None:
+            return self.get_sampled_loss(protocol)
         if self == LossTerm.full_blended:
             return L1Loss(
                 expected_func=protocol.get_output_func(protocol.keys.groundtruth_posed_image),
@@ -49,6 +54,23 @@ class LossTerm(Enum):
         else:
             raise RuntimeError(f"Unsupported loss term {self}")
 
+    def get_sampled_loss(self, protocol: SirenMorpherComputationProtocol03):
+        keys = protocol.keys
+        if self == LossTerm.full_blended:
+            expected_key, actual_key = keys.sampled_groundtruth_posed_image, keys.sampled_predicted_posed_image
+        elif self == LossTerm.full_warped:
+            expected_key, actual_key = keys.sampled_groundtruth_warped_image, keys.sampled_predicted_warped_image
+        elif self == LossTerm.full_grid_change:
+            expected_key, actual_key = keys.sampled_groundtruth_grid_change, keys.sampled_predicted_grid_change
+        elif self == LossTerm.full_color_change:
+            expected_key, actual_key = keys.sampled_groundtruth_posed_image, keys.sampled_predicted_color_change
+        else:
+            raise RuntimeError(f"Unsupported loss term {self}")
+        return MaskedL1Loss(
+            expected_func=protocol.get_output_func(expected_key),
+            actual_func=protocol.get_output_func(actual_key),
+            mask_func=protocol.get_output_func(keys.sampled_weight))
+
 
 class LossWeights:
     def __init__(self, weights: Optional[Dict[LossTerm, float]] = None):
@@ -122,7 +144,7 @@ class TrainingPhases:
         return LossWeightFunc(self.phases, term)
 
 
-class SirenMorpher03TrainerArgs:
+class SirenMorpher03TrainerArgs(SirenStudentTrainerArgs):
     def __init__(self,
                  character_file_name: str,
                  pose_dataset_file_name: str,
@@ -136,13 +158,52 @@ class SirenMorpher03TrainerArgs:
                  total_worker: int = 8,
                  poser_func: Optional[Callable[[], Poser]] = None,
                  sample_output_batch_size: Optional[int] = None,
-                 pretrained_module_file_name: Optional[str] = None):
+                 pretrained_module_file_name: Optional[str] = None,
+                 broadcast_constant_images: bool = False,
+                 online_teacher_devices: Optional[List[str]] = None,
+                 online_teacher_batch_size: int = 32,
+                 online_teacher_num_slots: int = 4,
+                 num_pixel_samples: Optional[int] = None,
+                 adaptive_pose_sampling: bool = False,
+                 early_stopping_patience: Optional[int] = None,
+                 early_stopping_window_size: int = 10,
+                 early_stopping_min_relative_improvement: float = 0.01,
+                 num_training_examples_per_validation: int = 10_000,
+                 num_validation_examples: int = 256,
+                 module_accumulator: Optional[ModuleAccumulator] = None):
         for phase in training_phases.phases:
             assert phase.num_examples_upper_bound % num_training_examples_per_checkpoint == 0
 
         if poser_func is None:
             poser_func = get_poser
 
+        if online_teacher_devices is not None:
+            assert online_teacher_batch_size % total_batch_size == 0
+            assert not adaptive_pose_sampling
+
+        if num_pixel_samples is not None:
+            self.pixel_sampler = ImportancePixelSampler(image_size=512, num_samples=num_pixel_samples)
+        else:
+            self.pixel_sampler = None
+
+        if early_stopping_patience is not None:
+            assert early_stopping_patience >= 1
+        assert num_validation_examples >= 1
+
+        self.module_accumulator = module_accumulator
+        self.num_validation_examples = num_validation_examples
+        self.num_training_examples_per_validation = num_training_examples_per_validation
+        self.early_stopping_min_relative_improvement = early_stopping_min_relative_improvement
+        self.early_stopping_window_size = early_stopping_window_size
+        self.early_stopping_patience = early_stopping_patience
+        self.adaptive_pose_sampling = adaptive_pose_sampling
+        self.pose_sampler = None
+        self.pose_sampler_record_dir = None
+        self.num_pixel_samples = num_pixel_samples
+        self.online_teacher_num_slots = online_teacher_num_slots
+        self.online_teacher_batch_size = online_teacher_batch_size
+        self.online_teacher_devices = online_teacher_devices
+        self.broadcast_constant_images = broadcast_constant_images
         self.training_phases = training_phases
         self.pretrained_module_file_name = pretrained_module_file_name
         self.sample_output_batch_size = sample_output_batch_size
@@ -165,11 +226,24 @@ class SirenMorpher03TrainerArgs:
             premultiply_alpha=True,
             perform_srgb_to_linear=True)
 
-    def get_training_dataset(self):
+    def get_training_dataset(self, return_pose_index: bool = False, pose_dataset: Optional[Dataset] = None):
+        if pose_dataset is None:
+            pose_dataset = LazyTensorDataset(self.pose_dataset_file_name)
         return ImagePosesAndOtherImagesDataset(
             main_image_func=self.get_character_image,
-            pose_dataset=LazyTensorDataset(self.pose_dataset_file_name),
-            other_image_funcs=[])
+            pose_dataset=pose_dataset,
+            other_image_funcs=[],
+            return_pose_index=return_pose_index)
+
+    def get_broadcast_training_dataset(self, return_pose_index: bool = False, pose_dataset: Optional[Dataset] = None):
+        if pose_dataset is None:
+            pose_dataset = LazyTensorDataset(self.pose_dataset_file_name)
+        return PosesWithBroadcastImagesDataset(
+            main_image_func=self.get_character_image,
+            pose_dataset=pose_dataset,
+            other_image_funcs=[],
+            expand_to_batch_size=True,
+            return_pose_index=return_pose_index)
 
     def get_module_factory(self):
         return SirenMorpher03Factory(
@@ -197,30 +271,22 @@ class SirenMorpher03TrainerArgs:
             indices=SirenMorpherProtocol03Indices(
                 batch_image=0,
                 batch_pose=1,
-                batch_face_mask=2))
+                batch_face_mask=2),
+            pixel_sampler=self.pixel_sampler)
 
-    def get_optimizer_factories(self):
-        return {
-            KEY_MODULE: AdamOptimizerFactory(betas=(0.9, 0.999)),
-        }
+    def get_learning_rate_func(self):
+        return self.training_phases.get_learning_rate_func([KEY_MODULE])
 
-    def get_poser(self):
-        return self.poser_func()
+    def get_online_teacher_output_indices(self) -> List[int]:
+        return [0, 1, 2, 3, 5]
 
-    def get_training_protocol(self, world_size: int):
+    def get_batch_pose_index_index(self) -> int:
+        # The body morpher batch is [image, pose, pose_index]; it has no face mask, unlike the face morpher's.
+        return 2
+
+    def get_num_checkpoints(self) -> int:
         total_examples = self.training_phases.phases[-1].num_examples_upper_bound
-        per_checkpoint_examples = self.num_training_examples_per_checkpoint
-        num_checkpoints = total_examples // per_checkpoint_examples
-        batch_size = self.total_batch_size // world_size
-        return SirenMorpherTrainingProtocol03(
-            check_point_examples=[per_checkpoint_examples * (i + 1) for i in range(num_checkpoints)],
-            batch_size=batch_size,
-            learning_rate=self.training_phases.get_learning_rate_func([KEY_MODULE]),
-            optimizer_factories=self.get_optimizer_factories(),
-            random_seed=self.training_random_seed,
-            poser_func=self.get_poser,
-            key_module=KEY_MODULE,
-            key_poser=KEY_POSER)
+        return total_examples // self.num_training_examples_per_checkpoint
 
     def get_sample_output_protocol(self):
         return SirenMorpherSampleOutputProtocol(
@@ -252,6 +318,21 @@ class SirenMorpher03TrainerArgs:
         else:
             sample_output_protocol = None
 
+        if self.broadcast_constant_images:
+            training_dataset = self.get_broadcast_training_dataset(
+                self.adaptive_pose_sampling, self.get_training_pose_dataset())
+            training_batch_func = training_dataset.attach_constant_images
+        else:
+            training_dataset = self.get_training_dataset(
+                self.adaptive_pose_sampling, self.get_training_pose_dataset())
+            training_batch_func = None
+
+        if self.adaptive_pose_sampling:
+            self.pose_sampler_record_dir = prefix + "/pose_sampler"
+            training_sampler_factory = self.create_pose_sampler
+        else:
+            training_sampler_factory = None
+
         pretrained_module_file_names = {}
         if self.pretrained_module_file_name is not None:
             pretrained_module_file_names[KEY_MODULE] = self.pretrained_module_file_name
@@ -261,16 +342,18 @@ class SirenMorpher03TrainerArgs:
             module_factories={
                 KEY_MODULE: self.get_module_factory(),
             },
-            accumulators={},
+            accumulators=self.get_accumulators(),
             losses={
                 KEY_MODULE: self.get_loss(),
             },
-            training_dataset=self.get_training_dataset(),
+            training_dataset=training_dataset,
             validation_dataset=self.get_training_dataset(),
             training_protocol=self.get_training_protocol(world_size),
-            validation_protocol=None,
+            validation_protocol=self.get_validation_protocol(),
             sample_output_protocol=sample_output_protocol,
             pretrained_module_file_names=pretrained_module_file_names,
             example_per_snapshot=self.num_training_examples_per_snapshot,
             num_data_loader_workers=max(1, self.total_worker // world_size),
-            distrib_backend=distrib_backend)
+            distrib_backend=distrib_backend,
+            training_batch_func=training_batch_func,
+            training_sampler_factory=training_sampler_factory)
@@ -9,9 +9,13 @@ from tha4.shion.core.cached_computation import output_array_indexing_func, add_s
 from tha4.shion.core.loss import Loss
 from tha4.shion.core.optimizer_factory import OptimizerFactory
 from tha4.shion.core.training.sample_output_protocol import SampleOutputProtocol
+from tha4.shion.core.training.plateau_detector import PlateauDetector
 from tha4.shion.core.training.training_protocol import AbstractTrainingProtocol
+from tha4.shion.core.training.validation_protocol import AbstractValidationProtocol
 from tha4.nn.image_processing_util import GridChangeApplier
+from tha4.distiller.online_teacher_service import OnlineTeacherService
 from tha4.nn.siren.morpher.siren_morpher_03 import SirenMorpher03
+from tha4.nn.siren.pixel_sampling import ImportancePixelSampler, get_foreground_weight
 from tha4.poser.general_poser_02 import GeneralPoser02
 from tha4.sampleoutput.sample_image_creator import SampleImageSpec, ImageSource, ImageType, SampleImageSaver
 from torch.nn import Module
@@ -50,6 +54,17 @@ class SirenMorpherProtocol03Keys:
     groundtruth_alpha: str = "groundtruth_alpha"
     groundtruth_warped_image: str = "groundtruth_warped_image"
 
+    pixel_sample: str = "pixel_sample"
+    sampled_weight: str = "sampled_weight"
+    sampled_module_output: str = "sampled_module_output"
+    sampled_groundtruth_posed_image: str = "sampled_groundtruth_posed_image"
+    sampled_groundtruth_grid_change: str = "sampled_groundtruth_grid_change"
+    sampled_groundtruth_warped_image: str = "sampled_groundtruth_warped_image"
+    sampled_predicted_posed_image: str = "sampled_predicted_posed_image"
+    sampled_predicted_grid_change: str = "sampled_predicted_grid_change"
+    sampled_predicted_color_change: str = "sampled_predicted_color_change"
+    sampled_predicted_warped_image: str = "sampled_predicted_warped_image"
+
     zero: str = "zero"
 
 
@@ -75,7 +90,8 @@ class SirenMorpherProtocol03Indices:
 class SirenMorpherComputationProtocol03(ComposableCachedComputationProtocol):
     def __init__(self,
                  keys: Optional[SirenMorpherProtocol03Keys] = None,
-                 indices: Optional[SirenMorpherProtocol03Indices] = None):
+                 indices: Optional[SirenMorpherProtocol03Indices] = None,
+                 pixel_sampler: Optional[ImportancePixelSampler] = None):
         super().__init__()
 
         if keys is None:
@@ -83,6 +99,7 @@ class SirenMorpherComputationProtocol03(ComposableCachedComputationProtocol):
         if indices is None:
             indices = SirenMorpherProtocol03Indices()
 
+        self.pixel_sampler = pixel_sampler
         self.keys = keys
         self.indices = indices
 
@@ -119,6 +136,8 @@ class SirenMorpherComputationProtocol03(ComposableCachedComputationProtocol):
         def get_groundtruth_posed_face_mask(protocol: CachedComputationProtocol, state: ComputationState):
             face_mask = protocol.get_output(keys.face_mask, state)
             groundtruth_grid_change = protocol.get_output(keys.groundtruth_grid_change, state)
+            if face_mask.shape[0] == 1 and groundtruth_grid_change.shape[0] > 1:
+                face_mask = face_mask.expand(groundtruth_grid_change.shape[0], *face_mask.shape[1:])
             with torch.no_grad():
                 return self.grid_change_applier.apply(groundtruth_grid_change, face_mask)
 
@@ -150,6 +169,49 @@ class SirenMorpherComputationProtocol03(ComposableCachedComputationProtocol):
         self.computation_steps[keys.groundtruth_warped_image] = output_array_indexing_func(
             keys.poser_output, indices.poser_warped_image)
 
+        if pixel_sampler is not None:
+            @add_step(self.computation_steps, keys.pixel_sample)
+            def get_pixel_sample(protocol: CachedComputationProtocol, state: ComputationState):
+                groundtruth_posed_image = protocol.get_output(keys.groundtruth_posed_image, state)
+                return pixel_sampler.sample(
+                    get_foreground_weight(groundtruth_posed_image),
+                    groundtruth_posed_image.shape[0],
+                    groundtruth_posed_image.device)
+
+            @add_step(self.computation_steps, keys.sampled_weight)
+            def get_sampled_weight(protocol: CachedComputationProtocol, state: ComputationState):
+                return protocol.get_output(keys.pixel_sample, state).get_weight()
+
+            @add_step(self.computation_steps, keys.sampled_module_output)
+            def get_sampled_module_output(protocol: CachedComputationProtocol, state: ComputationState):
+                image = protocol.get_output(keys.module_input_image, state)
+                pose = protocol.get_output(keys.pose, state)
+                pixel_sample = protocol.get_output(keys.pixel_sample, state)
+                module = state.modules[self.keys.module]
+                return module.forward_sampled(image, pose, pixel_sample.get_position(pose.dtype))
+
+            def sampled_func(key: str):
+                def _f(protocol: CachedComputationProtocol, state: ComputationState):
+                    pixel_sample = protocol.get_output(keys.pixel_sample, state)
+                    return pixel_sample.gather(protocol.get_output(key, state))
+
+                return _f
+
+            self.computation_steps[keys.sampled_groundtruth_posed_image] = sampled_func(
+                keys.groundtruth_posed_image)
+            self.computation_steps[keys.sampled_groundtruth_grid_change] = sampled_func(
+                keys.groundtruth_grid_change)
+            self.computation_steps[keys.sampled_groundtruth_warped_image] = sampled_func(
+                keys.groundtruth_warped_image)
+            self.computation_steps[keys.sampled_predicted_posed_image] = output_array_indexing_func(
+                keys.sampled_module_output, indices.module_blended_image)
+            self.computation_steps[keys.sampled_predicted_grid_change] = output_array_indexing_func(
+                keys.sampled_module_output, indices.module_grid_change)
+            self.computation_steps[keys.sampled_predicted_color_change] = output_array_indexing_func(
+                keys.sampled_module_output, indices.module_color_change)
+            self.computation_steps[keys.sampled_predicted_warped_image] = output_array_indexing_func(
+                keys.sampled_module_output, indices.module_warped_image)
+
         @add_step(self.computation_steps, keys.zero)
         def get_zero(protocol: CachedComputationProtocol, state: ComputationState):
             pose = protocol.get_output(keys.pose, state)
@@ -167,13 +229,24 @@ class SirenMorpherTrainingProtocol03(AbstractTrainingProtocol):
                  poser_func: Callable[[], GeneralPoser02],
                  key_module: str,
                  key_poser: str = KEY_POSER,
-                 key_examples_seen_so_far: str = KEY_EXAMPLES_SEEN_SO_FAR):
+                 key_examples_seen_so_far: str = KEY_EXAMPLES_SEEN_SO_FAR,
+                 teacher_service_func: Optional[Callable[[], OnlineTeacherService]] = None,
+                 batch_pose_index: int = 1,
+                 key_poser_output: str = "poser_output",
+                 iteration_callbacks: Optional[List[Callable[[ComputationState], None]]] = None):
         super().__init__(check_point_examples, batch_size, learning_rate, optimizer_factories, random_seed)
+        if iteration_callbacks is None:
+            iteration_callbacks = []
+        self.iteration_callbacks = iteration_callbacks
+        self.key_poser_output = key_poser_output
+        self.batch_pose_index = batch_pose_index
+        self.teacher_service_func = teacher_service_func
         self.key_examples_seen_so_far = key_examples_seen_so_far
         self.key_poser = key_poser
         self.key_module = key_module
         self.poser_func = poser_func
         self.poser = None
+        self.teacher_service = None
 
     def run_training_iteration(
             self,
@@ -185,9 +258,24 @@ class SirenMorpherTrainingProtocol03(AbstractTrainingProtocol):
             losses: Dict[str, Loss],
             create_log_func: Optional[Callable[[str, int], Callable[[str, float], None]]],
             device: torch.device):
-        if self.poser is None:
-            self.poser = self.poser_func()
-            self.poser.to(device)
+        outputs = {
+            self.key_examples_seen_so_far: examples_seen_so_far,
+        }
+        if self.teacher_service_func is not None:
+            if self.teacher_service is None:
+                self.teacher_service = self.teacher_service_func()
+                self.teacher_service.start()
+            pose, poser_output = self.teacher_service.get_batch(batch[self.batch_pose_index].shape[0], device)
+            batch = list(batch)
+            batch[self.batch_pose_index] = pose
+            outputs[self.key_poser_output] = poser_output
+            self.teacher_service.report(create_log_func, examples_seen_so_far)
+            poser_modules = {}
+        else:
+            if self.poser is None:
+                self.poser = self.poser_func()
+                self.poser.to(device)
+            poser_modules = {self.key_poser: self.poser}
 
         module = modules[self.key_module]
         module.train(True)
@@ -199,6 +287,79 @@ class SirenMorpherTrainingProtocol03(AbstractTrainingProtocol):
             log_func = create_log_func(f"training_{self.key_module}", examples_seen_so_far)
         else:
             log_func = None
+        state = ComputationState(
+            modules={
+                **modules,
+                **poser_modules,
+            },
+            accumulated_modules=accumulated_modules,
+            batch=batch,
+            outputs=outputs)
+        loss_value = loss.compute(state, log_func)
+        loss_value.backward()
+        module_optimizer.step()
+
+        for callback in self.iteration_callbacks:
+            callback(state)
+
+    def close(self):
+        if self.teacher_service is not None:
+            self.teacher_service.close()
+            self.teacher_service = None
+
+
+# When validation_dataset_func is given, the validation loss is the mean loss over a fixed held-out set of
+# num_validation_examples examples from that dataset, so that consecutive values differ because of training and not
+# because of the batch they were computed on. The batch that the trainer passes is then not used.
+class SirenMorpherValidationProtocol(AbstractValidationProtocol):
+    def __init__(self,
+                 example_per_validation_iteration: int,
+                 batch_size: int,
+                 poser_func: Callable[[], GeneralPoser02],
+                 key_module: str = KEY_MODULE,
+                 key_poser: str = KEY_POSER,
+                 key_examples_seen_so_far: str = KEY_EXAMPLES_SEEN_SO_FAR,
+                 plateau_detector: Optional[PlateauDetector] = None,
+                 validation_dataset_func: Optional[Callable[[], Dataset]] = None,
+                 num_validation_examples: int = 256,
+                 random_seed: int = 1853502993):
+        super().__init__(example_per_validation_iteration, batch_size)
+        assert num_validation_examples >= 1
+        self.random_seed = random_seed
+        self.num_validation_examples = num_validation_examples
+        self.validation_dataset_func = validation_dataset_func
+        self.plateau_detector = plateau_detector
+        self.key_examples_seen_so_far = key_examples_seen_so_far
+        self.key_poser = key_poser
+        self.key_module = key_module
+        self.poser_func = poser_func
+        self.poser = None
+        self.validation_dataset = None
+        self.validation_example_indices = None
+
+    def get_validation_batches(self, batch: Any, device: torch.device) -> List[Any]:
+        if self.validation_dataset_func is None:
+            return [batch]
+        if self.validation_dataset is None:
+            self.validation_dataset = self.validation_dataset_func()
+            generator = torch.Generator()
+            generator.manual_seed(self.random_seed)
+            num_examples = min(self.num_validation_examples, len(self.validation_dataset))
+            permutation = torch.randperm(len(self.validation_dataset), generator=generator)
+            self.validation_example_indices = permutation[:num_examples].tolist()
+        return [
+            get_indexed_batch(
+                self.validation_dataset, self.validation_example_indices[i:i + self.batch_size], device)
+            for i in range(0, len(self.validation_example_indices), self.batch_size)
+        ]
+
+    def compute_loss(self,
+                     batch: Any,
+                     examples_seen_so_far: int,
+                     modules: Dict[str, Module],
+                     accumulated_modules: Dict[str, Module],
+                     losses: Dict[str, Loss],
+                     log_func: Optional[Callable[[str, float], None]]) -> float:
         state = ComputationState(
             modules={
                 **modules,
@@ -209,9 +370,60 @@ class SirenMorpherTrainingProtocol03(AbstractTrainingProtocol):
             outputs={
                 self.key_examples_seen_so_far: examples_seen_so_far,
             })
-        loss_value = loss.compute(state, log_func)
-        loss_value.backward()
-        module_optimizer.step()
+        with torch.no_grad():
+            return losses[self.key_module].compute(state, log_func).item()
+
+    def run_validation_iteration(
+            self,
+            batch: Any,
+            examples_seen_so_far: int,
+            modules: Dict[str, Module],
+            accumulated_modules: Dict[str, Module],
+            losses: Dict[str, Loss],
+            create_log_func: Optional[Callable[[str, int], Callable[[str, float], None]]],
+            device: torch.device):
+        if self.poser is None:
+            self.poser = self.poser_func()
+            self.poser.to(device)
+
+        module = modules[self.key_module]
+        module.train(False)
+        total_loss = 0.0
+        logged_totals = {}
+        num_examples = 0
+        for validation_batch in self.get_validation_batches(batch, device):
+            batch_size = validation_batch[0].shape[0]
+
+            def accumulate_log(tag: str, value: float):
+                logged_totals[tag] = logged_totals.get(tag, 0.0) + float(value) * batch_size
+
+            loss_value = self.compute_loss(
+                validation_batch, examples_seen_so_far, modules, accumulated_modules, losses, accumulate_log)
+            total_loss += loss_value * batch_size
+            num_examples += batch_size
+        loss_value = total_loss / num_examples
+        module.train(True)
+
+        if create_log_func is not None:
+            log_func = create_log_func(f"validation_{self.key_module}", examples_seen_so_far)
+            for tag, total in logged_totals.items():
+                log_func(tag, total / num_examples)
+        if self.plateau_detector is not None:
+            self.plateau_detector.add(loss_value)
+
+    def should_stop_training(self) -> bool:
+        return self.plateau_detector is not None and self.plateau_detector.has_plateaued()
+
+    def state_dict(self) -> dict:
+        if self.plateau_detector is None:
+            return {}
+        return {
+            'plateau_detector': self.plateau_detector.state_dict(),
+        }
+
+    def load_state_dict(self, state: dict):
+        if self.plateau_detector is not None and 'plateau_detector' in state:
+            self.plateau_detector.load_state_dict(state['plateau_detector'])
 
 
 class SirenMorpherSampleOutputProtocol(SampleOutputProtocol):
@@ -0,0 +1,73 @@
+import argparse
+import logging
+import os
+import tempfile
+
+import numpy
+import PIL.Image
+import torch
+
+from tha4.nn.siren.morpher.siren_morpher_03_trainer import SirenMorpher03TrainerArgs, TrainingPhases, \
+    TrainingPhase, LossWeights, LossTerm
+
+
+def create_synthetic_inputs(dir: str, num_poses: int, seed: int):
+    generator = numpy.random.default_rng(seed)
+    character_file_name = os.path.join(dir, "character.png")
+    pixels = generator.integers(0, 256, size=(512, 512, 4), dtype=numpy.uint8)
+    PIL.Image.fromarray(pixels, mode='RGBA').save(character_file_name)
+
+    pose_dataset_file_name = os.path.join(dir, "poses.pt")
+    poses = torch.from_numpy(generator.uniform(-1.0, 1.0, size=(num_poses, 45)).astype(numpy.float32))
+    torch.save(poses, pose_dataset_file_name)
+    return character_file_name, pose_dataset_file_name
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Run a single training step of the SIREN body morpher trainer to check that it is wired up.')
+    parser.add_argument('--character_file_name', type=str, required=False, default=None,
+                        help='The character image. A random image is used when not given.')
+    parser.add_argument('--pose_dataset_file_name', type=str, required=False, default=None,
+                        help='The pose dataset. Random poses are used when not given.')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--no_adaptive_pose_sampling', action='store_true')
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, force=True)
+    device = torch.device(args.device)
+
+    with tempfile.TemporaryDirectory() as dir:
+        character_file_name, pose_dataset_file_name = create_synthetic_inputs(dir, 16 * args.batch_size, seed=0)
+        if args.character_file_name is not None:
+            character_file_name = args.character_file_name
+        if args.pose_dataset_file_name is not None:
+            pose_dataset_file_name = args.pose_dataset_file_name
+
+        trainer_args = SirenMorpher03TrainerArgs(
+            character_file_name=character_file_name,
+            pose_dataset_file_name=pose_dataset_file_name,
+            training_phases=TrainingPhases([
+                TrainingPhase(
+                    num_examples_upper_bound=args.batch_size,
+                    learning_rate=1e-4,
+                    loss_weights=LossWeights({LossTerm.full_blended: 1.0})),
+            ]),
+            num_training_examples_per_checkpoint=args.batch_size,
+            num_training_examples_per_sample_output=None,
+            num_training_examples_per_snapshot=args.batch_size,
+            total_batch_size=args.batch_size,
+            total_worker=1,
+            adaptive_pose_sampling=not args.no_adaptive_pose_sampling)
+
+        os.environ.setdefault("MASTER_ADDR", "127.0.0.1")
+        os.environ.setdefault("MASTER_PORT", "29517")
+        torch.distributed.init_process_group('gloo', rank=0, world_size=1)
+        try:
+            trainer = trainer_args.create_trainer(os.path.join(dir, "trainer"), world_size=1)
+            trainer.train(1, 0, 0, target_checkpoint_examples=args.batch_size, device_mapper=lambda r, l: device)
+        finally:
+            torch.distributed.destroy_process_group()
+
+    print("The SIREN body morpher trainer ran one training step.")
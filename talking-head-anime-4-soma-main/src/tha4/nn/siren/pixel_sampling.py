@@ -0,0 +1,139 @@
+from typing import Optional, Callable
+
+import torch
+from torch import Tensor
+
+from tha4.shion.core.cached_computation import ComputationState, TensorCachedComputationFunc
+
+
+def get_pixel_center_rows(indices: Tensor, image_size: int, dtype: torch.dtype = torch.float) -> Tensor:
+    xs = (indices % image_size).to(dtype)
+    ys = torch.div(indices, image_size, rounding_mode='floor').to(dtype)
+    return torch.stack([(2 * xs + 1) / image_size - 1, (2 * ys + 1) / image_size - 1], dim=-1)
+
+
+def get_bilinear_neighbors(position: Tensor, image_size: int):
+    n, k = position.shape[0], position.shape[1]
+    u = ((position + 1) * image_size / 2 - 0.5).clamp(min=0.0)
+    p0 = u.floor().clamp(max=image_size - 1)
+    p1 = (p0 + 1).clamp(max=image_size - 1)
+    f = u - p0
+
+    xs = torch.stack([p0[:, :, 0], p1[:, :, 0], p0[:, :, 0], p1[:, :, 0]], dim=2)
+    ys = torch.stack([p0[:, :, 1], p0[:, :, 1], p1[:, :, 1], p1[:, :, 1]], dim=2)
+    fx, fy = f[:, :, 0:1], f[:, :, 1:2]
+    weights = torch.cat([(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy], dim=2)
+    indices = (ys * image_size + xs).long()
+    neighbor_position = torch.stack([(2 * xs + 1) / image_size - 1, (2 * ys + 1) / image_size - 1], dim=3)
+    return indices, weights, neighbor_position.view(n, 4 * k, 2)
+
+
+class PixelSample:
+    def __init__(self, indices: Tensor, weight: Tensor, image_size: int):
+        self.image_size = image_size
+        self.weight = weight
+        self.indices = indices
+
+    def get_position(self, dtype: torch.dtype = torch.float) -> Tensor:
+        n, k = self.indices.shape
+        return get_pixel_center_rows(self.indices, self.image_size, dtype).transpose(1, 2).reshape(n, 2, 1, k)
+
+    def get_weight(self) -> Tensor:
+        n, k = self.indices.shape
+        return self.weight.view(n, 1, 1, k)
+
+    def gather(self, image: Tensor) -> Tensor:
+        n, k = self.indices.shape
+        c = image.shape[1]
+        assert image.shape[2] == self.image_size and image.shape[3] == self.image_size
+        if image.shape[0] == 1 and n > 1:
+            image = image.expand(n, c, self.image_size, self.image_size)
+        rows = image.reshape(n, c, self.image_size * self.image_size)
+        return rows.gather(2, self.indices.view(n, 1, k).expand(n, c, k)).view(n, c, 1, k)
+
+
+class ImportancePixelSampler:
+    def __init__(self,
+                 image_size: int,
+                 num_samples: int,
+                 uniform_fraction: float = 0.25,
+                 foreground_fraction: float = 0.25,
+                 error_decay: float = 0.9):
+        assert num_samples >= 1
+        assert uniform_fraction > 0.0
+        assert foreground_fraction >= 0.0
+        assert uniform_fraction + foreground_fraction <= 1.0
+        self.error_decay = error_decay
+        self.foreground_fraction = foreground_fraction
+        self.uniform_fraction = uniform_fraction
+        self.num_samples = num_samples
+        self.image_size = image_size
+        self.error_map = None
+
+    def get_density(self, foreground: Optional[Tensor], n: int, device: torch.device) -> Tensor:
+        num_pixels = self.image_size * self.image_size
+        uniform_fraction = self.uniform_fraction
+        density = torch.zeros(n, num_pixels, device=device)
+
+        if foreground is not None and self.foreground_fraction > 0:
+            foreground = foreground.reshape(foreground.shape[0], num_pixels).expand(n, num_pixels)
+            total = foreground.sum(dim=1, keepdim=True)
+            has_foreground = total > 0
+            density += torch.where(
+                has_foreground, foreground / total.clamp(min=1e-8), 1.0 / num_pixels) * self.foreground_fraction
+        else:
+            uniform_fraction += self.foreground_fraction
+
+        error_fraction = 1.0 - self.foreground_fraction - self.uniform_fraction
+        if self.error_map is not None and self.error_map.device == device and error_fraction > 0:
+            total = self.error_map.sum()
+            if total.item() > 0:
+                density += (self.error_map / total).view(1, num_pixels) * error_fraction
+            else:
+                uniform_fraction += error_fraction
+        else:
+            uniform_fraction += error_fraction
+
+        return density + uniform_fraction / num_pixels
+
+    def sample(self, foreground: Optional[Tensor], n: int, device: torch.device) -> PixelSample:
+        with torch.no_grad():
+            density = self.get_density(foreground, n, device)
+            indices = torch.multinomial(density, self.num_samples, replacement=True)
+            weight = 1.0 / (density.gather(1, indices) * density.shape[1])
+        return PixelSample(indices, weight, self.image_size)
+
+    def update(self, sample: PixelSample, error: Tensor):
+        num_pixels = self.image_size * self.image_size
+        with torch.no_grad():
+            indices = sample.indices.reshape(-1)
+            error = error.reshape(-1).to(torch.float)
+            sums = torch.zeros(num_pixels, device=error.device).index_add_(0, indices, error)
+            counts = torch.zeros(num_pixels, device=error.device).index_add_(0, indices, torch.ones_like(error))
+            if self.error_map is None or self.error_map.device != error.device:
+                self.error_map = torch.full([num_pixels], error.mean().item(), device=error.device)
+            touched = counts > 0
+            self.error_map[touched] = self.error_decay * self.error_map[touched] \
+                + (1 - self.error_decay) * sums[touched] / counts[touched]
+
+
+class PixelSamplerErrorFeedback:
+    def __init__(self,
+                 sampler: ImportancePixelSampler,
+                 sample_func: Callable[[ComputationState], PixelSample],
+                 expected_func: TensorCachedComputationFunc,
+                 actual_func: TensorCachedComputationFunc):
+        self.actual_func = actual_func
+        self.expected_func = expected_func
+        self.sample_func = sample_func
+        self.sampler = sampler
+
+    def __call__(self, state: ComputationState):
+        with torch.no_grad():
+            sample = self.sample_func(state)
+            error = (self.expected_func(state) - self.actual_func(state)).abs().mean(dim=1)
+            self.sampler.update(sample, error)
+
+
+def get_foreground_weight(image: Tensor) -> Tensor:
+    return ((image[:, 3:4, :, :] + 1.0) / 2.0).clamp(0.0, 1.0)
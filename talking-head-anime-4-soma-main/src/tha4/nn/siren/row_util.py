@@ -0,0 +1,30 @@
+from typing import Dict, Tuple
+
+import torch
+from torch import Tensor
+from torch.nn.functional import affine_grid, interpolate
+
+
+class PositionRowsCache:
+    def __init__(self):
+        self.cache: Dict[Tuple[int, torch.dtype, torch.device], Tensor] = {}
+
+    def get(self, image_size: int, dtype: torch.dtype, device: torch.device) -> Tensor:
+        key = (image_size, dtype, device)
+        if key not in self.cache:
+            identity = torch.tensor([[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]], dtype=dtype, device=device).unsqueeze(0)
+            position = affine_grid(identity, [1, 1, image_size, image_size], align_corners=False)
+            self.cache[key] = position.view(image_size * image_size, 2)
+        return self.cache[key]
+
+
+def rows_to_image(x: Tensor, image_size: int) -> Tensor:
+    n, _, c = x.shape
+    return x.transpose(1, 2).reshape(n, c, image_size, image_size)
+
+
+def resize_rows(x: Tensor, source_size: int, target_size: int) -> Tensor:
+    n, _, c = x.shape
+    image = x.view(n, source_size, source_size, c).permute(0, 3, 1, 2)
+    image = interpolate(image, size=(target_size, target_size), mode='bilinear', align_corners=False)
+    return image.permute(0, 2, 3, 1).reshape(n, target_size * target_size, c)
@@ -0,0 +1,175 @@
+import math
+from typing import List, Optional, Tuple
+
+import torch
+from torch import Tensor
+from torch.nn.functional import grid_sample, interpolate
+
+from tha4.nn.siren.face_morpher.siren_face_morpher_00 import SirenFaceMorpher00
+from tha4.nn.siren.morpher.siren_morpher_03 import SirenMorpher03
+
+
+class PixelRect:
+    def __init__(self, canvas_size: int, top: int, left: int, height: int, width: int):
+        assert canvas_size >= 1
+        assert height >= 1 and width >= 1
+        assert 0 <= top and top + height <= canvas_size
+        assert 0 <= left and left + width <= canvas_size
+        self.canvas_size = canvas_size
+        self.width = width
+        self.height = height
+        self.left = left
+        self.top = top
+
+    @staticmethod
+    def full(canvas_size: int) -> 'PixelRect':
+        return PixelRect(canvas_size, 0, 0, canvas_size, canvas_size)
+
+    def get_extent(self):
+        s = self.canvas_size
+        return (
+            2.0 * self.left / s - 1.0,
+            2.0 * self.top / s - 1.0,
+            2.0 * (self.left + self.width) / s - 1.0,
+            2.0 * (self.top + self.height) / s - 1.0)
+
+    def get_pixel_centers(self, device: torch.device, dtype: torch.dtype = torch.float) -> Tensor:
+        s = self.canvas_size
+        xs = (2 * torch.arange(self.left, self.left + self.width, device=device, dtype=dtype) + 1) / s - 1
+        ys = (2 * torch.arange(self.top, self.top + self.height, device=device, dtype=dtype) + 1) / s - 1
+        return torch.stack([
+            xs.view(1, self.width).expand(self.height, self.width),
+            ys.view(self.height, 1).expand(self.height, self.width),
+        ], dim=0).unsqueeze(0)
+
+    def get_covering_rect(self, canvas_size: int, margin: int = 1) -> 'PixelRect':
+        x0, y0, x1, y1 = self.get_extent()
+
+        def pixel_range(u0: float, u1: float):
+            j0 = max(0, math.floor((u0 + 1) * canvas_size / 2 - 0.5) - margin)
+            j1 = min(canvas_size - 1, math.ceil((u1 + 1) * canvas_size / 2 - 0.5) + margin)
+            return j0, j1 - j0 + 1
+
+        left, width = pixel_range(x0, x1)
+        top, height = pixel_range(y0, y1)
+        return PixelRect(canvas_size, top, left, height, width)
+
+    def intersect(self, other: 'PixelRect') -> Optional['PixelRect']:
+        assert self.canvas_size == other.canvas_size
+        top = max(self.top, other.top)
+        left = max(self.left, other.left)
+        bottom = min(self.top + self.height, other.top + other.height)
+        right = min(self.left + self.width, other.left + other.width)
+        if bottom <= top or right <= left:
+            return None
+        return PixelRect(self.canvas_size, top, left, bottom - top, right - left)
+
+    def to_local_grid(self, position: Tensor) -> Tensor:
+        s = self.canvas_size
+        x = ((position[:, 0] + 1) * s / 2 - self.left) * 2 / self.width - 1
+        y = ((position[:, 1] + 1) * s / 2 - self.top) * 2 / self.height - 1
+        return torch.stack([x, y], dim=3)
+
+
+def resample_image(image: Tensor, image_size: int) -> Tensor:
+    if image.shape[2] == image_size and image.shape[3] == image_size:
+        return image
+    return interpolate(
+        image,
+        size=(image_size, image_size),
+        mode='bilinear',
+        align_corners=False,
+        antialias=image_size < image.shape[2])
+
+
+def render_siren_face_morpher_00(module: SirenFaceMorpher00, pose: Tensor, rect: PixelRect) -> Tensor:
+    n = pose.shape[0]
+    position = rect.get_pixel_centers(pose.device, pose.dtype)
+    return module.forward(pose, position.expand(n, 2, rect.height, rect.width))
+
+
+def get_sampled_pixel_rect(grid: Tensor, canvas_size: int) -> PixelRect:
+    # The pixels that bilinear grid_sample with border padding and align_corners=False reads for an (n, 2, h, w) grid.
+    def pixel_range(u: Tensor):
+        u = (u + 1) * canvas_size / 2 - 0.5
+        j0 = min(canvas_size - 1, max(0, math.floor(u.min().item())))
+        j1 = min(canvas_size - 1, max(0, math.floor(u.max().item()) + 1))
+        return j0, j1 - j0 + 1
+
+    left, width = pixel_range(grid[:, 0])
+    top, height = pixel_range(grid[:, 1])
+    return PixelRect(canvas_size, top, left, height, width)
+
+
+def evaluate_siren_morpher_03(
+        module: SirenMorpher03,
+        pose: Tensor,
+        output_size: Optional[int] = None,
+        rect: Optional[PixelRect] = None) -> Tuple[Tensor, Tensor]:
+    args = module.args
+    assert args.level_args[-1].image_size == args.image_size
+    if output_size is None:
+        output_size = args.image_size
+    if rect is None:
+        rect = PixelRect.full(output_size)
+    assert rect.canvas_size == output_size
+    n, p = pose.shape[0], pose.shape[1]
+
+    level_sizes = [
+        max(1, round(level_args.image_size * output_size / args.image_size))
+        for level_args in args.level_args[:-1]
+    ] + [output_size]
+    level_rects = [rect]
+    for level_size in reversed(level_sizes[:-1]):
+        level_rects.insert(0, level_rects[0].get_covering_rect(level_size, margin=1))
+
+    x = None
+    position = None
+    for i in range(len(args.level_args)):
+        level_rect = level_rects[i]
+        h, w = level_rect.height, level_rect.width
+        position = level_rect.get_pixel_centers(pose.device, pose.dtype).expand(n, 2, h, w)
+        pose_image = pose.view(n, p, 1, 1).expand(n, p, h, w)
+        if i == 0:
+            x = module.siren_layers[i].forward(torch.cat([position, pose_image], dim=1))
+        else:
+            grid = level_rects[i - 1].to_local_grid(position)
+            x = grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+            x = module.siren_layers[i].forward(torch.cat([x, position, pose_image], dim=1))
+
+    return position, module.last_linear(x)
+
+
+def apply_siren_morpher_03_output(
+        image: Tensor,
+        position: Tensor,
+        siren_output: Tensor,
+        output_size: int) -> List[Tensor]:
+    grid_change = siren_output[:, 0:2, :, :]
+    alpha = siren_output[:, 2:3, :, :]
+    color_change = siren_output[:, 3:, :, :]
+
+    texture = resample_image(image, output_size)
+    grid = (position + grid_change).permute(0, 2, 3, 1)
+    warped_image = grid_sample(texture, grid, mode='bilinear', padding_mode='border', align_corners=False)
+    blended_image = (1 - alpha) * warped_image + alpha * color_change
+
+    return [
+        blended_image,
+        alpha,
+        color_change,
+        warped_image,
+        grid_change
+    ]
+
+
+def render_siren_morpher_03(
+        module: SirenMorpher03,
+        image: Tensor,
+        pose: Tensor,
+        output_size: Optional[int] = None,
+        rect: Optional[PixelRect] = None) -> List[Tensor]:
+    if output_size is None:
+        output_size = module.args.image_size
+    position, siren_output = evaluate_siren_morpher_03(module, pose, output_size, rect)
+    return apply_siren_morpher_03_output(image, position, siren_output, output_size)
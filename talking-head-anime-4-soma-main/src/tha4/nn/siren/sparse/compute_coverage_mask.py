@@ -0,0 +1,62 @@
+import argparse
+import os
+
+import torch
+
+from tha4.charmodel.character_model import CharacterModel
+from tha4.nn.siren.sparse.coverage_mask import compute_coverage_mask, measure_sparse_speedup
+from tha4.poser.modes.mode_14 import load_body_morpher, SirenEngine
+from tha4.shion.core.load_save import torch_load, torch_save
+
+
+def process_character_model(args, character_model_file_name: str, device: torch.device):
+    character_model = CharacterModel.load(character_model_file_name)
+    image = character_model.get_character_image(device)
+    dense_body_morpher = load_body_morpher(character_model.body_morpher_file_name, SirenEngine.CONV) \
+        .to(device).train(False)
+
+    pose_dataset = torch_load(args.pose_dataset_file_name)
+    if isinstance(pose_dataset, (list, tuple)):
+        pose_dataset = pose_dataset[0]
+    generator = torch.Generator().manual_seed(args.random_seed)
+    pose_indices = torch.randperm(pose_dataset.shape[0], generator=generator)[0:args.num_poses]
+    poses = pose_dataset[pose_indices].to(device)
+
+    coverage_mask, max_warp = compute_coverage_mask(
+        dense_body_morpher, image, poses, batch_size=args.batch_size, margin=args.margin)
+    coverage_mask_file_name = os.path.join(os.path.dirname(character_model_file_name), "coverage_mask.pt")
+    torch_save(coverage_mask.cpu(), coverage_mask_file_name)
+
+    sparse_body_morpher = load_body_morpher(None, SirenEngine.SPARSE).to(device).train(False)
+    sparse_body_morpher.load_state_dict(dense_body_morpher.state_dict())
+    sparse_body_morpher.set_coverage_mask(coverage_mask)
+    dense_time, sparse_time = measure_sparse_speedup(
+        dense_body_morpher, sparse_body_morpher, image, poses[0:args.num_benchmark_poses])
+
+    print("%s" % character_model_file_name)
+    print("    coverage mask: %s" % coverage_mask_file_name)
+    print("    max warp: %.2f pixels" % max_warp)
+    print("    covered pixel ratio: %.4f" % sparse_body_morpher.get_covered_pixel_ratio())
+    print("    dense: %.2f ms, sparse: %.2f ms, speedup: %.2fx" % (
+        dense_time * 1000, sparse_time * 1000, dense_time / sparse_time))
+
+    if args.update_character_model:
+        character_model.coverage_mask_file_name = coverage_mask_file_name
+        character_model.save(character_model_file_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute the coverage masks used by sparse SIREN evaluation.')
+    parser.add_argument('character_model_file_names', type=str, nargs='+')
+    parser.add_argument('--pose_dataset_file_name', type=str, default="data/pose_dataset.pt")
+    parser.add_argument('--num_poses', type=int, default=4096)
+    parser.add_argument('--num_benchmark_poses', type=int, default=16)
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--margin', type=int, default=2)
+    parser.add_argument('--random_seed', type=int, default=3498503951)
+    parser.add_argument('--device', type=str, default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument('--update_character_model', action='store_true')
+    args = parser.parse_args()
+
+    for file_name in args.character_model_file_names:
+        process_character_model(args, file_name, torch.device(args.device))
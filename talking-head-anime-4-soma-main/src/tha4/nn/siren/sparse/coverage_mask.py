@@ -0,0 +1,69 @@
+import math
+import time
+from typing import Tuple
+
+import torch
+from torch import Tensor
+from torch.nn.functional import max_pool2d
+
+from tha4.nn.siren.morpher.siren_morpher_03 import SirenMorpher03
+
+
+def dilate_mask(mask: Tensor, radius: int) -> Tensor:
+    if radius <= 0:
+        return mask
+    return max_pool2d(mask.float(), kernel_size=2 * radius + 1, stride=1, padding=radius) > 0
+
+
+def compute_coverage_mask(
+        body_morpher: SirenMorpher03,
+        image: Tensor,
+        poses: Tensor,
+        batch_size: int = 8,
+        alpha_threshold: float = 1.0 / 255.0,
+        margin: int = 2) -> Tuple[Tensor, float]:
+    if len(image.shape) == 3:
+        image = image.unsqueeze(0)
+    image_size = body_morpher.args.image_size
+    threshold = alpha_threshold * 2.0 - 1.0
+
+    alpha_footprint = image[:, 3:4, :, :] > threshold
+    observed_footprint = torch.zeros_like(alpha_footprint)
+    max_warp = 0.0
+    with torch.no_grad():
+        for pose in torch.split(poses, batch_size, dim=0):
+            n = pose.shape[0]
+            outputs = body_morpher.forward(image.expand(n, -1, -1, -1), pose)
+            grid_change = outputs[SirenMorpher03.INDEX_GRID_CHANGE]
+            max_warp = max(max_warp, grid_change.abs().max().item() * image_size / 2.0)
+            posed_alpha = outputs[SirenMorpher03.INDEX_BLENDED_IMAGE][:, 3:4, :, :]
+            observed_footprint = observed_footprint | (posed_alpha > threshold).any(dim=0, keepdim=True)
+
+    coverage_mask = dilate_mask(alpha_footprint, math.ceil(max_warp) + margin) \
+                    | dilate_mask(observed_footprint, margin)
+    return coverage_mask, max_warp
+
+
+def measure_sparse_speedup(
+        dense_body_morpher: SirenMorpher03,
+        sparse_body_morpher: SirenMorpher03,
+        image: Tensor,
+        poses: Tensor,
+        num_warmup_iterations: int = 1) -> Tuple[float, float]:
+    if len(image.shape) == 3:
+        image = image.unsqueeze(0)
+
+    def measure(module: SirenMorpher03) -> float:
+        with torch.no_grad():
+            for i in range(num_warmup_iterations):
+                module.forward(image, poses[0:1])
+            if image.is_cuda:
+                torch.cuda.synchronize(image.device)
+            start_time = time.perf_counter()
+            for i in range(poses.shape[0]):
+                module.forward(image, poses[i:i + 1])
+            if image.is_cuda:
+                torch.cuda.synchronize(image.device)
+            return (time.perf_counter() - start_time) / poses.shape[0]
+
+    return measure(dense_body_morpher), measure(sparse_body_morpher)
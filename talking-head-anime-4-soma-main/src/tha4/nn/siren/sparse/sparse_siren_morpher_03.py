@@ -0,0 +1,98 @@
+from typing import List, Optional, Dict, Tuple
+
+import torch
+from torch import Tensor
+from torch.nn.functional import adaptive_max_pool2d, max_pool2d, grid_sample
+
+from tha4.nn.siren.matmul.folded_linear import FoldedLinearCache, sin_rows
+from tha4.nn.siren.row_util import PositionRowsCache
+from tha4.nn.siren.morpher.siren_morpher_03 import SirenMorpher03, SirenMorpher03Args
+
+
+class SparseSirenMorpher03(SirenMorpher03):
+    def __init__(self, args: SirenMorpher03Args, coverage_mask: Optional[Tensor] = None):
+        super().__init__(args)
+        self.folded_siren_layers = [[FoldedLinearCache() for _ in level] for level in self.siren_layers]
+        self.folded_last_linear = FoldedLinearCache()
+        self.position_rows_cache = PositionRowsCache()
+        self.level_indices: Dict[torch.device, List[Tensor]] = {}
+        self.coverage_mask = None
+        self.set_coverage_mask(coverage_mask)
+
+    def set_coverage_mask(self, coverage_mask: Optional[Tensor]):
+        if coverage_mask is not None:
+            coverage_mask = coverage_mask.view(1, 1, self.args.image_size, self.args.image_size).bool().cpu()
+        self.coverage_mask = coverage_mask
+        self.level_indices = {}
+
+    def get_level_masks(self) -> List[Tensor]:
+        mask = self.coverage_mask.float()
+        masks = [mask]
+        for level_args in reversed(self.args.level_args[:-1]):
+            size = level_args.image_size
+            mask = adaptive_max_pool2d(masks[0], (size, size))
+            mask = max_pool2d(mask, kernel_size=3, stride=1, padding=1)
+            masks.insert(0, mask)
+        return [mask > 0 for mask in masks]
+
+    def get_level_indices(self, device: torch.device) -> List[Tensor]:
+        if device not in self.level_indices:
+            self.level_indices[device] = [
+                torch.nonzero(mask.view(-1), as_tuple=False).view(-1).to(device)
+                for mask in self.get_level_masks()
+            ]
+        return self.level_indices[device]
+
+    def get_covered_pixel_ratio(self) -> float:
+        if self.coverage_mask is None:
+            return 1.0
+        return self.coverage_mask.float().mean().item()
+
+    def get_folded_layer(self, level_index: int, layer_index: int) -> Tuple[Tensor, Tensor]:
+        layer = self.siren_layers[level_index][layer_index]
+        return self.folded_siren_layers[level_index][layer_index].get(layer.linear, layer.omega_0)
+
+    def forward(self, image: Tensor, pose: Tensor) -> List[Tensor]:
+        if self.coverage_mask is None:
+            return super().forward(image, pose)
+
+        n = pose.shape[0]
+        level_indices = self.get_level_indices(pose.device)
+
+        x = None
+        previous_size = None
+        for i in range(len(self.args.level_args)):
+            image_size = self.args.level_args[i].image_size
+            indices = level_indices[i]
+            k = indices.shape[0]
+            position = self.position_rows_cache.get(image_size, pose.dtype, pose.device).index_select(0, indices)
+
+            weight, bias = self.get_folded_layer(i, 0)
+            c = 0 if x is None else x.shape[2]
+            out_channels = weight.shape[1]
+            pose_term = torch.addmm(bias, pose, weight[c + 2:, :]).view(n, 1, out_channels)
+            y = (torch.matmul(position, weight[c:c + 2, :]) + pose_term).view(n * k, out_channels)
+            if x is not None:
+                dense = x.new_zeros(n, previous_size * previous_size, c)
+                dense.index_copy_(1, level_indices[i - 1], x)
+                dense = dense.view(n, previous_size, previous_size, c).permute(0, 3, 1, 2)
+                grid = position.view(1, 1, k, 2).expand(n, 1, k, 2)
+                x = grid_sample(dense, grid, mode='bilinear', padding_mode='border', align_corners=False)
+                x = x.view(n, c, k).transpose(1, 2).reshape(n * k, c)
+                y = y.addmm_(x, weight[0:c, :])
+            x = sin_rows(y)
+
+            for j in range(1, len(self.siren_layers[i])):
+                weight, bias = self.get_folded_layer(i, j)
+                x = sin_rows(torch.addmm(bias, x, weight))
+            x = x.view(n, k, x.shape[1])
+            previous_size = image_size
+
+        weight, bias = self.folded_last_linear.get(self.last_linear)
+        k = x.shape[1]
+        x = torch.addmm(bias, x.view(n * k, x.shape[2]), weight).view(n, k, weight.shape[1])
+        siren_output = x.new_zeros(n, previous_size * previous_size, weight.shape[1])
+        siren_output.index_copy_(1, level_indices[-1], x)
+        siren_output = siren_output.transpose(1, 2).reshape(n, weight.shape[1], previous_size, previous_size)
+
+        return self.apply_siren_output(image, siren_output)
@@ -0,0 +1,164 @@
+import threading
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+from typing import List, Optional, Tuple, Dict
+
+import torch
+from torch import Tensor
+
+from tha4.poser.general_poser_02 import GeneralPoser02
+from tha4.poser.poser import Poser, PoseParameterGroup
+
+
+class PoseRequest:
+    def __init__(self, image: Tensor, pose: Tensor, future: Future):
+        self.future = future
+        self.pose = pose
+        self.image = image
+
+    def get_group_key(self) -> Tuple:
+        return (
+            tuple(self.image.shape[1:]), self.image.dtype, self.image.device,
+            tuple(self.pose.shape[1:]), self.pose.dtype, self.pose.device)
+
+
+class BatchingPoserSchedulerStats:
+    def __init__(self):
+        self.num_requests = 0
+        self.num_batches = 0
+        self.max_batch_size = 0
+
+    def get_average_batch_size(self) -> float:
+        if self.num_batches == 0:
+            return 0.0
+        return self.num_requests / self.num_batches
+
+
+class BatchingPoserScheduler(Poser):
+    def __init__(self,
+                 poser: GeneralPoser02,
+                 max_batch_size: int = 8,
+                 max_wait_time: float = 0.005):
+        assert max_batch_size >= 1
+        assert max_wait_time >= 0.0
+        self.max_wait_time = max_wait_time
+        self.max_batch_size = max_batch_size
+        self.poser = poser
+
+        self.request_queue: Queue[Optional[PoseRequest]] = Queue()
+        self.stats = BatchingPoserSchedulerStats()
+        self.stats_lock = threading.Lock()
+        self.worker_thread: Optional[threading.Thread] = None
+        self.worker_thread_lock = threading.Lock()
+
+    def start(self):
+        with self.worker_thread_lock:
+            if self.worker_thread is not None:
+                return
+            self.worker_thread = threading.Thread(target=self.run_worker, daemon=True)
+            self.worker_thread.start()
+
+    def stop(self):
+        with self.worker_thread_lock:
+            if self.worker_thread is None:
+                return
+            self.request_queue.put(None)
+            self.worker_thread.join()
+            self.worker_thread = None
+
+    def submit(self, image: Tensor, pose: Tensor) -> Future:
+        if len(image.shape) == 3:
+            image = image.unsqueeze(0)
+        if len(pose.shape) == 1:
+            pose = pose.unsqueeze(0)
+        assert image.shape[0] == 1 and pose.shape[0] == 1
+        self.start()
+        future = Future()
+        self.request_queue.put(PoseRequest(image, pose, future))
+        return future
+
+    def get_posing_outputs(self, image: Tensor, pose: Tensor) -> List[Tensor]:
+        return self.submit(image, pose).result()
+
+    def pose(self, image: Tensor, pose: Tensor, output_index: Optional[int] = None) -> Tensor:
+        if output_index is None:
+            output_index = self.poser.default_output_index
+        return self.get_posing_outputs(image, pose)[output_index]
+
+    def collect_requests(self, first_request: PoseRequest) -> Tuple[List[PoseRequest], bool]:
+        requests = [first_request]
+        deadline = time.perf_counter() + self.max_wait_time
+        while len(requests) < self.max_batch_size:
+            remaining_time = deadline - time.perf_counter()
+            try:
+                if remaining_time <= 0:
+                    request = self.request_queue.get_nowait()
+                else:
+                    request = self.request_queue.get(timeout=remaining_time)
+            except Empty:
+                break
+            if request is None:
+                return requests, True
+            requests.append(request)
+        return requests, False
+
+    def run_worker(self):
+        while True:
+            request = self.request_queue.get()
+            if request is None:
+                return
+            requests, should_stop = self.collect_requests(request)
+            groups: Dict[Tuple, List[PoseRequest]] = {}
+            for request in requests:
+                if request.future.set_running_or_notify_cancel():
+                    groups.setdefault(request.get_group_key(), []).append(request)
+            for group in groups.values():
+                self.process_batch(group)
+            if should_stop:
+                return
+
+    def process_batch(self, requests: List[PoseRequest]):
+        try:
+            image = torch.cat([request.image for request in requests], dim=0)
+            pose = torch.cat([request.pose for request in requests], dim=0)
+            with torch.no_grad():
+                outputs = self.poser.get_posing_outputs(image, pose)
+        except BaseException as e:
+            for request in requests:
+                request.future.set_exception(e)
+            return
+        for i, request in enumerate(requests):
+            request.future.set_result([output[i:i + 1] for output in outputs])
+        with self.stats_lock:
+            self.stats.num_requests += len(requests)
+            self.stats.num_batches += 1
+            self.stats.max_batch_size = max(self.stats.max_batch_size, len(requests))
+
+    def get_stats(self) -> BatchingPoserSchedulerStats:
+        with self.stats_lock:
+            stats = BatchingPoserSchedulerStats()
+            stats.num_requests = self.stats.num_requests
+            stats.num_batches = self.stats.num_batches
+            stats.max_batch_size = self.stats.max_batch_size
+            return stats
+
+    def get_image_size(self) -> int:
+        return self.poser.get_image_size()
+
+    def get_output_length(self) -> int:
+        return self.poser.get_output_length()
+
+    def get_pose_parameter_groups(self) -> List[PoseParameterGroup]:
+        return self.poser.get_pose_parameter_groups()
+
+    def get_num_parameters(self) -> int:
+        return self.poser.get_num_parameters()
+
+    def get_dtype(self) -> torch.dtype:
+        return self.poser.get_dtype()
+
+    def to(self, device: torch.device) -> 'BatchingPoserScheduler':
+        self.stop()
+        self.poser.to(device)
+        return self
@@ -0,0 +1,63 @@
+import argparse
+import functools
+import os
+import time
+
+import torch
+
+from tha4.poser.poser_process_pool import PoserProcessPool, create_character_model_poser, create_mode_07_poser
+
+
+def benchmark(poser_factory, num_workers: int, num_threads_per_worker: int, num_frames: int, batch_size: int,
+              pin_cpus: bool) -> float:
+    pool = PoserProcessPool(poser_factory, num_workers, num_threads_per_worker, pin_cpus)
+    try:
+        pool.start()
+        image = torch.rand(4, pool.image_size, pool.image_size).to(pool.dtype) * 2 - 1
+        poses = torch.zeros(num_frames, pool.num_parameters, dtype=pool.dtype)
+
+        # Warm up every worker once before timing.
+        for _ in pool.pose_sequence(image, poses[:num_workers * batch_size], batch_size):
+            pass
+
+        start_time = time.perf_counter()
+        for _ in pool.pose_sequence(image, poses, batch_size):
+            pass
+        elapsed_time = time.perf_counter() - start_time
+    finally:
+        pool.close()
+    return num_frames / elapsed_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measure the aggregate FPS of the poser process pool on the CPU.')
+    parser.add_argument('--character_model', type=str, required=False, default=None,
+                        help='The YAML file of the character model. Uses the mode_07 poser when not given.')
+    parser.add_argument('--num_workers', type=int, action='append', required=False, default=None,
+                        help='A number of workers to measure. Repeat the option to measure several.')
+    parser.add_argument('--num_threads_per_worker', type=int, default=1)
+    parser.add_argument('--num_frames', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--no_pin_cpus', action='store_true')
+    args = parser.parse_args()
+
+    if args.character_model is not None:
+        poser_factory = functools.partial(create_character_model_poser, args.character_model)
+    else:
+        poser_factory = create_mode_07_poser
+
+    num_workers_list = args.num_workers
+    if num_workers_list is None:
+        max_num_workers = max(1, (os.cpu_count() or 1) // args.num_threads_per_worker)
+        num_workers_list = sorted(set([1, 2, 4, max_num_workers]))
+        num_workers_list = [n for n in num_workers_list if n <= max_num_workers]
+
+    single_worker_fps = None
+    for num_workers in num_workers_list:
+        fps = benchmark(
+            poser_factory, num_workers, args.num_threads_per_worker, args.num_frames, args.batch_size,
+            not args.no_pin_cpus)
+        if single_worker_fps is None:
+            single_worker_fps = fps / num_workers
+        print("workers: %d, threads per worker: %d, fps = %.2f, scaling efficiency = %.2f" % (
+            num_workers, args.num_threads_per_worker, fps, fps / (single_worker_fps * num_workers)))
@@ -1,7 +1,9 @@
+import threading
 from typing import List, Optional, Tuple, Dict, Callable
 
 import torch
 from tha4.shion.core.cached_computation import ComputationState
+from tha4.shion.core.profiler import get_profiler
 from tha4.poser.poser import PoseParameterGroup, Poser
 from torch import Tensor
 from torch.nn import Module
@@ -28,6 +30,9 @@ class GeneralPoser02(Poser):
         self.module_loaders = module_loaders
 
         self.modules = None
+        # Guards loading, moving and freeing the modules. Posing itself only reads the modules and keeps its
+        # intermediate results in a per-call ComputationState, so concurrent pose() calls need no locking.
+        self.modules_lock = threading.Lock()
 
         self.num_parameters = 0
         for pose_parameter in self.pose_parameters:
@@ -39,14 +44,19 @@ class GeneralPoser02(Poser):
         return self.image_size
 
     def get_modules(self):
-        if self.modules is None:
-            self.modules = {}
-            for key in self.module_loaders:
-                module = self.module_loaders[key]()
-                self.modules[key] = module
-                module.to(self.device)
-                module.train(False)
-        return self.modules
+        modules = self.modules
+        if modules is not None:
+            return modules
+        with self.modules_lock:
+            if self.modules is None:
+                modules = {}
+                for key in self.module_loaders:
+                    module = self.module_loaders[key]()
+                    modules[key] = module
+                    module.to(self.device)
+                    module.train(False)
+                self.modules = modules
+            return self.modules
 
     def get_pose_parameter_groups(self) -> List[PoseParameterGroup]:
         return self.pose_parameters
@@ -67,6 +77,8 @@ class GeneralPoser02(Poser):
             image = image.unsqueeze(0)
         if len(pose.shape) == 1:
             pose = pose.unsqueeze(0)
+        if image.shape[0] == 1 and pose.shape[0] > 1:
+            image = image.expand(pose.shape[0], image.shape[1], image.shape[2], image.shape[3])
         if self.subrect is not None:
             image = image[:, :, self.subrect[0][0]:self.subrect[0][1], self.subrect[1][0]:self.subrect[1][1]]
         batch = [image, pose]
@@ -76,13 +88,15 @@ class GeneralPoser02(Poser):
             accumulated_modules={},
             batch=batch,
             outputs={})
-        return self.output_list_func(state)
+        with get_profiler().profile(f"{type(self).__name__}.get_posing_outputs"):
+            return self.output_list_func(state)
 
     def get_output_length(self) -> int:
         return self.output_length
 
     def free(self):
-        self.modules = None
+        with self.modules_lock:
+            self.modules = None
 
     def get_dtype(self) -> torch.dtype:
         return self.dtype
@@ -91,8 +105,9 @@ class GeneralPoser02(Poser):
         if device == self.device:
             return self
         modules = self.get_modules()
-        self.device = device
-        for key in modules:
-            module = modules[key]
-            module.to(self.device)
+        with self.modules_lock:
+            self.device = device
+            for key in modules:
+                module = modules[key]
+                module.to(self.device)
         return self
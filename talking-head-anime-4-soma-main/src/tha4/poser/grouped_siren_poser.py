@@ -0,0 +1,89 @@
+from typing import Dict, Hashable, List, Optional
+
+import torch
+from torch import Tensor
+
+from tha4.nn.siren.face_morpher.siren_face_morpher_00 import SirenFaceMorpher00
+from tha4.nn.siren.grouped.grouped_siren_face_morpher_00 import GroupedSirenFaceMorpher00Executor
+from tha4.nn.siren.grouped.grouped_siren_morpher_03 import GroupedSirenMorpher03Executor
+from tha4.nn.siren.morpher.siren_morpher_03 import SirenMorpher03
+from tha4.poser.modes.mode_14 import load_face_morpher, load_body_morpher
+
+
+class GroupedSirenPoser:
+    def __init__(self,
+                 device: torch.device,
+                 initial_capacity: int = 4,
+                 dtype: torch.dtype = torch.float):
+        self.dtype = dtype
+        self.initial_capacity = initial_capacity
+        self.device = device
+
+        self.face_morpher_executor: Optional[GroupedSirenFaceMorpher00Executor] = None
+        self.body_morpher_executor: Optional[GroupedSirenMorpher03Executor] = None
+        self.character_images: Dict[Hashable, Tensor] = {}
+
+    def add_character(self,
+                      key: Hashable,
+                      character_image: Tensor,
+                      face_morpher: SirenFaceMorpher00,
+                      body_morpher: SirenMorpher03):
+        if self.face_morpher_executor is None:
+            self.face_morpher_executor = GroupedSirenFaceMorpher00Executor(
+                face_morpher.args, self.device, self.initial_capacity, self.dtype)
+        if self.body_morpher_executor is None:
+            self.body_morpher_executor = GroupedSirenMorpher03Executor(
+                body_morpher.args, self.device, self.initial_capacity, self.dtype)
+        self.face_morpher_executor.add_model(key, face_morpher)
+        self.body_morpher_executor.add_model(key, body_morpher)
+        if len(character_image.shape) == 3:
+            character_image = character_image.unsqueeze(0)
+        self.character_images[key] = character_image.to(self.device, self.dtype)
+
+    def add_character_model(self, key: Hashable, character_model):
+        self.add_character(
+            key,
+            character_model.get_character_image(self.device),
+            load_face_morpher(character_model.face_morpher_file_name),
+            load_body_morpher(character_model.body_morpher_file_name))
+
+    def remove_character(self, key: Hashable):
+        if key not in self.character_images:
+            raise RuntimeError("Unknown character: " + str(key))
+        self.face_morpher_executor.remove_model(key)
+        self.body_morpher_executor.remove_model(key)
+        del self.character_images[key]
+
+    def get_character_keys(self) -> List[Hashable]:
+        return list(self.character_images.keys())
+
+    def get_posing_outputs(self, keys: List[Hashable], pose: Tensor) -> List[Tensor]:
+        if len(pose.shape) == 1:
+            pose = pose.unsqueeze(0)
+        assert len(keys) == pose.shape[0]
+        pose = pose.to(self.device, self.dtype)
+
+        with torch.no_grad():
+            face_morpher_output = self.face_morpher_executor.forward(keys, pose[:, 0:39])
+            image = torch.cat([self.character_images[key] for key in keys], dim=0)
+            center_x = 256
+            center_y = 128 + 16
+            image[:, :, center_y - 64:center_y + 64, center_x - 64:center_x + 64] = face_morpher_output
+            body_morpher_output = self.body_morpher_executor.forward(keys, image, pose)
+
+        return body_morpher_output + [face_morpher_output]
+
+    def pose(self, keys: List[Hashable], pose: Tensor, output_index: int = 0) -> Tensor:
+        return self.get_posing_outputs(keys, pose)[output_index]
+
+    def to(self, device: torch.device) -> 'GroupedSirenPoser':
+        if device == self.device:
+            return self
+        self.device = device
+        if self.face_morpher_executor is not None:
+            self.face_morpher_executor.to(device)
+        if self.body_morpher_executor is not None:
+            self.body_morpher_executor.to(device)
+        for key in self.character_images:
+            self.character_images[key] = self.character_images[key].to(device)
+        return self
@@ -1,5 +1,5 @@
 from enum import Enum
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 
 import torch
 from tha4.shion.core.cached_computation import CachedComputationProtocol, ComputationState
@@ -48,23 +48,25 @@ class FiveStepPoserComputationProtocol(CachedComputationProtocol):
     def __init__(self, eyebrow_morphed_image_index: int):
         super().__init__()
         self.eyebrow_morphed_image_index = eyebrow_morphed_image_index
-        self.cached_batch_0 = None
-        self.cached_eyebrow_decomposer_output = None
+        # The last character image and its eyebrow decomposer output, stored as one tuple so that threads posing
+        # concurrently always see a matching pair.
+        self.eyebrow_decomposer_cache: Optional[Tuple[Tensor, List[Tensor]]] = None
 
     def compute_func(self):
         def func(state: ComputationState) -> List[Tensor]:
-            if self.cached_batch_0 is None:
+            cache = self.eyebrow_decomposer_cache
+            if cache is None:
                 new_batch_0 = True
-            elif state.batch[0].shape[0] != self.cached_batch_0.shape[0]:
+            elif state.batch[0].shape != cache[0].shape or state.batch[0].device != cache[0].device:
                 new_batch_0 = True
             else:
-                new_batch_0 = torch.max((state.batch[0] - self.cached_batch_0).abs()).item() > 0
+                new_batch_0 = torch.max((state.batch[0] - cache[0]).abs()).item() > 0
             if not new_batch_0:
-                state.outputs[Network.eyebrow_decomposer.outputs_key] = self.cached_eyebrow_decomposer_output
+                state.outputs[Network.eyebrow_decomposer.outputs_key] = cache[1]
             output = self.get_output(Branch.all_outputs.name, state)
             if new_batch_0:
-                self.cached_batch_0 = state.batch[0]
-                self.cached_eyebrow_decomposer_output = state.outputs[Network.eyebrow_decomposer.outputs_key]
+                self.eyebrow_decomposer_cache = (
+                    state.batch[0], state.outputs[Network.eyebrow_decomposer.outputs_key])
             return output
 
         return func
@@ -1,11 +1,15 @@
 from dataclasses import dataclass
+from enum import Enum
 from typing import List, Optional, Dict, Any
 
 import torch
 from tha4.shion.core.cached_computation import CachedComputationProtocol, ComputationState
 from tha4.shion.core.load_save import torch_load
 from tha4.nn.siren.face_morpher.siren_face_morpher_00 import SirenFaceMorpher00Args, SirenFaceMorpher00
+from tha4.nn.siren.matmul.matmul_siren_face_morpher_00 import MatmulSirenFaceMorpher00
+from tha4.nn.siren.matmul.matmul_siren_morpher_03 import MatmulSirenMorpher03
 from tha4.nn.siren.morpher.siren_morpher_03 import SirenMorpher03, SirenMorpher03Args, SirenMorpherLevelArgs
+from tha4.nn.siren.sparse.sparse_siren_morpher_03 import SparseSirenMorpher03
 from tha4.nn.siren.vanilla.siren import SirenArgs
 from tha4.poser.general_poser_02 import GeneralPoser02
 from tha4.poser.modes.pose_parameters import get_pose_parameters
@@ -15,6 +19,12 @@ KEY_FACE_MORPHER = "face_morpher"
 KEY_BODY_MORPHER = "body_morpher"
 
 
+class SirenEngine(Enum):
+    CONV = 1
+    MATMUL = 2
+    SPARSE = 3
+
+
 @dataclass
 class Keys:
     face_morpher: str = KEY_FACE_MORPHER
@@ -90,8 +100,12 @@ class TwoStepPoserComputationProtocol(CachedComputationProtocol):
             raise RuntimeError("Unsupported key: " + key)
 
 
-def load_face_morpher(file_name: Optional[str] = None):
-    module = SirenFaceMorpher00(
+def load_face_morpher(file_name: Optional[str] = None, engine: SirenEngine = SirenEngine.CONV):
+    if engine == SirenEngine.MATMUL or engine == SirenEngine.SPARSE:
+        module_class = MatmulSirenFaceMorpher00
+    else:
+        module_class = SirenFaceMorpher00
+    module = module_class(
         SirenFaceMorpher00Args(
             image_size=128,
             image_channels=4,
@@ -106,8 +120,17 @@ def load_face_morpher(file_name: Optional[str] = None):
     return module
 
 
-def load_body_morpher(file_name: Optional[str] = None):
-    module = SirenMorpher03(
+def load_body_morpher(
+        file_name: Optional[str] = None,
+        engine: SirenEngine = SirenEngine.CONV,
+        coverage_mask_file_name: Optional[str] = None):
+    if engine == SirenEngine.MATMUL:
+        module_class = MatmulSirenMorpher03
+    elif engine == SirenEngine.SPARSE:
+        module_class = SparseSirenMorpher03
+    else:
+        module_class = SirenMorpher03
+    module = module_class(
         SirenMorpher03Args(
             image_size=512,
             image_channels=4,
@@ -128,13 +151,17 @@ def load_body_morpher(file_name: Optional[str] = None):
             ]))
     if file_name is not None:
         module.load_state_dict(torch_load(file_name))
+    if engine == SirenEngine.SPARSE and coverage_mask_file_name is not None:
+        module.set_coverage_mask(torch_load(coverage_mask_file_name))
     return module
 
 
 def create_poser(
         device: torch.device,
         module_file_names: Optional[Dict[str, str]] = None,
-        default_output_index: int = 0) -> GeneralPoser02:
+        default_output_index: int = 0,
+        engine: SirenEngine = SirenEngine.CONV,
+        coverage_mask_file_name: Optional[str] = None) -> GeneralPoser02:
     if module_file_names is None:
         module_file_names = {}
     if KEY_FACE_MORPHER not in module_file_names:
@@ -146,9 +173,9 @@ def create_poser(
 
     loaders = {
         KEY_FACE_MORPHER:
-            lambda: load_face_morpher(module_file_names[KEY_FACE_MORPHER]),
+            lambda: load_face_morpher(module_file_names[KEY_FACE_MORPHER], engine),
         KEY_BODY_MORPHER:
-            lambda: load_body_morpher(module_file_names[KEY_BODY_MORPHER]),
+            lambda: load_body_morpher(module_file_names[KEY_BODY_MORPHER], engine, coverage_mask_file_name),
     }
 
     return GeneralPoser02(
@@ -0,0 +1,261 @@
+import logging
+import os
+import queue
+import threading
+import traceback
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Iterator
+
+import torch
+import torch.multiprocessing
+from torch import Tensor
+from torch.nn import Module
+
+from tha4.poser.general_poser_02 import GeneralPoser02
+from tha4.poser.poser import Poser
+
+WORKER_READY = -1
+
+
+def create_character_model_poser(character_model_file_name: str, device: torch.device) -> Poser:
+    from tha4.charmodel.character_model import CharacterModel
+
+    return CharacterModel.load(character_model_file_name).get_poser(device)
+
+
+def create_mode_07_poser(device: torch.device) -> Poser:
+    import tha4.poser.modes.mode_07
+
+    return tha4.poser.modes.mode_07.create_poser(device)
+
+
+# The workers get the parent's modules with their parameters moved to shared memory, so N replicas cost the
+# memory of one copy of the weights.
+def share_poser_modules(poser: Poser) -> Optional[Dict[str, Module]]:
+    if not isinstance(poser, GeneralPoser02):
+        return None
+    modules = poser.get_modules()
+    for module in modules.values():
+        module.share_memory()
+    return modules
+
+
+def get_worker_cpus(worker_index: int, num_threads_per_worker: int) -> Optional[List[int]]:
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    available_cpus = sorted(os.sched_getaffinity(0))
+    start = (worker_index * num_threads_per_worker) % len(available_cpus)
+    return [available_cpus[(start + i) % len(available_cpus)] for i in range(num_threads_per_worker)]
+
+
+def run_poser_worker(worker_index: int,
+                     poser_factory: Callable[[torch.device], Poser],
+                     shared_modules: Optional[Dict[str, Module]],
+                     cpus: Optional[List[int]],
+                     num_threads: int,
+                     request_queue,
+                     result_queue):
+    if cpus is not None:
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+
+    try:
+        poser = poser_factory(torch.device('cpu'))
+        if shared_modules is not None:
+            poser.modules = shared_modules
+    except Exception:
+        result_queue.put((WORKER_READY, worker_index, traceback.format_exc()))
+        return
+    result_queue.put((WORKER_READY, worker_index, None))
+
+    while True:
+        request = request_queue.get()
+        if request is None:
+            return
+        request_id, image, pose, output_index = request
+        try:
+            with torch.no_grad():
+                output = poser.pose(image, pose, output_index)
+            result_queue.put((request_id, output, None))
+        except Exception as e:
+            result_queue.put((request_id, None, f"{type(e).__name__}: {e}"))
+
+
+class PoserProcessPool:
+    def __init__(self,
+                 poser_factory: Callable[[torch.device], Poser],
+                 num_workers: Optional[int] = None,
+                 num_threads_per_worker: int = 1,
+                 pin_cpus: bool = True,
+                 share_weights: bool = True,
+                 poll_interval: float = 1.0):
+        if num_workers is None:
+            num_workers = max(1, (os.cpu_count() or 1) // num_threads_per_worker)
+        assert num_workers >= 1
+        assert num_threads_per_worker >= 1
+        assert poll_interval > 0
+        self.poll_interval = poll_interval
+        self.share_weights = share_weights
+        self.pin_cpus = pin_cpus
+        self.num_threads_per_worker = num_threads_per_worker
+        self.num_workers = num_workers
+        self.poser_factory = poser_factory
+
+        self.context = torch.multiprocessing.get_context('spawn')
+        self.request_queue = None
+        self.result_queue = None
+        self.processes = []
+        self.pending_requests: Dict[int, Future] = {}
+        self.pending_requests_lock = threading.Lock()
+        self.next_request_id = 0
+        self.error: Optional[Exception] = None
+        self.closing = False
+        self.collector_thread: Optional[threading.Thread] = None
+        self.image_size = None
+        self.num_parameters = None
+        self.dtype = torch.float
+
+    def start(self):
+        if len(self.processes) > 0:
+            return
+        poser = self.poser_factory(torch.device('cpu'))
+        self.image_size = poser.get_image_size()
+        self.num_parameters = poser.get_num_parameters()
+        self.dtype = poser.get_dtype()
+        shared_modules = share_poser_modules(poser) if self.share_weights else None
+
+        self.request_queue = self.context.Queue()
+        self.result_queue = self.context.Queue()
+        for worker_index in range(self.num_workers):
+            if self.pin_cpus:
+                cpus = get_worker_cpus(worker_index, self.num_threads_per_worker)
+            else:
+                cpus = None
+            process = self.context.Process(
+                target=run_poser_worker,
+                args=(
+                    worker_index,
+                    self.poser_factory,
+                    shared_modules,
+                    cpus,
+                    self.num_threads_per_worker,
+                    self.request_queue,
+                    self.result_queue),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        try:
+            num_ready_workers = 0
+            while num_ready_workers < self.num_workers:
+                request_id, worker_index, error = self.get_result()
+                assert request_id == WORKER_READY
+                if error is not None:
+                    raise RuntimeError(f"Poser worker {worker_index} failed to start:\n{error}")
+                num_ready_workers += 1
+        except Exception:
+            self.terminate()
+            raise
+        logging.info(f"Started {self.num_workers} poser workers with {self.num_threads_per_worker} thread(s) each")
+
+        self.collector_thread = threading.Thread(target=self.collect_results, daemon=True)
+        self.collector_thread.start()
+
+    def check_workers(self):
+        for worker_index, process in enumerate(self.processes):
+            if not process.is_alive():
+                raise RuntimeError(
+                    f"Poser worker {worker_index} exited unexpectedly with exit code {process.exitcode}.")
+
+    def get_result(self):
+        # Waits for the workers without hanging forever when one of them dies.
+        while True:
+            try:
+                return self.result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                self.check_workers()
+
+    def fail_pending_requests(self, error: Exception):
+        with self.pending_requests_lock:
+            self.error = error
+            futures = list(self.pending_requests.values())
+            self.pending_requests.clear()
+        for future in futures:
+            future.set_exception(error)
+
+    def collect_results(self):
+        while True:
+            try:
+                result = self.result_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self.closing:
+                    continue
+                try:
+                    self.check_workers()
+                except RuntimeError as e:
+                    # The request a dead worker was serving is lost, and there is no telling which one it was.
+                    self.fail_pending_requests(e)
+                    return
+                continue
+            if result is None:
+                return
+            request_id, output, error = result
+            with self.pending_requests_lock:
+                future = self.pending_requests.pop(request_id)
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(output.clone())
+
+    def submit(self, image: Tensor, pose: Tensor, output_index: int = 0) -> Future:
+        self.start()
+        future = Future()
+        with self.pending_requests_lock:
+            if self.error is not None:
+                raise RuntimeError(f"The poser process pool has failed: {self.error}")
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            self.pending_requests[request_id] = future
+        self.request_queue.put((request_id, image.cpu(), pose.cpu(), output_index))
+        return future
+
+    def pose_sequence(self,
+                      image: Tensor,
+                      poses: Tensor,
+                      batch_size: int = 1,
+                      output_index: int = 0,
+                      max_pending_batches: Optional[int] = None) -> Iterator[Tensor]:
+        if max_pending_batches is None:
+            max_pending_batches = 2 * self.num_workers
+        image = image.cpu().share_memory_()
+        futures: List[Future] = []
+        for start in range(0, poses.shape[0], batch_size):
+            futures.append(self.submit(image, poses[start:start + batch_size], output_index))
+            while len(futures) >= max_pending_batches:
+                yield futures.pop(0).result()
+        for future in futures:
+            yield future.result()
+
+    def terminate(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        self.processes = []
+
+    def close(self):
+        if len(self.processes) == 0:
+            return
+        self.closing = True
+        for _ in self.processes:
+            self.request_queue.put(None)
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.result_queue.put(None)
+        self.collector_thread.join()
+        self.collector_thread = None
+        self.fail_pending_requests(RuntimeError("The poser process pool was closed."))
+        self.error = None
+        self.closing = False
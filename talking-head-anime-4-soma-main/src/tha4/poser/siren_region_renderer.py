@@ -0,0 +1,100 @@
+import math
+from typing import List, Optional
+
+import torch
+from torch import Tensor
+
+from tha4.nn.siren.siren_region_rendering import PixelRect, resample_image, evaluate_siren_morpher_03, \
+    apply_siren_morpher_03_output, get_sampled_pixel_rect
+from tha4.poser.general_poser_02 import GeneralPoser02
+from tha4.poser.modes.mode_14 import KEY_FACE_MORPHER, KEY_BODY_MORPHER
+
+
+class SirenRegionRenderer:
+    def __init__(self,
+                 poser: GeneralPoser02,
+                 face_center_x: int = 256,
+                 face_center_y: int = 128 + 16,
+                 face_size: int = 128):
+        self.face_size = face_size
+        self.face_center_y = face_center_y
+        self.face_center_x = face_center_x
+        self.poser = poser
+
+    def get_face_rect(self, output_size: int) -> PixelRect:
+        image_size = self.poser.get_image_size()
+        scale = output_size / image_size
+        half_size = self.face_size // 2
+
+        def pixel_range(start: int, end: int):
+            j0 = math.ceil(start * scale - 0.5)
+            j1 = math.floor(end * scale - 0.5)
+            return j0, j1 - j0 + 1
+
+        left, width = pixel_range(self.face_center_x - half_size, self.face_center_x + half_size)
+        top, height = pixel_range(self.face_center_y - half_size, self.face_center_y + half_size)
+        return PixelRect(output_size, top, left, height, width)
+
+    def render_face(self, pose: Tensor, output_size: int, face_rect: Optional[PixelRect] = None):
+        face_morpher = self.poser.get_modules()[KEY_FACE_MORPHER]
+        image_size = self.poser.get_image_size()
+        half_size = self.face_size // 2
+        if face_rect is None:
+            face_rect = self.get_face_rect(output_size)
+        face_crop_rect = PixelRect(
+            image_size,
+            self.face_center_y - half_size,
+            self.face_center_x - half_size,
+            self.face_size,
+            self.face_size)
+        n = pose.shape[0]
+        position = face_rect.get_pixel_centers(pose.device, pose.dtype).expand(n, 2, face_rect.height, face_rect.width)
+        face_position = face_crop_rect.to_local_grid(position).permute(0, 3, 1, 2)
+        face_pose = pose[:, 0:face_morpher.args.pose_size]
+        return face_rect, face_morpher.forward(face_pose, face_position)
+
+    def render(self,
+               image: Tensor,
+               pose: Tensor,
+               output_size: Optional[int] = None,
+               rect: Optional[PixelRect] = None) -> List[Optional[Tensor]]:
+        if output_size is None:
+            output_size = self.poser.get_image_size()
+        if len(image.shape) == 3:
+            image = image.unsqueeze(0)
+        if len(pose.shape) == 1:
+            pose = pose.unsqueeze(0)
+        n = pose.shape[0]
+        if image.shape[0] == 1 and n > 1:
+            image = image.expand(n, image.shape[1], image.shape[2], image.shape[3])
+        body_morpher = self.poser.get_modules()[KEY_BODY_MORPHER]
+
+        # The body morpher runs first so that the face morpher is only evaluated on the part of the face that the
+        # warp actually reads. The last output is None when the region does not sample the face at all.
+        with torch.no_grad():
+            position, siren_output = evaluate_siren_morpher_03(body_morpher, pose, output_size, rect)
+            sampled_rect = get_sampled_pixel_rect(position + siren_output[:, 0:2, :, :], output_size)
+            face_rect = self.get_face_rect(output_size).intersect(sampled_rect)
+            texture = resample_image(image, output_size)
+            face_morpher_output = None
+            if face_rect is not None:
+                face_rect, face_morpher_output = self.render_face(pose, output_size, face_rect)
+                texture = texture.clone()
+                texture[:, :,
+                    face_rect.top:face_rect.top + face_rect.height,
+                    face_rect.left:face_rect.left + face_rect.width] = face_morpher_output
+            body_morpher_output = apply_siren_morpher_03_output(texture, position, siren_output, output_size)
+
+        return body_morpher_output + [face_morpher_output]
+
+    def render_region(self,
+                      image: Tensor,
+                      pose: Tensor,
+                      top: int,
+                      left: int,
+                      height: int,
+                      width: int,
+                      output_size: Optional[int] = None) -> List[Optional[Tensor]]:
+        if output_size is None:
+            output_size = self.poser.get_image_size()
+        return self.render(image, pose, output_size, PixelRect(output_size, top, left, height, width))
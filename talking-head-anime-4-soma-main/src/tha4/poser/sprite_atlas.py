@@ -0,0 +1,253 @@
+import json
+import math
+from typing import List, Optional, Dict
+
+import numpy
+import torch
+from torch import Tensor
+from torch.nn.functional import interpolate
+
+from tha4.poser.poser import Poser, PoseParameterGroup
+
+
+class SpriteAtlasAxis:
+    def __init__(self, parameter_name: str, min_value: float, max_value: float, num_samples: int):
+        assert num_samples >= 2
+        assert max_value > min_value
+        self.num_samples = num_samples
+        self.max_value = max_value
+        self.min_value = min_value
+        self.parameter_name = parameter_name
+
+    def get_values(self) -> List[float]:
+        return [
+            self.min_value + (self.max_value - self.min_value) * i / (self.num_samples - 1)
+            for i in range(self.num_samples)
+        ]
+
+    def to_json(self):
+        return {
+            "parameter_name": self.parameter_name,
+            "min_value": self.min_value,
+            "max_value": self.max_value,
+            "num_samples": self.num_samples,
+        }
+
+    @staticmethod
+    def from_json(data) -> 'SpriteAtlasAxis':
+        return SpriteAtlasAxis(data["parameter_name"], data["min_value"], data["max_value"], data["num_samples"])
+
+    @staticmethod
+    def parse(spec: str) -> 'SpriteAtlasAxis':
+        parts = spec.split(":")
+        if len(parts) != 4:
+            raise RuntimeError(f"An axis must be given as name:min:max:num_samples, got {spec}")
+        return SpriteAtlasAxis(parts[0], float(parts[1]), float(parts[2]), int(parts[3]))
+
+
+def get_parameter_index(pose_parameter_groups: List[PoseParameterGroup], parameter_name: str) -> int:
+    for group in pose_parameter_groups:
+        if parameter_name in group.get_parameter_names():
+            return group.get_parameter_index() + group.get_parameter_names().index(parameter_name)
+    raise RuntimeError(f"Cannot find pose parameter {parameter_name}")
+
+
+class SpriteAtlas:
+    def __init__(self,
+                 axes: List[SpriteAtlasAxis],
+                 base_pose: numpy.ndarray,
+                 images: numpy.ndarray,
+                 image_size: int):
+        assert len(axes) >= 1
+        assert images.dtype == numpy.uint8
+        assert images.shape[0] == math.prod(axis.num_samples for axis in axes)
+        self.image_size = image_size
+        self.images = images
+        self.base_pose = base_pose
+        self.axes = axes
+
+    def get_num_entries(self) -> int:
+        return self.images.shape[0]
+
+    def get_num_bytes(self) -> int:
+        return self.images.nbytes
+
+    def save(self, file_name: str):
+        metadata = {
+            "axes": [axis.to_json() for axis in self.axes],
+            "image_size": self.image_size,
+        }
+        numpy.savez_compressed(
+            file_name,
+            metadata=numpy.array(json.dumps(metadata)),
+            base_pose=self.base_pose,
+            images=self.images)
+
+    @staticmethod
+    def load(file_name: str) -> 'SpriteAtlas':
+        with numpy.load(file_name) as data:
+            metadata = json.loads(str(data["metadata"]))
+            return SpriteAtlas(
+                [SpriteAtlasAxis.from_json(axis) for axis in metadata["axes"]],
+                data["base_pose"],
+                data["images"],
+                metadata["image_size"])
+
+
+def get_sprite_atlas_lattice_poses(axes: List[SpriteAtlasAxis],
+                                   parameter_indices: List[int],
+                                   base_pose: numpy.ndarray) -> numpy.ndarray:
+    grids = numpy.meshgrid(*[numpy.array(axis.get_values()) for axis in axes], indexing='ij')
+    num_entries = math.prod(axis.num_samples for axis in axes)
+    poses = numpy.tile(base_pose.astype(numpy.float32), (num_entries, 1))
+    for parameter_index, grid in zip(parameter_indices, grids):
+        poses[:, parameter_index] = grid.reshape(-1)
+    return poses
+
+
+def quantize_images(images: Tensor) -> Tensor:
+    return torch.round(torch.clip((images.float() + 1.0) / 2.0, 0.0, 1.0) * 255.0).to(torch.uint8)
+
+
+def render_sprite_atlas(poser: Poser,
+                        image: Tensor,
+                        axes: List[SpriteAtlasAxis],
+                        base_pose: numpy.ndarray,
+                        atlas_image_size: Optional[int] = None,
+                        batch_size: int = 8) -> SpriteAtlas:
+    if atlas_image_size is None:
+        atlas_image_size = poser.get_image_size()
+    pose_parameter_groups = poser.get_pose_parameter_groups()
+    parameter_indices = [get_parameter_index(pose_parameter_groups, axis.parameter_name) for axis in axes]
+    poses = get_sprite_atlas_lattice_poses(axes, parameter_indices, base_pose)
+
+    device = image.device
+    images = []
+    with torch.no_grad():
+        for start in range(0, poses.shape[0], batch_size):
+            pose = torch.from_numpy(poses[start:start + batch_size]).to(device).to(poser.get_dtype())
+            output = poser.pose(image, pose)
+            if output.shape[-1] != atlas_image_size:
+                output = interpolate(output.float(), size=(atlas_image_size, atlas_image_size), mode='area')
+            images.append(quantize_images(output).cpu())
+    return SpriteAtlas(axes, base_pose, torch.cat(images, dim=0).numpy(), poser.get_image_size())
+
+
+class SpriteAtlasPoser(Poser):
+    def __init__(self,
+                 atlas: SpriteAtlas,
+                 pose_parameter_groups: List[PoseParameterGroup],
+                 device: torch.device,
+                 dtype: torch.dtype = torch.float):
+        self.dtype = dtype
+        self.device = device
+        self.pose_parameter_groups = pose_parameter_groups
+        self.atlas = atlas
+
+        self.num_parameters = sum(group.get_arity() for group in pose_parameter_groups)
+        self.parameter_indices = [
+            get_parameter_index(pose_parameter_groups, axis.parameter_name) for axis in atlas.axes
+        ]
+        self.strides = []
+        stride = 1
+        for axis in reversed(atlas.axes):
+            self.strides.insert(0, stride)
+            stride *= axis.num_samples
+        self.images: Optional[Tensor] = None
+
+    def get_images(self) -> Tensor:
+        if self.images is None:
+            self.images = torch.from_numpy(self.atlas.images).to(self.device)
+        return self.images
+
+    def get_image_size(self) -> int:
+        return self.atlas.image_size
+
+    def get_output_length(self) -> int:
+        return 1
+
+    def get_pose_parameter_groups(self) -> List[PoseParameterGroup]:
+        return self.pose_parameter_groups
+
+    def get_num_parameters(self) -> int:
+        return self.num_parameters
+
+    def get_dtype(self) -> torch.dtype:
+        return self.dtype
+
+    def to(self, device: torch.device):
+        self.device = device
+        if self.images is not None:
+            self.images = self.images.to(device)
+        return self
+
+    def pose(self, image: Tensor, pose: Tensor, output_index: int = 0) -> Tensor:
+        return self.get_posing_outputs(image, pose)[output_index]
+
+    def get_posing_outputs(self, image: Tensor, pose: Tensor) -> List[Tensor]:
+        if len(pose.shape) == 1:
+            pose = pose.unsqueeze(0)
+        images = self.get_images()
+        pose = pose.to(self.device).float()
+        n = pose.shape[0]
+
+        lower_indices = []
+        fractions = []
+        for axis, parameter_index in zip(self.atlas.axes, self.parameter_indices):
+            t = (pose[:, parameter_index] - axis.min_value) / (axis.max_value - axis.min_value) * (axis.num_samples - 1)
+            t = torch.clip(t, 0.0, axis.num_samples - 1)
+            lower_index = torch.clip(torch.floor(t).long(), 0, axis.num_samples - 2)
+            lower_indices.append(lower_index)
+            fractions.append(t - lower_index.float())
+
+        output = torch.zeros(n, images.shape[1], images.shape[2], images.shape[3], device=self.device)
+        for corner in range(2 ** len(self.atlas.axes)):
+            entry_index = torch.zeros(n, dtype=torch.long, device=self.device)
+            weight = torch.ones(n, device=self.device)
+            for j in range(len(self.atlas.axes)):
+                upper = (corner >> j) & 1
+                entry_index = entry_index + (lower_indices[j] + upper) * self.strides[j]
+                weight = weight * (fractions[j] if upper else 1.0 - fractions[j])
+            output = output + weight.view(n, 1, 1, 1) * images[entry_index].float()
+
+        output = output * (2.0 / 255.0) - 1.0
+        if output.shape[-1] != self.atlas.image_size:
+            output = interpolate(output, size=(self.atlas.image_size, self.atlas.image_size), mode='bilinear',
+                                 align_corners=False)
+        return [output.to(self.dtype)]
+
+
+def evaluate_sprite_atlas(atlas_poser: SpriteAtlasPoser,
+                          poser: Poser,
+                          image: Tensor,
+                          num_samples: int = 64,
+                          batch_size: int = 8,
+                          seed: int = 0) -> Dict[str, float]:
+    atlas = atlas_poser.atlas
+    generator = numpy.random.default_rng(seed)
+    poses = numpy.tile(atlas.base_pose.astype(numpy.float32), (num_samples, 1))
+    for axis, parameter_index in zip(atlas.axes, atlas_poser.parameter_indices):
+        poses[:, parameter_index] = generator.uniform(axis.min_value, axis.max_value, size=num_samples)
+
+    sum_abs_error = 0.0
+    sum_squared_error = 0.0
+    max_abs_error = 0.0
+    num_values = 0
+    with torch.no_grad():
+        for start in range(0, num_samples, batch_size):
+            pose = torch.from_numpy(poses[start:start + batch_size]).to(image.device)
+            expected = (poser.pose(image, pose.to(poser.get_dtype())).float() + 1.0) / 2.0
+            actual = (atlas_poser.pose(image, pose).float() + 1.0) / 2.0
+            diff = torch.abs(torch.clip(expected, 0.0, 1.0) - torch.clip(actual, 0.0, 1.0))
+            sum_abs_error += diff.sum().item()
+            sum_squared_error += (diff ** 2).sum().item()
+            max_abs_error = max(max_abs_error, diff.max().item())
+            num_values += diff.numel()
+
+    mean_squared_error = sum_squared_error / num_values
+    return {
+        "mean_abs_error": sum_abs_error / num_values,
+        "rmse": math.sqrt(mean_squared_error),
+        "psnr": 10.0 * math.log10(1.0 / max(mean_squared_error, 1e-12)),
+        "max_abs_error": max_abs_error,
+    }
@@ -0,0 +1,94 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import torch
+from torch import Tensor
+
+from tha4.poser.poser import Poser
+
+
+def create_poser(character_model_file_name, device: torch.device) -> Tuple[Poser, Tensor]:
+    if character_model_file_name is not None:
+        from tha4.charmodel.character_model import CharacterModel
+
+        character_model = CharacterModel.load(character_model_file_name)
+        poser = character_model.get_poser(device)
+        image = character_model.get_character_image(device)
+    else:
+        import tha4.poser.modes.mode_07
+
+        poser = tha4.poser.modes.mode_07.create_poser(device)
+        image = torch.rand(4, poser.get_image_size(), poser.get_image_size(), device=device) * 2 - 1
+    return poser, image.to(poser.get_dtype())
+
+
+def pose_requests(poser: Poser, requests: List[Tuple[Tensor, Tensor]], num_threads: int) -> List[Tensor]:
+    def pose(request: Tuple[Tensor, Tensor]) -> Tensor:
+        with torch.no_grad():
+            return poser.pose(request[0], request[1])
+
+    if num_threads == 1:
+        return [pose(request) for request in requests]
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        return list(executor.map(pose, requests))
+
+
+def stress_test(poser: Poser,
+                image: Tensor,
+                num_images: int,
+                num_requests: int,
+                num_threads: int,
+                seed: int) -> Tuple[float, float, float]:
+    generator = torch.Generator().manual_seed(seed)
+    # Slightly different copies of the character image make the threads fight over the eyebrow decomposer cache.
+    images = [
+        (image + 0.01 * i * torch.rand(image.shape, generator=generator).to(image.device, image.dtype)).clamp(-1, 1)
+        for i in range(num_images)
+    ]
+    requests = []
+    for i in range(num_requests):
+        pose = torch.rand(1, poser.get_num_parameters(), generator=generator) * 2 - 1
+        requests.append((images[i % num_images], pose.to(image.device, poser.get_dtype())))
+
+    pose_requests(poser, requests[:num_threads], 1)
+
+    start_time = time.perf_counter()
+    expected_outputs = pose_requests(poser, requests, 1)
+    sequential_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    actual_outputs = pose_requests(poser, requests, num_threads)
+    concurrent_time = time.perf_counter() - start_time
+
+    max_abs_diff = max(
+        (expected.float() - actual.float()).abs().max().item()
+        for expected, actual in zip(expected_outputs, actual_outputs))
+    return max_abs_diff, num_requests / sequential_time, num_requests / concurrent_time
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Pose one shared poser from many threads and check the outputs against sequential posing.')
+    parser.add_argument('--character_model', type=str, required=False, default=None,
+                        help='The YAML file of the character model. Uses the mode_07 poser when not given.')
+    parser.add_argument('--num_threads', type=int, default=16)
+    parser.add_argument('--num_images', type=int, default=4)
+    parser.add_argument('--num_requests', type=int, default=128)
+    parser.add_argument('--num_rounds', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=1e-4)
+    parser.add_argument('--device', type=str, default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    poser, image = create_poser(args.character_model, torch.device(args.device))
+    failed = False
+    for round_index in range(args.num_rounds):
+        max_abs_diff, sequential_fps, concurrent_fps = stress_test(
+            poser, image, args.num_images, args.num_requests, args.num_threads, round_index)
+        ok = max_abs_diff <= args.tolerance
+        failed = failed or not ok
+        print("round %d: max abs diff = %e (%s), sequential = %.2f fps, %d threads = %.2f fps" % (
+            round_index, max_abs_diff, "ok" if ok else "MISMATCH", sequential_fps, args.num_threads, concurrent_fps))
+    if failed:
+        raise RuntimeError("Concurrent posing produced outputs that differ from sequential posing.")
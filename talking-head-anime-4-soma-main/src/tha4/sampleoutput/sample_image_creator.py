@@ -5,10 +5,10 @@ from typing import List
 
 import numpy
 import torch
-from matplotlib import cm
 from torch import Tensor
 from torch.nn.functional import interpolate
 
+from tha4.sampleoutput.sample_output_writer import get_sample_output_writer
 from tha4.shion.base.image_util import save_numpy_image
 
 
@@ -55,6 +55,8 @@ def torch_rgba_to_numpy_image(torch_image: Tensor, min_pixel_value=-1.0, max_pix
 
 
 def torch_grid_change_to_numpy_image(torch_image, num_channels=3):
+    from matplotlib import cm
+
     height = torch_image.shape[1]
     width = torch_image.shape[2]
     size_image = (torch_image[0, :, :] ** 2 + torch_image[1, :, :] ** 2).sqrt().view(height, width, 1).numpy()
@@ -71,63 +73,102 @@ def torch_grid_change_to_numpy_image(torch_image, num_channels=3):
         raise RuntimeError("Unsupported num_channels: " + str(num_channels))
 
 
+def numpy_grid_change_to_numpy_image(grid_change: numpy.ndarray, num_channels=3):
+    from matplotlib import cm
+
+    size_image = numpy.sqrt(grid_change[..., 0] ** 2 + grid_change[..., 1] ** 2)[..., numpy.newaxis]
+    hsv = cm.get_cmap('hsv')
+    angle_image = hsv((numpy.arctan2(grid_change[..., 0], grid_change[..., 1]) + math.pi) / (2 * math.pi)) * 3
+    numpy_image = size_image * angle_image[..., 0:3]
+    if num_channels == 3:
+        return numpy_image
+    elif num_channels == 4:
+        return numpy.concatenate([numpy_image, numpy.ones_like(size_image)], axis=-1)
+    else:
+        raise RuntimeError("Unsupported num_channels: " + str(num_channels))
+
+
+def assemble_sample_output_image(cells: numpy.ndarray, grid_change_columns: List[bool], image_channels: int):
+    num_rows, num_cols, _, cell_size, _ = cells.shape
+    cells = cells.transpose(0, 1, 3, 4, 2)
+    output_image = (cells - -1.0) / 2.0
+    if image_channels == 4:
+        output_image = numpy.clip(output_image, 0.0, 1.0)
+    grid_change_columns = numpy.array(grid_change_columns, dtype=bool)
+    if grid_change_columns.any():
+        output_image[:, grid_change_columns] = numpy_grid_change_to_numpy_image(
+            cells[:, grid_change_columns, :, :, 0:2], num_channels=image_channels)
+    return output_image.transpose(0, 2, 1, 3, 4).reshape(num_rows * cell_size, num_cols * cell_size, image_channels)
+
+
+def write_sample_output_image(
+        cells: numpy.ndarray, grid_change_columns: List[bool], image_channels: int, file_name: str) -> str:
+    output_image = assemble_sample_output_image(cells, grid_change_columns, image_channels)
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    save_numpy_image(output_image, file_name, save_straight_alpha=True)
+    return file_name
+
+
 class SampleImageSaver:
     def __init__(self,
                  image_size: int,
                  cell_size: int,
                  image_channels: int,
-                 sample_image_specs: List[SampleImageSpec]):
+                 sample_image_specs: List[SampleImageSpec],
+                 save_in_background: bool = True):
         super().__init__()
+        self.save_in_background = save_in_background
         self.sample_image_specs = sample_image_specs
         self.cell_size = cell_size
         self.image_channels = image_channels
         self.image_size = image_size
 
+    def get_column_cells(self, image: Tensor, spec: SampleImageSpec) -> Tensor:
+        image = image.detach()
+        if spec.image_type == ImageType.COLOR:
+            n, c, h, w = image.shape
+            green_screen = torch.tensor([-1.0, 1.0, -1.0], device=image.device, dtype=image.dtype).view(1, 3, 1, 1)
+            alpha = (image[:, 3:4, :, :] + 1.0) * 0.5
+            rgb = image[:, 0:3, :, :] * alpha + green_screen * (1 - alpha)
+            image = torch.cat([rgb, torch.ones_like(alpha)], dim=1)
+        elif spec.image_type == ImageType.GRID_CHANGE:
+            pass
+        elif spec.image_type == ImageType.SIGMOID_LOGIT:
+            image = torch.sigmoid(image)
+            image = image.repeat(1, self.image_channels, 1, 1)
+            image = image * 2.0 - 1.0
+        else:
+            if image.shape[1] == 1:
+                image = image.repeat(1, self.image_channels, 1, 1)
+            image = image * 2.0 - 1.0
+        if self.cell_size != self.image_size:
+            image = interpolate(image, size=self.cell_size)
+        if image.shape[1] > self.image_channels:
+            image = image[:, 0:self.image_channels]
+        elif image.shape[1] < self.image_channels:
+            n, c, h, w = image.shape
+            padding = torch.zeros(n, self.image_channels - c, h, w, device=image.device, dtype=image.dtype)
+            image = torch.cat([image, padding], dim=1)
+        return image.float()
+
+    def get_cells(self, batch: List[Tensor], outputs: List[Tensor]) -> Tensor:
+        columns = []
+        for spec in self.sample_image_specs:
+            if spec.image_source == ImageSource.BATCH:
+                image = batch[spec.index]
+            else:
+                image = outputs[spec.index]
+            columns.append(self.get_column_cells(image, spec))
+        return torch.stack(columns, dim=1).cpu()
+
     def save_sample_output_image(self, batch: List[Tensor], outputs: List[Tensor], file_name: str):
-        num_cols = len(self.sample_image_specs)
-
-        num_rows = batch[0].shape[0]
-        output_image = numpy.zeros([self.cell_size * num_rows, self.cell_size * num_cols, self.image_channels])
-
-        for image_index in range(num_rows):
-            row = image_index
-            start_row = row * self.cell_size
-
-            for col in range(num_cols):
-                spec = self.sample_image_specs[col]
-                start_col = col * self.cell_size
-
-                if spec.image_source == ImageSource.BATCH:
-                    image = batch[spec.index][image_index].clone()
-                else:
-                    image = outputs[spec.index][image_index].clone()
-
-                if spec.image_type == ImageType.COLOR:
-                    c, h, w = image.shape
-                    green_screen = torch.ones(3, h, w, device=image.device) * -1.0
-                    green_screen[1, :, :] = 1.0
-                    alpha = (image[3:4, :, :] + 1.0) * 0.5
-                    image[0:3, :, :] = image[0:3, :, :] * alpha + green_screen * (1 - alpha)
-                    image[3:4, :, :] = 1.0
-                    image = image.detach().cpu()
-                elif spec.image_type == ImageType.GRID_CHANGE:
-                    image = image.detach().cpu()
-                elif spec.image_type == ImageType.SIGMOID_LOGIT:
-                    image = torch.sigmoid(image)
-                    image = image.repeat(self.image_channels, 1, 1)
-                    image = image * 2.0 - 1.0
-                    image = image.detach().cpu()
-                else:
-                    if image.shape[0] == 1:
-                        image = image.repeat(self.image_channels, 1, 1)
-                    image = image * 2.0 - 1.0
-                    image = image.detach().cpu()
-
-                output_image[start_row:start_row + self.cell_size, start_col:start_col + self.cell_size, :] \
-                    = self.convert_to_numpy_image(image)
-
-        os.makedirs(os.path.dirname(file_name), exist_ok=True)
-        save_numpy_image(output_image, file_name, save_straight_alpha=True)
+        cells = self.get_cells(batch, outputs).numpy()
+        grid_change_columns = [spec.image_type == ImageType.GRID_CHANGE for spec in self.sample_image_specs]
+        if self.save_in_background:
+            get_sample_output_writer().submit(
+                write_sample_output_image, cells, grid_change_columns, self.image_channels, file_name)
+        else:
+            write_sample_output_image(cells, grid_change_columns, self.image_channels, file_name)
 
     def save_sample_output_data(self,
                                 batch: List[Tensor],
@@ -136,13 +177,3 @@ class SampleImageSaver:
                                 examples_seen_so_far: int):
         file_name = "%s/sample_output_%010d.png" % (prefix, examples_seen_so_far)
         self.save_sample_output_image(batch, outputs, file_name)
-
-    def convert_to_numpy_image(self, image: torch.Tensor):
-        if self.cell_size != self.image_size:
-            image = interpolate(image.unsqueeze(0), size=self.cell_size).squeeze(0)
-        if image.shape[0] == 2:
-            return torch_grid_change_to_numpy_image(image, num_channels=self.image_channels)
-        elif self.image_channels == 3:
-            return torch_rgb_to_numpy_image(image)
-        else:
-            return torch_rgba_to_numpy_image(image)
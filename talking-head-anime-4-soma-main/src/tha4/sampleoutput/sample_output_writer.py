@@ -0,0 +1,64 @@
+import logging
+from concurrent.futures import ProcessPoolExecutor, Future
+from typing import Callable, List, Optional
+
+import torch.multiprocessing
+
+
+class SampleOutputWriter:
+    def __init__(self, max_pending_writes: int = 4):
+        assert max_pending_writes >= 1
+        self.max_pending_writes = max_pending_writes
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.pending_writes: List[Future] = []
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=torch.multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def submit(self, func: Callable, *args):
+        self.collect_finished_writes()
+        while len(self.pending_writes) >= self.max_pending_writes:
+            self.wait_for_write(self.pending_writes.pop(0))
+        self.pending_writes.append(self.get_executor().submit(func, *args))
+
+    def collect_finished_writes(self):
+        pending_writes = []
+        for future in self.pending_writes:
+            if future.done():
+                self.wait_for_write(future)
+            else:
+                pending_writes.append(future)
+        self.pending_writes = pending_writes
+
+    @staticmethod
+    def wait_for_write(future: Future):
+        try:
+            file_name = future.result()
+            logging.info(f"Saved {file_name}")
+        except Exception as e:
+            logging.error(f"Failed to save a sample output: {e}")
+
+    def wait(self):
+        for future in self.pending_writes:
+            self.wait_for_write(future)
+        self.pending_writes = []
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+sample_output_writer = None
+
+
+def get_sample_output_writer() -> SampleOutputWriter:
+    global sample_output_writer
+    if sample_output_writer is None:
+        sample_output_writer = SampleOutputWriter()
+    return sample_output_writer
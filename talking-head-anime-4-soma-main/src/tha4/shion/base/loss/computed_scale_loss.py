@@ -18,5 +18,5 @@ class ComputedScaleLoss(Loss):
         scale = self.scale_func(state)
         loss = self.weight * scale * loss
         if log_func is not None:
-            log_func("loss", loss.item())
+            log_func("loss", loss.detach())
         return loss
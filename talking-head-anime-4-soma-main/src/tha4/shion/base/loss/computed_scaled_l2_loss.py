@@ -25,5 +25,5 @@ class ComputedScaledL2Loss(Loss):
         diff = (expected - actual) * element_scale
         loss = self.weight * (diff ** 2).mean()
         if log_func is not None:
-            log_func("loss", loss.item())
+            log_func("loss", loss.detach())
         return loss
@@ -24,6 +24,6 @@ class TimeDependentlyWeightedLoss(Loss):
         loss_value = base_value * weight
 
         if log_func is not None:
-            log_func("loss", loss_value.item())
+            log_func("loss", loss_value.detach())
 
         return loss_value
@@ -27,3 +27,75 @@ class DecayAccumulator(ModuleAccumulator):
     def accumulate(self, module: Module, output: Module, examples_seen_so_far: Optional[int] = None) -> Module:
         accumulate_modules(module, output, self.decay)
         return output
+
+
+# Opt-in: trainers use it only when given one, e.g. through the module_accumulator argument of the SIREN trainer
+# arguments. With offload_to_cpu, the running average is kept only in a CPU shadow of the parameters, so updates do no
+# arithmetic on the device. The shadow is copied into the accumulated module when the trainer calls materialize(),
+# before the module is saved, evaluated or used for sample outputs.
+class ForeachDecayAccumulator(ModuleAccumulator):
+    def __init__(self, decay: float = 0.999, update_interval: int = 1, offload_to_cpu: bool = False):
+        assert update_interval >= 1
+        self.offload_to_cpu = offload_to_cpu
+        self.update_interval = update_interval
+        self.decay = decay
+
+        self.num_calls = 0
+        self.cached_module_ids = None
+        self.new_parameters = None
+        self.accumulated_parameters = None
+        self.shadow_parameters = None
+        self.new_buffers = None
+        self.accumulated_buffers = None
+
+    def get_effective_decay(self) -> float:
+        return self.decay ** self.update_interval
+
+    def update_cache(self, module: Module, output: Module):
+        if self.cached_module_ids == (id(module), id(output)):
+            return
+        new_parameters = dict(module.named_parameters())
+        accumulated_parameters = dict(output.named_parameters())
+        assert new_parameters.keys() == accumulated_parameters.keys()
+        self.new_parameters = [new_parameters[key] for key in new_parameters]
+        self.accumulated_parameters = [accumulated_parameters[key].data for key in new_parameters]
+        if self.offload_to_cpu:
+            self.shadow_parameters = [
+                p.detach().to(torch.device('cpu'), copy=True) for p in self.accumulated_parameters
+            ]
+        else:
+            self.shadow_parameters = None
+        new_buffers = dict(module.named_buffers())
+        accumulated_buffers = dict(output.named_buffers())
+        self.new_buffers = [new_buffers[key] for key in new_buffers]
+        self.accumulated_buffers = [accumulated_buffers[key] for key in new_buffers]
+        self.cached_module_ids = (id(module), id(output))
+
+    def accumulate(self, module: Module, output: Module, examples_seen_so_far: Optional[int] = None) -> Module:
+        self.num_calls += 1
+        if self.num_calls % self.update_interval != 0:
+            return output
+        self.update_cache(module, output)
+
+        with torch.no_grad():
+            if self.offload_to_cpu:
+                new_parameters = [p.detach().to(torch.device('cpu')) for p in self.new_parameters]
+                averaged_parameters = self.shadow_parameters
+            else:
+                new_parameters = [p.detach() for p in self.new_parameters]
+                averaged_parameters = self.accumulated_parameters
+            decay = self.get_effective_decay()
+            if len(averaged_parameters) > 0:
+                torch._foreach_mul_(averaged_parameters, decay)
+                torch._foreach_add_(averaged_parameters, new_parameters, alpha=1 - decay)
+            for accumulated_buffer, new_buffer in zip(self.accumulated_buffers, self.new_buffers):
+                accumulated_buffer.copy_(new_buffer)
+        return output
+
+    def materialize(self, output: Module) -> Module:
+        if self.shadow_parameters is None or self.cached_module_ids is None or self.cached_module_ids[1] != id(output):
+            return output
+        with torch.no_grad():
+            for accumulated, shadow in zip(self.accumulated_parameters, self.shadow_parameters):
+                accumulated.copy_(shadow)
+        return output
@@ -5,6 +5,8 @@ import torch
 from torch import Tensor
 from torch.nn import Module
 
+from tha4.shion.core.profiler import get_profiler
+
 
 class ComputationState:
     def __init__(self,
@@ -44,7 +46,12 @@ class CachedComputationProtocol(ABC):
         if key in state.outputs:
             return state.outputs[key]
         else:
-            output = self.compute_output(key, state)
+            profiler = get_profiler()
+            if profiler.enabled:
+                with profiler.profile(f"{type(self).__name__}.{key}"):
+                    output = self.compute_output(key, state)
+            else:
+                output = self.compute_output(key, state)
             state.outputs[key] = output
             return state.outputs[key]
 
@@ -8,3 +8,8 @@ class ModuleAccumulator(ABC):
     @abstractmethod
     def accumulate(self, module: Module, output: Module, examples_seen_so_far: Optional[int] = None) -> Module:
         pass
+
+    # Called before the accumulated module is saved or evaluated. Accumulators that keep the running average somewhere
+    # else copy it into the output module here.
+    def materialize(self, output: Module) -> Module:
+        return output
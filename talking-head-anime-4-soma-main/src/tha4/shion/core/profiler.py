@@ -0,0 +1,212 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import nullcontext
+from typing import Dict, List, Optional
+
+import torch
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * (len(sorted_values) - 1)))))
+    return sorted_values[index]
+
+
+class ProfileStatistics:
+    def __init__(self,
+                 key: str,
+                 num_calls: int,
+                 wall_time_ms: List[float],
+                 device_time_ms: List[float],
+                 peak_allocated_memory_bytes: List[int]):
+        self.key = key
+        self.num_calls = num_calls
+        self.num_samples = len(wall_time_ms)
+
+        sorted_wall_time = sorted(wall_time_ms)
+        self.mean_wall_time_ms = sum(sorted_wall_time) / max(1, len(sorted_wall_time))
+        self.median_wall_time_ms = percentile(sorted_wall_time, 0.5)
+        self.p95_wall_time_ms = percentile(sorted_wall_time, 0.95)
+        self.max_wall_time_ms = sorted_wall_time[-1] if len(sorted_wall_time) > 0 else 0.0
+
+        if len(device_time_ms) > 0:
+            self.mean_device_time_ms = sum(device_time_ms) / len(device_time_ms)
+        else:
+            self.mean_device_time_ms = None
+
+        if len(peak_allocated_memory_bytes) > 0:
+            self.max_peak_allocated_memory_bytes = max(peak_allocated_memory_bytes)
+        else:
+            self.max_peak_allocated_memory_bytes = None
+
+    def __str__(self):
+        output = f"{self.key}: calls = {self.num_calls}, " \
+                 f"wall mean/p50/p95/max (ms) = {self.mean_wall_time_ms:.3f}/{self.median_wall_time_ms:.3f}/" \
+                 f"{self.p95_wall_time_ms:.3f}/{self.max_wall_time_ms:.3f}"
+        if self.mean_device_time_ms is not None:
+            output += f", device mean (ms) = {self.mean_device_time_ms:.3f}"
+        if self.max_peak_allocated_memory_bytes is not None:
+            output += f", peak allocated (MiB) = {self.max_peak_allocated_memory_bytes / 2 ** 20:.1f}"
+        return output
+
+
+class ProfileRecord:
+    def __init__(self, profiler: 'Profiler', key: str):
+        self.profiler = profiler
+        self.key = key
+        self.start_time = None
+        self.start_event = None
+        self.end_event = None
+        self.peak_allocated_memory_bytes = 0
+
+    def __enter__(self):
+        if self.profiler.is_device_timing_available():
+            self.start_event = torch.cuda.Event(enable_timing=True)
+            self.end_event = torch.cuda.Event(enable_timing=True)
+            self.profiler.start_memory_record(self)
+            self.start_event.record()
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall_time_ms = (time.perf_counter() - self.start_time) * 1000.0
+        if self.end_event is not None:
+            self.end_event.record()
+            peak_allocated_memory_bytes = self.profiler.end_memory_record(self)
+        else:
+            peak_allocated_memory_bytes = None
+        self.profiler.add_record(
+            self.key, wall_time_ms, self.start_event, self.end_event, peak_allocated_memory_bytes)
+        return False
+
+
+class Profiler:
+    def __init__(self, window_size: int = 256, log_interval: Optional[float] = None, enabled: bool = False):
+        assert window_size >= 1
+        self.window_size = window_size
+        self.log_interval = log_interval
+        self.enabled = enabled
+
+        self.lock = threading.Lock()
+        self.num_calls: Dict[str, int] = {}
+        self.wall_time_ms: Dict[str, deque] = {}
+        self.device_time_ms: Dict[str, deque] = {}
+        self.peak_allocated_memory_bytes: Dict[str, deque] = {}
+        self.pending_events: deque = deque()
+        self.open_memory_records: List[ProfileRecord] = []
+        self.last_log_time = time.time()
+
+    def enable(self, log_interval: Optional[float] = None):
+        if log_interval is not None:
+            self.log_interval = log_interval
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.num_calls = {}
+            self.wall_time_ms = {}
+            self.device_time_ms = {}
+            self.peak_allocated_memory_bytes = {}
+            self.pending_events = deque()
+
+    def is_device_timing_available(self) -> bool:
+        return torch.cuda.is_available() and torch.cuda.is_initialized()
+
+    # The CUDA peak memory counter is shared by the whole process, and profiled regions nest (computed keys call each
+    # other). Before a region resets the counter, the peak so far is folded into every region that is still open, so
+    # an enclosing region still reports the peak over all of its duration.
+    def start_memory_record(self, record: ProfileRecord):
+        with self.lock:
+            peak_allocated_memory_bytes = torch.cuda.max_memory_allocated()
+            for open_record in self.open_memory_records:
+                open_record.peak_allocated_memory_bytes = max(
+                    open_record.peak_allocated_memory_bytes, peak_allocated_memory_bytes)
+            torch.cuda.reset_peak_memory_stats()
+            self.open_memory_records.append(record)
+
+    def end_memory_record(self, record: ProfileRecord) -> int:
+        with self.lock:
+            if record in self.open_memory_records:
+                self.open_memory_records.remove(record)
+            return max(record.peak_allocated_memory_bytes, torch.cuda.max_memory_allocated())
+
+    def profile(self, key: str):
+        if not self.enabled:
+            return nullcontext()
+        return ProfileRecord(self, key)
+
+    def get_window(self, windows: Dict[str, deque], key: str) -> deque:
+        if key not in windows:
+            windows[key] = deque(maxlen=self.window_size)
+        return windows[key]
+
+    def add_record(self,
+                   key: str,
+                   wall_time_ms: float,
+                   start_event: Optional[torch.cuda.Event],
+                   end_event: Optional[torch.cuda.Event],
+                   peak_allocated_memory_bytes: Optional[int]):
+        with self.lock:
+            self.num_calls[key] = self.num_calls.get(key, 0) + 1
+            self.get_window(self.wall_time_ms, key).append(wall_time_ms)
+            if peak_allocated_memory_bytes is not None:
+                self.get_window(self.peak_allocated_memory_bytes, key).append(peak_allocated_memory_bytes)
+            if start_event is not None:
+                self.pending_events.append((key, start_event, end_event))
+                self.collect_device_times(wait=False)
+        if self.log_interval is not None and time.time() - self.last_log_time >= self.log_interval:
+            self.log_statistics()
+
+    def collect_device_times(self, wait: bool):
+        while len(self.pending_events) > 0:
+            key, start_event, end_event = self.pending_events[0]
+            if wait:
+                end_event.synchronize()
+            elif not end_event.query():
+                return
+            self.pending_events.popleft()
+            self.get_window(self.device_time_ms, key).append(start_event.elapsed_time(end_event))
+
+    def get_statistics(self) -> Dict[str, ProfileStatistics]:
+        with self.lock:
+            self.collect_device_times(wait=True)
+            return {
+                key: ProfileStatistics(
+                    key,
+                    self.num_calls[key],
+                    list(self.wall_time_ms[key]),
+                    list(self.device_time_ms.get(key, [])),
+                    list(self.peak_allocated_memory_bytes.get(key, [])))
+                for key in self.num_calls
+            }
+
+    def log_statistics(self):
+        self.last_log_time = time.time()
+        statistics = sorted(self.get_statistics().values(), key=lambda x: x.mean_wall_time_ms, reverse=True)
+        if len(statistics) == 0:
+            return
+        logging.info("Profile statistics (slowest first):\n" + "\n".join(str(x) for x in statistics))
+
+
+def create_profiler_from_environment() -> Profiler:
+    log_interval = os.environ.get("THA4_PROFILE_LOG_INTERVAL", None)
+    return Profiler(
+        log_interval=float(log_interval) if log_interval is not None else None,
+        enabled=os.environ.get("THA4_PROFILE", "0") not in ["", "0"])
+
+
+profiler = None
+
+
+def get_profiler() -> Profiler:
+    global profiler
+    if profiler is None:
+        profiler = create_profiler_from_environment()
+    return profiler
@@ -3,23 +3,25 @@ import logging
 import os.path
 import time
 from datetime import datetime
-from typing import Dict, Optional, Callable, Any
+from typing import Dict, Optional, Callable, Any, List
 
 import torch
 import torch.distributed
 from torch.nn.parallel import DistributedDataParallel
-from torch.utils.data import Dataset, DataLoader, DistributedSampler
+from torch.utils.data import Dataset, DataLoader, DistributedSampler, Sampler
 from torch.utils.tensorboard import SummaryWriter
 
+from tha4.sampleoutput.sample_output_writer import get_sample_output_writer
 from tha4.shion.core.load_save import torch_save, torch_load
 from tha4.shion.core.loss import Loss
 from tha4.shion.core.module_accumulator import ModuleAccumulator
 from tha4.shion.core.module_factory import ModuleFactory
 from tha4.shion.core.training.distrib.device_mapper import SimpleCudaDeviceMapper
 from tha4.shion.core.training.distrib.distributed_training_states import DistributedTrainingState
+from tha4.shion.core.training.metrics_collector import MetricsCollector
 from tha4.shion.core.training.sample_output_protocol import SampleOutputProtocol
 from tha4.shion.core.training.training_protocol import TrainingProtocol
-from tha4.shion.core.training.util import set_learning_rate, create_log_func, get_least_greater_multiple
+from tha4.shion.core.training.util import set_learning_rate, get_least_greater_multiple
 from tha4.shion.core.training.validation_protocol import ValidationProtocol
 
 KEY_CHECKPOINT = 'checkpoint'
@@ -42,7 +44,11 @@ class DistributedTrainer:
                  pretrained_module_file_names: Dict[str, str],
                  example_per_snapshot: int,
                  num_data_loader_workers: int = 8,
-                 distrib_backend: str = 'gloo'):
+                 distrib_backend: str = 'gloo',
+                 training_batch_func: Optional[Callable[[List[torch.Tensor], torch.device], List[torch.Tensor]]] = None,
+                 training_sampler_factory: Optional[Callable[[Dataset], Sampler]] = None):
+        self.training_sampler_factory = training_sampler_factory
+        self.training_batch_func = training_batch_func
         self.distrib_backend = distrib_backend
         self.num_data_loader_workers = num_data_loader_workers
         self.accumulators = accumulators
@@ -101,6 +107,12 @@ class DistributedTrainer:
             self.save_sample_output_data(rank, device)
             return torch_load(self.get_sample_output_data_file_name())
 
+    def get_early_stop_marker_file_name(self) -> str:
+        return self.prefix + "/early_stopped.txt"
+
+    def has_stopped_early(self) -> bool:
+        return os.path.exists(self.get_early_stop_marker_file_name())
+
     def get_snapshot_prefix(self) -> str:
         return self.prefix + "/snapshot"
 
@@ -112,8 +124,12 @@ class DistributedTrainer:
             self.training_protocol.get_optimizer_factories(),
             world_size)
 
+    @staticmethod
+    def get_validation_state_file_name(prefix: str) -> str:
+        return "%s/validation_state.pt" % prefix
+
     def load_training_state(self, prefix, rank: int, local_rank: int, device: torch.device) -> DistributedTrainingState:
-        return DistributedTrainingState.load(
+        training_state = DistributedTrainingState.load(
             prefix,
             self.module_factories,
             self.accumulators,
@@ -121,6 +137,19 @@ class DistributedTrainer:
             rank,
             local_rank,
             device)
+        validation_state_file_name = DistributedTrainer.get_validation_state_file_name(prefix)
+        if self.validation_protocol is not None and os.path.exists(validation_state_file_name):
+            self.validation_protocol.load_state_dict(torch_load(validation_state_file_name))
+            logging.info("Loaded %s" % validation_state_file_name)
+        return training_state
+
+    def save_training_state(self, training_state: DistributedTrainingState, prefix: str, rank: int, local_rank: int):
+        training_state.save(prefix, rank, lambda: self.barrier(local_rank))
+        if self.validation_protocol is not None and rank == 0:
+            torch_save(
+                self.validation_protocol.state_dict(), DistributedTrainer.get_validation_state_file_name(prefix))
+            logging.info("Saved %s" % DistributedTrainer.get_validation_state_file_name(prefix))
+        self.barrier(local_rank)
 
     @staticmethod
     def checkpoint_prefix(prefix: str, checkpoint_index: int) -> str:
@@ -164,7 +193,7 @@ class DistributedTrainer:
                         self.get_checkpoint_prefix(checkpoint_index), rank, local_rank, device)
 
         training_state = self.get_initial_training_state(rank, local_rank, device)
-        training_state.save(self.get_checkpoint_prefix(0), rank, lambda: self.barrier(local_rank))
+        self.save_training_state(training_state, self.get_checkpoint_prefix(0), rank, local_rank)
         training_state = self.load_training_state(self.get_checkpoint_prefix(0), rank, local_rank, device)
         return training_state
 
@@ -197,10 +226,13 @@ class DistributedTrainer:
         batch_size = self.training_protocol.get_batch_size()
         dataset = self.training_dataset
         if self.training_data_loader is None:
-            self.training_data_sampler = DistributedSampler(
-                dataset,
-                shuffle=True,
-                drop_last=True)
+            if self.training_sampler_factory is not None:
+                self.training_data_sampler = self.training_sampler_factory(dataset)
+            else:
+                self.training_data_sampler = DistributedSampler(
+                    dataset,
+                    shuffle=True,
+                    drop_last=True)
             self.training_data_loader = DataLoader(
                 dataset,
                 batch_size=batch_size,
@@ -221,7 +253,10 @@ class DistributedTrainer:
             self.training_data_sampler.set_epoch(epoch_index)
             self.training_data_loader_iter = iter(self.training_data_loader)
             batch = next(self.training_data_loader_iter)
-        return [x.to(device) for x in batch]
+        batch = [x.to(device) for x in batch]
+        if self.training_batch_func is not None:
+            batch = self.training_batch_func(batch, device)
+        return batch
 
     def get_next_checkpoint_num_examples(self, examples_seen_so_far) -> int:
         next_index = next(
@@ -278,6 +313,33 @@ class DistributedTrainer:
                 checkpoint_index = i
         return checkpoint_index
 
+    def should_stop_training(self, rank: int, device: torch.device) -> bool:
+        if self.distrib_backend == 'nccl':
+            flag_device = device
+        else:
+            flag_device = torch.device('cpu')
+        flag = torch.zeros(1, dtype=torch.int64, device=flag_device)
+        if rank == 0 and self.validation_protocol.should_stop_training():
+            flag[0] = 1
+        torch.distributed.broadcast(flag, 0)
+        return flag.item() == 1
+
+    def materialize_accumulated_modules(self, training_state: DistributedTrainingState):
+        for module_name in self.accumulators:
+            self.accumulators[module_name].materialize(training_state.accumulated_modules[module_name])
+
+    def stop_training_early(self, training_state: DistributedTrainingState, rank: int, local_rank: int):
+        self.materialize_accumulated_modules(training_state)
+        final_checkpoint_index = len(self.checkpoint_examples) - 1
+        self.save_training_state(training_state, self.get_checkpoint_prefix(final_checkpoint_index), rank, local_rank)
+        if rank == 0:
+            with open(self.get_early_stop_marker_file_name(), "wt") as fout:
+                fout.write(f"{training_state.examples_seen_so_far}\n")
+        self.barrier(local_rank)
+        logging.info(
+            f"Validation loss has plateaued. Stopped training after {training_state.examples_seen_so_far} examples "
+            f"and saved the final checkpoint.")
+
     def barrier(self, local_rank: int):
         if self.distrib_backend == 'nccl':
             torch.distributed.barrier(device_ids=[local_rank])
@@ -290,8 +352,23 @@ class DistributedTrainer:
               local_rank: int,
               target_checkpoint_examples: Optional[int] = None,
               device_mapper: Optional[Callable[[int, int], torch.device]] = None):
+        try:
+            self.run_training(world_size, rank, local_rank, target_checkpoint_examples, device_mapper)
+        finally:
+            self.training_protocol.close()
+            get_sample_output_writer().close()
+
+    def run_training(self,
+                     world_size: int,
+                     rank: int,
+                     local_rank: int,
+                     target_checkpoint_examples: Optional[int] = None,
+                     device_mapper: Optional[Callable[[int, int], torch.device]] = None):
         if target_checkpoint_examples is None:
             target_checkpoint_examples = self.checkpoint_examples[-1]
+        if self.has_stopped_early():
+            logging.info(f"Training has already stopped early. See {self.get_early_stop_marker_file_name()}.")
+            return
 
         if device_mapper is None:
             device_mapper = SimpleCudaDeviceMapper()
@@ -302,8 +379,10 @@ class DistributedTrainer:
             target_checkpoint_examples, world_size, rank, local_rank, device)
         summary_writer = self.get_summary_writer(rank)
         if summary_writer is not None:
-            log_func_factory = lambda name, num: create_log_func(summary_writer, name, num)
+            metrics_collector = MetricsCollector(summary_writer)
+            log_func_factory = metrics_collector.create_log_func
         else:
+            metrics_collector = None
             log_func_factory = None
         last_time = time.time()
 
@@ -315,8 +394,8 @@ class DistributedTrainer:
                     continue
                 lr = learning_rate_by_module_name[module_name]
                 set_learning_rate(training_state.optimizers[module_name], lr)
-                if summary_writer is not None:
-                    summary_writer.add_scalar(
+                if metrics_collector is not None:
+                    metrics_collector.add_scalar(
                         module_name + "_learning_rate", lr, training_state.examples_seen_so_far)
 
             # One training iteration
@@ -346,21 +425,26 @@ class DistributedTrainer:
 
             # Validation iteration
             if self.validation_protocol is not None \
-                    and training_state.examples_seen_so_far >= next_num_examples[KEY_VALIDATION] \
-                    and rank == 0:
-                validation_batch = self.get_next_validation_batch(device)
-                self.validation_protocol.run_validation_iteration(
-                    validation_batch,
-                    training_state.examples_seen_so_far,
-                    training_state.modules,
-                    training_state.accumulated_modules,
-                    self.losses,
-                    log_func_factory,
-                    device)
+                    and training_state.examples_seen_so_far >= next_num_examples[KEY_VALIDATION]:
+                self.materialize_accumulated_modules(training_state)
+                if rank == 0:
+                    validation_batch = self.get_next_validation_batch(device)
+                    self.validation_protocol.run_validation_iteration(
+                        validation_batch,
+                        training_state.examples_seen_so_far,
+                        training_state.modules,
+                        training_state.accumulated_modules,
+                        self.losses,
+                        log_func_factory,
+                        device)
+                if self.should_stop_training(rank, device):
+                    self.stop_training_early(training_state, rank, local_rank)
+                    break
 
             # Save sample output
             if self.sample_output_protocol is not None \
                     and training_state.examples_seen_so_far >= next_num_examples[KEY_SAMPLE_OUTPUT]:
+                self.materialize_accumulated_modules(training_state)
                 if rank == 0:
                     self.sample_output_protocol.save_sample_output_data(
                         training_state.modules,
@@ -373,21 +457,29 @@ class DistributedTrainer:
 
             # Save checkpoint
             if training_state.examples_seen_so_far >= next_num_examples[KEY_CHECKPOINT]:
+                self.materialize_accumulated_modules(training_state)
                 checkpoint_index = self.get_checkpoint_index_to_save(training_state.examples_seen_so_far)
-                training_state.save(
-                    self.get_checkpoint_prefix(checkpoint_index), rank, lambda: self.barrier(local_rank))
+                self.save_training_state(
+                    training_state, self.get_checkpoint_prefix(checkpoint_index), rank, local_rank)
                 if next_num_examples[KEY_CHECKPOINT] != next_num_examples[KEY_SNAPSHOT]:
-                    training_state.save(self.get_snapshot_prefix(), rank, lambda: self.barrier(local_rank))
+                    self.save_training_state(training_state, self.get_snapshot_prefix(), rank, local_rank)
 
             # Save snapshot
             if training_state.examples_seen_so_far >= next_num_examples[KEY_SNAPSHOT]:
-                training_state.save(self.get_snapshot_prefix(), rank, lambda: self.barrier(local_rank))
+                self.materialize_accumulated_modules(training_state)
+                self.save_training_state(training_state, self.get_snapshot_prefix(), rank, local_rank)
+
+            if metrics_collector is not None:
+                metrics_collector.step()
 
             now = time.time()
             if now - last_time > 10:
                 logging.info("Showed %d training examples." % training_state.examples_seen_so_far)
                 last_time = now
 
+        if metrics_collector is not None:
+            metrics_collector.close()
+
     @staticmethod
     def get_default_arg_parser() -> argparse.ArgumentParser:
         parser = argparse.ArgumentParser(description='Training script.')
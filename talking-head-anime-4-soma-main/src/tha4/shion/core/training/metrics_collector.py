@@ -0,0 +1,98 @@
+import queue
+import threading
+import time
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+import torch
+from torch import Tensor
+
+
+class MetricsReduction(Enum):
+    NONE = 0
+    MEAN = 1
+
+
+class MetricsCollector:
+    def __init__(self,
+                 summary_writer,
+                 flush_interval_steps: int = 100,
+                 flush_interval_seconds: float = 30.0,
+                 reduction: MetricsReduction = MetricsReduction.MEAN):
+        assert flush_interval_steps >= 1
+        self.reduction = reduction
+        self.flush_interval_seconds = flush_interval_seconds
+        self.flush_interval_steps = flush_interval_steps
+        self.summary_writer = summary_writer
+
+        self.pending: List[Tuple[str, Union[float, Tensor], int]] = []
+        self.num_steps_since_flush = 0
+        self.last_flush_time = time.time()
+
+        self.write_queue = queue.Queue()
+        self.writer_thread = threading.Thread(target=self.write_scalars, daemon=True)
+        self.writer_thread.start()
+
+    def add_scalar(self, tag: str, value: Union[float, Tensor], examples_seen_so_far: int):
+        if isinstance(value, Tensor):
+            value = value.detach()
+        self.pending.append((tag, value, examples_seen_so_far))
+
+    def create_log_func(self, prefix: str, examples_seen_so_far: int) -> Callable[[str, Union[float, Tensor]], None]:
+        def log_func(tag: str, value: Union[float, Tensor]):
+            self.add_scalar(prefix + "_" + tag, value, examples_seen_so_far)
+
+        return log_func
+
+    def step(self):
+        self.num_steps_since_flush += 1
+        if self.num_steps_since_flush >= self.flush_interval_steps \
+                or time.time() - self.last_flush_time >= self.flush_interval_seconds:
+            self.flush()
+
+    def get_values(self) -> List[float]:
+        values: List[Optional[float]] = [None for i in range(len(self.pending))]
+        tensor_positions_by_device: Dict[torch.device, List[int]] = {}
+        for i, (tag, value, examples_seen_so_far) in enumerate(self.pending):
+            if isinstance(value, Tensor):
+                tensor_positions_by_device.setdefault(value.device, []).append(i)
+            else:
+                values[i] = float(value)
+        for device, positions in tensor_positions_by_device.items():
+            stacked = torch.cat([self.pending[i][1].reshape(-1)[0:1].float() for i in positions])
+            for i, value in zip(positions, stacked.cpu().tolist()):
+                values[i] = value
+        return values
+
+    def reduce(self, values: List[float]) -> List[Tuple[str, float, int]]:
+        if self.reduction == MetricsReduction.NONE:
+            return [(tag, value, step) for (tag, _, step), value in zip(self.pending, values)]
+        sums: Dict[str, float] = {}
+        counts: Dict[str, int] = {}
+        last_steps: Dict[str, int] = {}
+        for (tag, _, step), value in zip(self.pending, values):
+            sums[tag] = sums.get(tag, 0.0) + value
+            counts[tag] = counts.get(tag, 0) + 1
+            last_steps[tag] = step
+        return [(tag, sums[tag] / counts[tag], last_steps[tag]) for tag in sums]
+
+    def flush(self):
+        if len(self.pending) > 0:
+            self.write_queue.put(self.reduce(self.get_values()))
+        self.pending = []
+        self.num_steps_since_flush = 0
+        self.last_flush_time = time.time()
+
+    def write_scalars(self):
+        while True:
+            scalars = self.write_queue.get()
+            if scalars is None:
+                return
+            for tag, value, examples_seen_so_far in scalars:
+                self.summary_writer.add_scalar(tag, value, examples_seen_so_far)
+
+    def close(self):
+        self.flush()
+        self.write_queue.put(None)
+        self.writer_thread.join()
+        self.summary_writer.flush()
@@ -0,0 +1,51 @@
+import math
+from typing import List
+
+
+class PlateauDetector:
+    def __init__(self,
+                 window_size: int = 10,
+                 patience: int = 5,
+                 min_relative_improvement: float = 0.01):
+        assert window_size >= 1
+        assert patience >= 1
+        assert min_relative_improvement >= 0.0
+        self.min_relative_improvement = min_relative_improvement
+        self.patience = patience
+        self.window_size = window_size
+
+        self.current_window: List[float] = []
+        self.window_means: List[float] = []
+        self.best_mean = math.inf
+        self.num_windows_without_improvement = 0
+
+    def add(self, value: float):
+        self.current_window.append(value)
+        if len(self.current_window) < self.window_size:
+            return
+        mean = sum(self.current_window) / len(self.current_window)
+        self.current_window = []
+        self.window_means.append(mean)
+        if mean < self.best_mean * (1.0 - self.min_relative_improvement):
+            self.best_mean = mean
+            self.num_windows_without_improvement = 0
+        else:
+            self.best_mean = min(self.best_mean, mean)
+            self.num_windows_without_improvement += 1
+
+    def has_plateaued(self) -> bool:
+        return self.num_windows_without_improvement >= self.patience
+
+    def state_dict(self) -> dict:
+        return {
+            'current_window': list(self.current_window),
+            'window_means': list(self.window_means),
+            'best_mean': self.best_mean,
+            'num_windows_without_improvement': self.num_windows_without_improvement,
+        }
+
+    def load_state_dict(self, state: dict):
+        self.current_window = list(state['current_window'])
+        self.window_means = list(state['window_means'])
+        self.best_mean = state['best_mean']
+        self.num_windows_without_improvement = state['num_windows_without_improvement']
@@ -43,6 +43,11 @@ class TrainingProtocol(ABC):
             device: torch.device):
         pass
 
+    # Releases the resources the protocol acquired during training, such as worker processes. The trainer calls it
+    # when training ends, whether normally or with an exception.
+    def close(self):
+        pass
+
 
 class AbstractTrainingProtocol(TrainingProtocol, ABC):
     def __init__(self,
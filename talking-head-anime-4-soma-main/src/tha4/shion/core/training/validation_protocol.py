@@ -28,6 +28,16 @@ class ValidationProtocol(ABC):
             device: torch.device):
         pass
 
+    def should_stop_training(self) -> bool:
+        return False
+
+    # The state that should survive a restart of the training process. The trainer saves it with each training state.
+    def state_dict(self) -> dict:
+        return {}
+
+    def load_state_dict(self, state: dict):
+        pass
+
 
 class AbstractValidationProtocol(ValidationProtocol, ABC):
     def __init__(self,